@@ -0,0 +1,3 @@
+"""
+离线性能测试工具：本地模拟钉钉与n8n的压测脚本和热点路径基准测试
+"""
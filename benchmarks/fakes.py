@@ -0,0 +1,391 @@
+"""
+压测用的本地替身服务
+- FakeStreamGateway：Stream网关，按设定速率通过WebSocket推送机器人消息回调，并记录ACK
+- FakeOpenAPI：钉钉OpenAPI（建立Stream连接、access_token、机器人群消息、AI卡片、会话webhook）
+- FakeN8nWebhook：n8n webhook，按延迟分布返回完整JSON或NDJSON/SSE流式回复
+所有替身通过LoadStats记录每条消息从推送到回复完成的各个时间点
+"""
+
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+from typing import Callable, Dict, Optional
+
+from aiohttp import web, WSMsgType
+
+logger = logging.getLogger(__name__)
+
+# 压测消息内容和回复内容都带上 [#序号]，用于把卡片和会话回复对应回原始消息
+TAG_PATTERN = re.compile(r"\[#(\d+)\]")
+
+CHATBOT_TOPIC = "/v1.0/im/bot/messages/get"
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    解析延迟分布
+    支持 fixed:0.2（或直接写0.2）、uniform:0.1,0.5、normal:均值,标准差、
+    lognormal:中位数,sigma、exp:均值，单位为秒
+    :return: 每次调用返回一个采样值（不小于0）的函数
+    """
+    kind, _, params = spec.partition(":")
+    if not params:
+        kind, params = "fixed", kind
+    try:
+        values = [float(value) for value in params.split(",")]
+    except ValueError:
+        raise ValueError(f"无法解析延迟分布: {spec}")
+    kind = kind.lower()
+    if kind == "fixed" and len(values) == 1:
+        return lambda: max(0.0, values[0])
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal" and len(values) == 2:
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        if values[0] <= 0:
+            raise ValueError(f"对数正态分布的中位数必须大于0: {spec}")
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    if kind == "exp" and len(values) == 1:
+        return lambda: random.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    raise ValueError(f"不支持的延迟分布: {spec}")
+
+
+class MessageRecord:
+    """一条压测消息的各个时间点（time.monotonic()）"""
+
+    def __init__(self, seq: int, sent_at: float):
+        self.seq = seq
+        self.sent_at = sent_at
+        self.acked_at: Optional[float] = None
+        self.first_update_at: Optional[float] = None
+        self.done_at: Optional[float] = None
+        # completed：卡片正常完成；failed：卡片以失败结束；busy：收到繁忙等会话回复
+        self.outcome: Optional[str] = None
+
+
+class LoadStats:
+    """压测过程中的消息记录"""
+
+    def __init__(self):
+        self.records: Dict[int, MessageRecord] = {}
+        self.done_count = 0
+        self.unmatched = 0
+        self.expected = 0
+        self._all_done = asyncio.Event()
+
+    def sent(self, seq: int):
+        self.records[seq] = MessageRecord(seq, time.monotonic())
+
+    def acked(self, seq: int):
+        record = self.records.get(seq)
+        if record is not None and record.acked_at is None:
+            record.acked_at = time.monotonic()
+
+    def first_update(self, seq: int, at: float):
+        record = self.records.get(seq)
+        if record is not None and record.first_update_at is None:
+            record.first_update_at = at
+
+    def finished(self, seq: Optional[int], outcome: str):
+        record = self.records.get(seq) if seq is not None else None
+        if record is None:
+            self.unmatched += 1
+            return
+        if record.done_at is not None:
+            return
+        record.done_at = time.monotonic()
+        record.outcome = outcome
+        self.done_count += 1
+        if self.expected and self.done_count >= self.expected:
+            self._all_done.set()
+
+    async def wait_all_done(self, expected: int, timeout: float) -> bool:
+        """等待expected条消息全部完成，超时返回False"""
+        self.expected = expected
+        if self.done_count >= expected:
+            return True
+        try:
+            await asyncio.wait_for(self._all_done.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class _Server:
+    """在当前事件循环中监听127.0.0.1随机端口的aiohttp服务"""
+
+    def __init__(self):
+        self.port = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def make_app(self) -> web.Application:
+        raise NotImplementedError
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class FakeStreamGateway(_Server):
+    """
+    Stream网关替身
+    机器人连接后由push按设定速率推送CALLBACK消息，收到的ACK按messageId计入统计
+    """
+
+    def __init__(self, stats: LoadStats, session_webhook_base: str = ""):
+        super().__init__()
+        self.stats = stats
+        self.session_webhook_base = session_webhook_base
+        self.connected = asyncio.Event()
+        self._ws: Optional[web.WebSocketResponse] = None
+
+    @property
+    def ws_url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}/connect"
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/connect", self._handle_connect)
+        return app
+
+    async def _handle_connect(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=None)
+        await ws.prepare(request)
+        self._ws = ws
+        self.connected.set()
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            ack = json.loads(message.data)
+            message_id = ack.get("headers", {}).get("messageId", "")
+            if message_id.startswith("lt-"):
+                self.stats.acked(int(message_id[3:]))
+        self.connected.clear()
+        return ws
+
+    def build_callback(self, seq: int, conversation: int, text: str) -> dict:
+        """构建一条机器人消息回调，字段与钉钉Stream推送的群聊文本消息一致"""
+        now_ms = int(time.time() * 1000)
+        data = {
+            "conversationId": f"cid-load-test-{conversation}",
+            "chatbotCorpId": "ding-load-test",
+            "chatbotUserId": "bot-load-test",
+            "msgId": f"msg-load-test-{seq}",
+            "senderNick": f"压测用户{conversation}",
+            "isAdmin": False,
+            "senderStaffId": f"staff-{conversation}",
+            "sessionWebhookExpiredTime": now_ms + 3600 * 1000,
+            "createAt": now_ms,
+            "senderCorpId": "ding-load-test",
+            "conversationType": "2",
+            "senderId": f"sender-{conversation}",
+            "conversationTitle": f"压测群{conversation}",
+            "isInAtList": True,
+            "sessionWebhook": f"{self.session_webhook_base}/robot/session/{seq}",
+            "text": {"content": text},
+            "robotCode": "load-test-robot",
+            "msgtype": "text",
+        }
+        return {
+            "specVersion": "1.0",
+            "type": "CALLBACK",
+            "headers": {
+                "appId": "load-test",
+                "connectionId": "load-test",
+                "contentType": "application/json",
+                "messageId": f"lt-{seq}",
+                "time": str(now_ms),
+                "topic": CHATBOT_TOPIC,
+            },
+            "data": json.dumps(data, ensure_ascii=False),
+        }
+
+    async def push(self, seq: int, conversation: int, text: str):
+        """推送一条消息"""
+        if self._ws is None or self._ws.closed:
+            raise ConnectionError("机器人未连接到Stream网关")
+        payload = json.dumps(self.build_callback(seq, conversation, text), ensure_ascii=False)
+        self.stats.sent(seq)
+        await self._ws.send_str(payload)
+
+    async def stop(self):
+        if self._ws is not None and not self._ws.closed:
+            await self._ws.close()
+        await super().stop()
+
+
+class FakeOpenAPI(_Server):
+    """
+    钉钉OpenAPI替身
+    卡片按outTrackId累积流式内容，从内容中的 [#序号] 找到对应消息；
+    isFinalize时记录完成，会话webhook回复（繁忙提示等）按URL中的序号记录
+    """
+
+    def __init__(self, stats: LoadStats, gateway_url: str = "", latency: Callable[[], float] = None):
+        super().__init__()
+        self.stats = stats
+        self.gateway_url = gateway_url
+        self.latency = latency or (lambda: 0.0)
+        self.requests: Dict[str, int] = {}
+        self._cards: Dict[str, dict] = {}
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1.0/gateway/connections/open", self._handle_open_connection)
+        app.router.add_post("/v1.0/oauth2/accessToken", self._handle_access_token)
+        app.router.add_post("/v1.0/robot/groupMessages/send", self._handle_group_send)
+        app.router.add_post("/v1.0/card/instances/createAndDeliver", self._handle_card_create)
+        app.router.add_put("/v1.0/card/streaming", self._handle_card_streaming)
+        app.router.add_post("/robot/session/{seq}", self._handle_session_reply)
+        return app
+
+    async def _delay(self, name: str):
+        self.requests[name] = self.requests.get(name, 0) + 1
+        latency = self.latency()
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    async def _handle_open_connection(self, request: web.Request) -> web.Response:
+        self.requests["open_connection"] = self.requests.get("open_connection", 0) + 1
+        return web.json_response({"endpoint": self.gateway_url, "ticket": "load-test-ticket"})
+
+    async def _handle_access_token(self, request: web.Request) -> web.Response:
+        await self._delay("access_token")
+        return web.json_response({"accessToken": "load-test-token", "expireIn": 7200})
+
+    async def _handle_group_send(self, request: web.Request) -> web.Response:
+        await self._delay("group_send")
+        body = await request.json()
+        match = TAG_PATTERN.search(body.get("msgParam", ""))
+        self.stats.finished(int(match.group(1)) if match else None, "completed")
+        return web.json_response({"processQueryKey": "load-test"})
+
+    async def _handle_card_create(self, request: web.Request) -> web.Response:
+        await self._delay("card_create")
+        body = await request.json()
+        self._cards[body["outTrackId"]] = {"content": "", "seq": None, "first_update_at": None}
+        return web.json_response({"success": True, "result": {"outTrackId": body["outTrackId"]}})
+
+    async def _handle_card_streaming(self, request: web.Request) -> web.Response:
+        received_at = time.monotonic()
+        await self._delay("card_streaming")
+        body = await request.json()
+        card = self._cards.get(body.get("outTrackId"))
+        if card is None:
+            return web.json_response({"code": "card.notFound", "message": "卡片不存在"}, status=404)
+        content = body.get("content") or ""
+        card["content"] = content if body.get("isFull") else card["content"] + content
+        if card["first_update_at"] is None and content:
+            card["first_update_at"] = received_at
+        if card["seq"] is None:
+            match = TAG_PATTERN.search(card["content"])
+            if match:
+                card["seq"] = int(match.group(1))
+                self.stats.first_update(card["seq"], card["first_update_at"] or received_at)
+        if body.get("isFinalize") or body.get("isError"):
+            self.stats.finished(card["seq"], "failed" if body.get("isError") else "completed")
+            self._cards.pop(body["outTrackId"], None)
+        return web.json_response({"success": True})
+
+    async def _handle_session_reply(self, request: web.Request) -> web.Response:
+        await self._delay("session_reply")
+        self.stats.finished(int(request.match_info["seq"]), "busy")
+        return web.json_response({"errcode": 0, "errmsg": "ok"})
+
+
+class FakeN8nWebhook(_Server):
+    """
+    n8n webhook替身
+    按latency采样首字节延迟，mode为json时返回完整的 {"output": ...}；
+    为ndjson/sse时把回复拆成chunks段，每段间隔chunk_interval秒流式返回
+    """
+
+    def __init__(self, latency: Callable[[], float], mode: str = "ndjson", chunks: int = 10,
+                 chunk_interval: float = 0.05, reply_chars: int = 300, error_rate: float = 0.0):
+        super().__init__()
+        if mode not in ("json", "ndjson", "sse"):
+            raise ValueError(f"不支持的n8n响应模式: {mode}")
+        self.latency = latency
+        self.mode = mode
+        self.chunks = max(1, chunks)
+        self.chunk_interval = chunk_interval
+        self.reply_chars = reply_chars
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/webhook/load-test"
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/webhook/load-test", self._handle_webhook)
+        app.router.add_get("/healthz", self._handle_health)
+        return app
+
+    async def _handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    def build_reply(self, tag: str) -> str:
+        """生成带序号标记的Markdown回复，包含段落和列表，覆盖分段逻辑"""
+        paragraph = "这是一段用于压测的AI回复内容，包含**加粗**和`代码`等Markdown格式。"
+        parts = [f"{tag} 收到，以下是回复："]
+        length = len(parts[0])
+        while length < self.reply_chars:
+            block = paragraph if len(parts) % 3 else f"- 列表项{len(parts)}：{paragraph}"
+            parts.append(block)
+            length += len(block) + 2
+        return "\n\n".join(parts)
+
+    def split_reply(self, reply: str):
+        size = max(1, -(-len(reply) // self.chunks))
+        return [reply[i:i + size] for i in range(0, len(reply), size)]
+
+    async def _handle_webhook(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.text()
+        match = TAG_PATTERN.search(body)
+        tag = match.group(0) if match else "[#?]"
+        await asyncio.sleep(self.latency())
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text="load test injected error")
+        reply = self.build_reply(tag)
+        if self.mode == "json":
+            return web.json_response({"output": reply}, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+        content_type = "application/x-ndjson" if self.mode == "ndjson" else "text/event-stream"
+        response = web.StreamResponse(headers={"Content-Type": f"{content_type}; charset=utf-8"})
+        await response.prepare(request)
+        if self.mode == "ndjson":
+            await response.write(b'{"type":"begin"}\n')
+        for i, chunk in enumerate(self.split_reply(reply)):
+            if i and self.chunk_interval > 0:
+                await asyncio.sleep(self.chunk_interval)
+            if self.mode == "ndjson":
+                line = json.dumps({"type": "item", "content": chunk}, ensure_ascii=False) + "\n"
+            else:
+                line = f"data: {json.dumps({'content': chunk}, ensure_ascii=False)}\n\n"
+            await response.write(line.encode("utf-8"))
+        await response.write(b'{"type":"end"}\n' if self.mode == "ndjson" else b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+端到端压测脚本
+在本地启动Stream网关、钉钉OpenAPI和n8n webhook的替身服务，以子进程方式运行main.py，
+按设定速率推送消息，统计吞吐量、ACK/首次更新/完成延迟的p50/p95/p99以及机器人进程的峰值内存。
+
+用法（在项目根目录执行）：
+    python -m benchmarks.load_test --messages 500 --rate 50 --n8n-latency lognormal:0.5,0.4
+    python -m benchmarks.load_test --env MAX_CONCURRENT_REPLIES=50 --json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import signal
+import asyncio
+import argparse
+import resource
+from pathlib import Path
+from typing import Dict, List, Optional
+
+if __package__ in (None, ""):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.fakes import FakeN8nWebhook, FakeOpenAPI, FakeStreamGateway, LoadStats, parse_latency
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="钉钉AI机器人端到端压测")
+    parser.add_argument("--messages", type=int, default=200, help="推送的消息总数")
+    parser.add_argument("--rate", type=float, default=20, help="每秒推送的消息数，0表示不限速")
+    parser.add_argument("--conversations", type=int, default=20, help="消息分布到多少个群会话")
+    parser.add_argument("--n8n-latency", default="lognormal:0.5,0.4",
+                        help="n8n首字节延迟分布，如 fixed:0.2、uniform:0.1,0.5、lognormal:0.5,0.4、exp:0.3")
+    parser.add_argument("--n8n-mode", choices=["json", "ndjson", "sse"], default="ndjson",
+                        help="n8n响应方式：完整JSON或NDJSON/SSE流式")
+    parser.add_argument("--n8n-chunks", type=int, default=10, help="流式回复拆分的段数")
+    parser.add_argument("--n8n-chunk-interval", type=float, default=0.05, help="流式回复每段间隔（秒）")
+    parser.add_argument("--n8n-error-rate", type=float, default=0.0, help="n8n返回503的比例")
+    parser.add_argument("--reply-chars", type=int, default=300, help="每条回复的大致字数")
+    parser.add_argument("--openapi-latency", default="fixed:0.01", help="钉钉OpenAPI每次请求的延迟分布")
+    parser.add_argument("--startup-timeout", type=float, default=30, help="等待机器人连接网关的超时（秒）")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="推送完成后等待回复完成的超时（秒）")
+    parser.add_argument("--stop-timeout", type=float, default=10,
+                        help="发送SIGTERM后等待机器人进程退出的超时（秒），超时后强制结束")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="传给机器人进程的额外环境变量，可重复，如 --env MAX_CONCURRENT_REPLIES=50")
+    parser.add_argument("--bot-log", default=None, help="机器人进程日志输出文件，默认丢弃")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    return parser
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩法计算百分位数，values为空时返回None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def _bot_env(args, openapi: FakeOpenAPI, n8n: FakeN8nWebhook) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "DINGTALK_CLIENT_ID": "load-test-client",
+        "DINGTALK_CLIENT_SECRET": "load-test-secret",
+        "DINGTALK_ROBOT_CODE": "load-test-robot",
+        "DINGTALK_AI_CARD_TEMPLATE_ID": "load-test.schema",
+        "DINGTALK_OPENAPI_ENDPOINT": openapi.base_url,
+        "N8N_WEBHOOK_URL": n8n.url,
+        "N8N_STREAMING": "false" if args.n8n_mode == "json" else "true",
+        "TOKEN_CACHE_FILE": "",
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": "WARNING",
+        "PYTHONUNBUFFERED": "1",
+    })
+    for item in args.env:
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"环境变量格式应为KEY=VALUE: {item}")
+        env[key] = value
+    return env
+
+
+def _peak_rss_kb(pid: int) -> Optional[int]:
+    """从/proc读取进程的峰值常驻内存（KB），非Linux系统返回None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+async def _stop_bot(process: asyncio.subprocess.Process, timeout: float = 10):
+    if process.returncode is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def run_load_test(args) -> dict:
+    """
+    执行一次压测
+    :param args: build_parser()解析出的参数
+    :return: 压测结果
+    """
+    stats = LoadStats()
+    openapi = FakeOpenAPI(stats, latency=parse_latency(args.openapi_latency))
+    gateway = FakeStreamGateway(stats)
+    n8n = FakeN8nWebhook(parse_latency(args.n8n_latency), mode=args.n8n_mode, chunks=args.n8n_chunks,
+                         chunk_interval=args.n8n_chunk_interval, reply_chars=args.reply_chars,
+                         error_rate=args.n8n_error_rate)
+    for server in (openapi, gateway, n8n):
+        await server.start()
+    openapi.gateway_url = gateway.ws_url
+    gateway.session_webhook_base = openapi.base_url
+
+    log_file = open(args.bot_log, "ab") if args.bot_log else None
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, str(PROJECT_ROOT / "main.py"), cwd=str(PROJECT_ROOT),
+        env=_bot_env(args, openapi, n8n),
+        stdout=log_file or asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.STDOUT,
+    )
+    peak_rss_kb = None
+    try:
+        started = time.monotonic()
+        connect = asyncio.ensure_future(gateway.connected.wait())
+        exited = asyncio.ensure_future(process.wait())
+        await asyncio.wait({connect, exited}, timeout=args.startup_timeout,
+                           return_when=asyncio.FIRST_COMPLETED)
+        connect.cancel()
+        exited.cancel()
+        if not gateway.connected.is_set():
+            raise RuntimeError("机器人进程未能连接到Stream网关"
+                               + (f"（退出码{process.returncode}）" if process.returncode is not None else ""))
+        startup_seconds = time.monotonic() - started
+
+        send_started = time.monotonic()
+        for seq in range(args.messages):
+            if args.rate > 0:
+                delay = send_started + seq / args.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await gateway.push(seq, seq % max(1, args.conversations), f"[#{seq}] 压测消息，请简单回复")
+        send_finished = time.monotonic()
+
+        drained = await stats.wait_all_done(args.messages, args.drain_timeout)
+        peak_rss_kb = _peak_rss_kb(process.pid)
+    finally:
+        await _stop_bot(process, args.stop_timeout)
+        for server in (gateway, openapi, n8n):
+            await server.stop()
+        if log_file:
+            log_file.close()
+    if peak_rss_kb is None:
+        # 子进程退出后才能读到，ru_maxrss在Linux上单位为KB
+        peak_rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    records = list(stats.records.values())
+    done = [r for r in records if r.done_at is not None]
+    outcomes: Dict[str, int] = {}
+    for record in done:
+        outcomes[record.outcome] = outcomes.get(record.outcome, 0) + 1
+    completed = [r for r in done if r.outcome == "completed"]
+    elapsed = (max(r.done_at for r in done) - send_started) if done else 0.0
+    return {
+        "messages": args.messages,
+        "startup_seconds": startup_seconds,
+        "send_seconds": send_finished - send_started,
+        "elapsed_seconds": elapsed,
+        "drained": drained,
+        "completed": outcomes.get("completed", 0),
+        "failed": outcomes.get("failed", 0),
+        "busy": outcomes.get("busy", 0),
+        "lost": len(records) - len(done),
+        "unmatched": stats.unmatched,
+        "throughput": len(completed) / elapsed if elapsed > 0 else 0.0,
+        "ack_latency": _latency_summary([r.acked_at - r.sent_at for r in records if r.acked_at is not None]),
+        "first_update_latency": _latency_summary(
+            [r.first_update_at - r.sent_at for r in completed if r.first_update_at is not None]),
+        "reply_latency": _latency_summary([r.done_at - r.sent_at for r in completed]),
+        "peak_rss_mb": peak_rss_kb / 1024 if peak_rss_kb else None,
+        "n8n_requests": n8n.requests,
+        "openapi_requests": dict(openapi.requests),
+    }
+
+
+def _format_ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+
+def print_report(result: dict):
+    print("\n压测结果")
+    print("=" * 50)
+    print(f"消息数: {result['messages']}，启动耗时: {result['startup_seconds']:.2f}s，"
+          f"推送耗时: {result['send_seconds']:.2f}s，总耗时: {result['elapsed_seconds']:.2f}s")
+    print(f"完成: {result['completed']}，失败: {result['failed']}，繁忙: {result['busy']}，"
+          f"未完成: {result['lost']}，无法对应: {result['unmatched']}")
+    print(f"吞吐量: {result['throughput']:.1f} 条/秒")
+    for key, name in (("ack_latency", "ACK延迟"), ("first_update_latency", "首次更新延迟"),
+                      ("reply_latency", "回复完成延迟")):
+        summary = result[key]
+        print(f"{name}: p50={_format_ms(summary['p50'])} p95={_format_ms(summary['p95'])} "
+              f"p99={_format_ms(summary['p99'])} max={_format_ms(summary['max'])}")
+    peak = result["peak_rss_mb"]
+    print(f"机器人进程峰值内存: {'-' if peak is None else f'{peak:.1f}MB'}")
+    print(f"n8n请求数: {result['n8n_requests']}，OpenAPI请求数: {result['openapi_requests']}")
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    result = asyncio.run(run_load_test(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+    return 0 if result["drained"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
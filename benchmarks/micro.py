@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+回复热点路径的微基准测试
+覆盖n8n响应解析（已解码的数据和完整响应体）、流式回复分段、Markdown消息格式化、用户消息提取、msgParam编码，
+以及新进程导入main.py的冷启动耗时。
+每项取多轮计时中的最小值作为单次耗时，与baseline.json中的基线比较，
+超过阈值（默认25%）视为性能回退，以非零退出码结束，可用于发布前检查。
+
+用法（在项目根目录执行）：
+    python -m benchmarks.micro                  # 与基线比较
+    python -m benchmarks.micro --save-baseline  # 在当前机器上重新生成基线
+    python -m benchmarks.micro -k parse         # 只运行名称包含parse的项
+"""
+
+import sys
+import json
+import timeit
+import subprocess
+import logging
+import argparse
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+if __package__ in (None, ""):
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+
+# 名称 -> 准备函数，准备函数返回被计时的无参函数
+BENCHMARKS: Dict[str, Callable[[], Callable[[], object]]] = {}
+
+
+def benchmark(name: str):
+    """注册一项基准测试"""
+    def decorator(setup: Callable[[], Callable[[], object]]):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+def _reply_text(chars: int) -> str:
+    """生成包含段落、列表和代码块的Markdown回复"""
+    blocks = [
+        "这是一段AI回复内容，包含**加粗**、`行内代码`和[链接](https://example.com)。第二句话！第三句话？",
+        "- 列表项：说明文字。\n- 列表项：更多说明。",
+        "```python\nfor i in range(10):\n    print('代码块内不切分。')\n```",
+    ]
+    parts = []
+    length = 0
+    while length < chars:
+        block = blocks[len(parts) % len(blocks)]
+        parts.append(block)
+        length += len(block) + 2
+    return "\n\n".join(parts)
+
+
+def _nested(depth: int, leaf) -> dict:
+    node = leaf
+    for level in range(depth):
+        node = {"level": level, "node": node, "items": [level, str(level)]}
+    return node
+
+
+def _ai_service():
+    from services.ai_service import AIService
+    return AIService("http://127.0.0.1:9/webhook")
+
+
+@benchmark("parse_ai_response_large")
+def bench_parse_large():
+    ai_service = _ai_service()
+    payload = [{
+        "output": _reply_text(20000),
+        "intermediateSteps": [{"action": {"tool": "search", "toolInput": "q" * 200}, "observation": "o" * 500}
+                              for _ in range(50)],
+    }]
+    return lambda: ai_service._parse_ai_response(payload)
+
+
+@benchmark("parse_ai_response_nested")
+def bench_parse_nested():
+    ai_service = _ai_service()
+    payload = {"data": {"reply": _reply_text(2000)}, "trace": _nested(100, "done")}
+    return lambda: ai_service._parse_ai_response(payload)
+
+
+@benchmark("parse_ai_response_unrecognized")
+def bench_parse_unrecognized():
+    # 顶层没有可识别字段时的兜底路径
+    ai_service = _ai_service()
+    payload = {"result": {"choices": [{"message": {"content": _reply_text(2000)}}]}, "trace": _nested(50, "done")}
+    return lambda: ai_service._parse_ai_response(payload)
+
+
+def _response_body(reply_first: bool) -> str:
+    steps = [{"action": {"tool": "search", "toolInput": "q" * 200}, "observation": "o" * 500}
+             for _ in range(2000)]
+    item = {"output": _reply_text(2000), "intermediateSteps": steps}
+    if not reply_first:
+        item = {"intermediateSteps": steps, "output": item["output"]}
+    return json.dumps([item], ensure_ascii=False)
+
+
+@benchmark("parse_response_body_reply_first")
+def bench_parse_body_reply_first():
+    # n8n附带大量执行数据，回复字段在前
+    ai_service = _ai_service()
+    body = _response_body(reply_first=True)
+    return lambda: ai_service._parse_complete_body(body)
+
+
+@benchmark("parse_response_body_reply_last")
+def bench_parse_body_reply_last():
+    ai_service = _ai_service()
+    body = _response_body(reply_first=False)
+    return lambda: ai_service._parse_complete_body(body)
+
+
+@benchmark("stream_reply_segmentation")
+def bench_segmentation():
+    from utils.markdown_segmenter import MarkdownSegmenter
+    text = _reply_text(20000)
+    deltas = [text[i:i + 20] for i in range(0, len(text), 20)]
+
+    def run():
+        # 与stream_reply相同的喂入方式
+        segmenter = MarkdownSegmenter()
+        segments = []
+        for delta in deltas:
+            segments.extend(segmenter.feed(delta))
+        segments.append(segmenter.flush())
+        return segments
+    return run
+
+
+@benchmark("format_markdown_content_long")
+def bench_format_markdown():
+    from services.dingtalk_service import DingTalkService
+    service = DingTalkService("robot", openapi_client=object())
+    text = "\n\n  " + _reply_text(50000) + "  \n"
+    return lambda: service.format_markdown_content(text, "压测用户")
+
+
+@benchmark("extract_user_message")
+def bench_extract_user_message():
+    from dingtalk_stream import ChatbotMessage
+    from handlers.chatbot_handler import AIChatbotHandler
+    # 只调用消息提取，不需要完整初始化handler
+    handler = AIChatbotHandler.__new__(AIChatbotHandler)
+    message = ChatbotMessage.from_dict({
+        "msgtype": "text",
+        "text": {"content": "@AI助手  请帮我总结一下今天的会议纪要，并列出待办事项。  "},
+    })
+    return lambda: handler._extract_user_message(message)
+
+
+@benchmark("encode_msg_param")
+def bench_encode_msg_param():
+    from services.dingtalk_service import encode_msg_param
+    params = {"title": "🤖 AI助手 回复 @压测用户", "text": _reply_text(2000)}
+    return lambda: encode_msg_param(params)
+
+
+@benchmark("startup_import_main")
+def bench_startup_import():
+    # 冷启动：新的解释器进程导入main.py及其依赖（包含解释器自身的启动耗时）
+    command = [sys.executable, "-c", "import main"]
+    return lambda: subprocess.run(command, cwd=ROOT, check=True)
+
+
+def measure(func: Callable[[], object], repeat: int = 5, min_time: float = 0.2) -> float:
+    """
+    测量单次调用耗时
+    :param repeat: 计时轮数，取最小值以减少系统噪声
+    :param min_time: 每轮最少运行时长（秒）
+    :return: 单次调用耗时（秒）
+    """
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run_benchmarks(names: List[str], repeat: int = 5, min_time: float = 0.2) -> Dict[str, float]:
+    """
+    运行基准测试
+    :return: 名称 -> 单次调用耗时（秒）
+    """
+    # 日志输出不计入耗时，也避免刷屏；日志消息本身的格式化仍然会执行
+    logging.disable(logging.CRITICAL)
+    try:
+        return {name: measure(BENCHMARKS[name](), repeat, min_time) for name in names}
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def load_baseline(path: Path = BASELINE_FILE) -> Dict[str, float]:
+    if not path.exists():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return {name: entry["seconds"] for name, entry in json.load(f)["benchmarks"].items()}
+
+
+def save_baseline(results: Dict[str, float], path: Path = BASELINE_FILE):
+    """保存基线，保留未运行项的原有基线"""
+    baseline = load_baseline(path)
+    baseline.update(results)
+    data = {
+        "python": sys.version.split()[0],
+        "benchmarks": {name: {"seconds": seconds} for name, seconds in sorted(baseline.items())},
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> List[str]:
+    """
+    与基线比较
+    :param threshold: 允许的变慢比例，如0.25表示比基线慢25%以内不算回退
+    :return: 发生回退的项目名称
+    """
+    return [name for name, seconds in results.items()
+            if name in baseline and seconds > baseline[name] * (1 + threshold)]
+
+
+def _format_seconds(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.2f}µs"
+    return f"{seconds * 1e3:.2f}ms"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="回复热点路径微基准测试")
+    parser.add_argument("-k", dest="keyword", default="", help="只运行名称包含该关键字的项")
+    parser.add_argument("--threshold", type=float, default=0.25, help="允许的变慢比例，默认0.25")
+    parser.add_argument("--repeat", type=int, default=5, help="计时轮数")
+    parser.add_argument("--min-time", type=float, default=0.2, help="每轮最少运行时长（秒）")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE, help="基线文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基线")
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if args.keyword in name]
+    results = run_benchmarks(names, args.repeat, args.min_time)
+    baseline = load_baseline(args.baseline)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions and not args.save_baseline:
+        # 单次计时容易受系统噪声影响，疑似回退的项目再测一次，取两次中的较小值
+        retry = run_benchmarks(regressions, args.repeat * 2, args.min_time)
+        results.update({name: min(results[name], seconds) for name, seconds in retry.items()})
+        regressions = compare(results, baseline, args.threshold)
+
+    print(f"{'名称':<32}{'耗时':>12}{'基线':>12}{'变化':>10}")
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        change = f"{(seconds / base - 1) * 100:+.1f}%" if base else "-"
+        flag = "  回退" if name in regressions else ""
+        print(f"{name:<32}{_format_seconds(seconds):>12}{_format_seconds(base):>12}{change:>10}{flag}")
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f"\n基线已保存到 {args.baseline}")
+        return 0
+    if regressions:
+        print(f"\n{len(regressions)}项比基线慢{args.threshold:.0%}以上: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,10 +16,124 @@ class Config:
     N8N_WEBHOOK_URL = os.getenv('N8N_WEBHOOK_URL', '')
     N8N_API_KEY = os.getenv('N8N_API_KEY', '')  # 如果需要认证
     N8N_WEBHOOK_TIMEOUT = int(os.getenv('N8N_WEBHOOK_TIMEOUT', '30'))
+    # 重试与熔断：重试共用N8N_WEBHOOK_TIMEOUT的总时长，熔断期间直接回复降级提示
+    N8N_RETRY_MAX_ATTEMPTS = int(os.getenv('N8N_RETRY_MAX_ATTEMPTS', '3'))
+    N8N_RETRY_BASE_DELAY = float(os.getenv('N8N_RETRY_BASE_DELAY', '0.5'))
+    N8N_RETRY_MAX_DELAY = float(os.getenv('N8N_RETRY_MAX_DELAY', '4'))
+    N8N_RETRY_STATUSES = os.getenv('N8N_RETRY_STATUSES', '429,502,503,504')
+    N8N_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('N8N_CIRCUIT_FAILURE_THRESHOLD', '5'))
+    N8N_CIRCUIT_RECOVERY_TIMEOUT = float(os.getenv('N8N_CIRCUIT_RECOVERY_TIMEOUT', '30'))
+    N8N_DEGRADED_MESSAGE = os.getenv('N8N_DEGRADED_MESSAGE', 'AI服务暂时不可用，请稍后再试~')
+    # 多个webhook地址（逗号分隔）时的负载均衡与健康检查
+    N8N_LOAD_BALANCING = os.getenv('N8N_LOAD_BALANCING', 'least_outstanding')  # least_outstanding/ewma
+    N8N_ENDPOINT_FAILURE_THRESHOLD = int(os.getenv('N8N_ENDPOINT_FAILURE_THRESHOLD', '3'))
+    N8N_ENDPOINT_EJECT_SECONDS = float(os.getenv('N8N_ENDPOINT_EJECT_SECONDS', '30'))
+    N8N_HEALTH_CHECK_INTERVAL = float(os.getenv('N8N_HEALTH_CHECK_INTERVAL', '0'))
+    N8N_HEALTH_CHECK_PATH = os.getenv('N8N_HEALTH_CHECK_PATH', '/healthz')
+    # 对冲请求：超过最近延迟的百分位仍未返回时再发一个请求，额外请求不超过预算；
+    # 流式调用只对冲输出内容之前等待响应头的阶段
+    N8N_HEDGING_ENABLED = os.getenv('N8N_HEDGING_ENABLED', 'false').lower() == 'true'
+    N8N_HEDGE_PERCENTILE = float(os.getenv('N8N_HEDGE_PERCENTILE', '95'))
+    N8N_HEDGE_BUDGET = float(os.getenv('N8N_HEDGE_BUDGET', '0.05'))
+    N8N_HEDGE_MIN_SAMPLES = int(os.getenv('N8N_HEDGE_MIN_SAMPLES', '20'))
+    # 是否以流式方式读取n8n响应（支持SSE/NDJSON/分块文本，普通JSON响应自动兼容）
+    N8N_STREAMING = os.getenv('N8N_STREAMING', 'true').lower() == 'true'
+    # 从n8n响应中提取回复的字段路径，逗号分隔，按顺序优先；路径各段用.分隔，纯数字表示列表下标
+    N8N_RESPONSE_PATHS = os.getenv('N8N_RESPONSE_PATHS', 'output,response,data.reply,message,content')
+    
+    # access_token缓存配置
+    TOKEN_REFRESH_AHEAD = int(os.getenv('TOKEN_REFRESH_AHEAD', '300'))  # 提前刷新的秒数
+    TOKEN_BACKGROUND_REFRESH = os.getenv('TOKEN_BACKGROUND_REFRESH', 'true').lower() == 'true'
+    TOKEN_CACHE_FILE = os.getenv('TOKEN_CACHE_FILE', '')  # 多进程共享的token缓存文件，为空则不启用
+    
+    # 启动预热：开始接收消息前建立到n8n和钉钉OpenAPI的长连接、获取token、检查卡片模板，失败不影响启动
+    STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', 'true').lower() == 'true'
+    STARTUP_WARMUP_TIMEOUT = float(os.getenv('STARTUP_WARMUP_TIMEOUT', '10'))
+    
+    # 多进程模式：大于1时主进程只负责启动和监控worker，每个worker建立自己的Stream长连接
+    WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '1'))
+    WORKER_RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', '1'))  # worker崩溃后重启前的等待秒数，连续崩溃时指数增长
+    WORKER_SHUTDOWN_TIMEOUT = float(os.getenv('WORKER_SHUTDOWN_TIMEOUT', '30'))  # 关闭时等待worker退出的秒数
+    # 主进程提供的共享状态服务地址，由主进程设置给worker，无需手动配置
+    LOCAL_STATE_SOCKET = os.getenv('LOCAL_STATE_SOCKET', '')
+    
+    # 钉钉OpenAPI地址和连接池配置，地址一般无需修改，压测或代理时可指向其他地址
+    DINGTALK_OPENAPI_ENDPOINT = os.getenv('DINGTALK_OPENAPI_ENDPOINT', 'https://api.dingtalk.com')
+    DINGTALK_HTTP_POOL_SIZE = int(os.getenv('DINGTALK_HTTP_POOL_SIZE', '100'))
+    DINGTALK_HTTP_TIMEOUT = float(os.getenv('DINGTALK_HTTP_TIMEOUT', '10'))
+    # 群消息发送限流（0表示不限制），排队中发往同一个群的同类型消息合并为一条发送
+    DINGTALK_SEND_GROUP_PER_MINUTE = float(os.getenv('DINGTALK_SEND_GROUP_PER_MINUTE', '20'))
+    DINGTALK_SEND_GROUP_BURST = int(os.getenv('DINGTALK_SEND_GROUP_BURST', '5'))
+    DINGTALK_SEND_APP_PER_SECOND = float(os.getenv('DINGTALK_SEND_APP_PER_SECOND', '20'))
+    DINGTALK_SEND_MERGE = os.getenv('DINGTALK_SEND_MERGE', 'true').lower() == 'true'
     
     # 机器人配置
     BOT_NAME = os.getenv('BOT_NAME', 'AI助手')
     MAX_MESSAGE_LENGTH = int(os.getenv('MAX_MESSAGE_LENGTH', '2000'))
+    # AI卡片流式更新频率上限（每张卡片每秒最多更新次数）
+    AI_CARD_MAX_UPDATES_PER_SECOND = float(os.getenv('AI_CARD_MAX_UPDATES_PER_SECOND', '2'))
+    # AI卡片单次更新最多携带的字符数，长回复在同一张卡片中分页追加，0表示不限制
+    AI_CARD_MAX_UPDATE_LENGTH = int(os.getenv('AI_CARD_MAX_UPDATE_LENGTH', '4000'))
+    
+    # 并发与排队配置，队列满时直接回复繁忙提示
+    MAX_CONCURRENT_REPLIES = int(os.getenv('MAX_CONCURRENT_REPLIES', '20'))
+    MAX_PENDING_REPLIES = int(os.getenv('MAX_PENDING_REPLIES', '200'))
+    # 公平排队：按发送者和会话分配处理份额，单个用户或会话最多排队的消息数（0表示不限制）
+    MAX_PENDING_PER_FLOW = int(os.getenv('MAX_PENDING_PER_FLOW', '20'))
+    # 优先级类别权重（vip：VIP会话或用户，dm：单聊，group：群聊），以及VIP名单（逗号分隔）
+    FAIR_QUEUE_CLASS_WEIGHTS = os.getenv('FAIR_QUEUE_CLASS_WEIGHTS', 'vip:4,dm:2,group:1')
+    FAIR_QUEUE_VIP_CONVERSATIONS = os.getenv('FAIR_QUEUE_VIP_CONVERSATIONS', '')
+    FAIR_QUEUE_VIP_USERS = os.getenv('FAIR_QUEUE_VIP_USERS', '')
+    BUSY_REPLY_MESSAGE = os.getenv('BUSY_REPLY_MESSAGE', '当前提问的人有点多，请稍后再试~')
+    # 关闭时等待处理中消息完成的秒数，超时未完成的卡片以失败状态结束并追加提示
+    SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '20'))
+    SHUTDOWN_REPLY_MESSAGE = os.getenv('SHUTDOWN_REPLY_MESSAGE', '（服务正在重启，回复中断，请重新提问）')
+    # 启用工作日志时被中断的消息会在重启后重放，改为追加以下提示
+    SHUTDOWN_RESUME_MESSAGE = os.getenv('SHUTDOWN_RESUME_MESSAGE', '（服务正在重启，回复中断，重启后将重新回复）')
+    # 工作日志：ACK前记录已接受的消息、发送前记录群消息，崩溃或强制结束后重启时重放，为空则不启用
+    JOURNAL_PATH = os.getenv('JOURNAL_PATH', '')
+    JOURNAL_REPLAY_MAX_AGE = float(os.getenv('JOURNAL_REPLAY_MAX_AGE', '3600'))  # 超过该秒数的条目不再重放
+    JOURNAL_MAX_ATTEMPTS = int(os.getenv('JOURNAL_MAX_ATTEMPTS', '3'))  # 每个条目最多重放的次数
+    # 消息顺序：conversation（同一会话串行）/conversation_user（同一会话内同一用户串行）/none
+    MESSAGE_ORDERING_SCOPE = os.getenv('MESSAGE_ORDERING_SCOPE', 'conversation')
+    # 重复投递消息去重：none/memory（进程内）/redis（多进程共享）
+    MESSAGE_DEDUP_BACKEND = os.getenv('MESSAGE_DEDUP_BACKEND', 'memory')
+    MESSAGE_DEDUP_TTL = int(os.getenv('MESSAGE_DEDUP_TTL', '300'))
+    # 按用户（staffId）和会话的限流与每日配额，在调用n8n之前检查，0表示不限制
+    RATE_LIMIT_WINDOW = float(os.getenv('RATE_LIMIT_WINDOW', '60'))  # 滑动窗口长度（秒）
+    RATE_LIMIT_PER_USER = int(os.getenv('RATE_LIMIT_PER_USER', '0'))
+    RATE_LIMIT_PER_CONVERSATION = int(os.getenv('RATE_LIMIT_PER_CONVERSATION', '0'))
+    DAILY_QUOTA_PER_USER = int(os.getenv('DAILY_QUOTA_PER_USER', '0'))
+    DAILY_QUOTA_PER_CONVERSATION = int(os.getenv('DAILY_QUOTA_PER_CONVERSATION', '0'))
+    RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # memory/redis（多进程共享）
+    RATE_LIMIT_MESSAGE = os.getenv('RATE_LIMIT_MESSAGE', '提问太频繁了，请稍后再试~')
+    DAILY_QUOTA_MESSAGE = os.getenv('DAILY_QUOTA_MESSAGE', '今天的提问次数已用完，请明天再来~')
+    
+    # 对话历史（多轮上下文）配置
+    CONVERSATION_MEMORY_BACKEND = os.getenv('CONVERSATION_MEMORY_BACKEND', 'none')  # none/memory/redis
+    CONVERSATION_MEMORY_SCOPE = os.getenv('CONVERSATION_MEMORY_SCOPE', 'conversation')  # conversation/user/conversation_user
+    CONVERSATION_MEMORY_MAX_TURNS = int(os.getenv('CONVERSATION_MEMORY_MAX_TURNS', '10'))
+    CONVERSATION_MEMORY_TTL = int(os.getenv('CONVERSATION_MEMORY_TTL', '3600'))
+    CONVERSATION_MEMORY_MAX_CONVERSATIONS = int(os.getenv('CONVERSATION_MEMORY_MAX_CONVERSATIONS', '10000'))
+    CONVERSATION_PROMPT_MAX_LENGTH = int(os.getenv('CONVERSATION_PROMPT_MAX_LENGTH', '4000'))
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+    
+    # 重复问题回复缓存配置
+    RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+    RESPONSE_CACHE_SCOPE = os.getenv('RESPONSE_CACHE_SCOPE', 'global')  # global/conversation/user
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '600'))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+    RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(10 * 1024 * 1024)))
+    RESPONSE_CACHE_WORKFLOW_ALLOWLIST = os.getenv('RESPONSE_CACHE_WORKFLOW_ALLOWLIST', '')
+    RESPONSE_CACHE_WORKFLOW_DENYLIST = os.getenv('RESPONSE_CACHE_WORKFLOW_DENYLIST', '')
+    
+    # 进行中请求合并配置
+    REQUEST_COALESCING_ENABLED = os.getenv('REQUEST_COALESCING_ENABLED', 'false').lower() == 'true'
+    REQUEST_COALESCING_SCOPE = os.getenv('REQUEST_COALESCING_SCOPE', 'global')  # global/conversation/user
+    
+    # 指标与健康检查HTTP服务（/metrics、/healthz），端口为0表示不启动
+    METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
     
     # 日志配置
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
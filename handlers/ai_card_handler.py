@@ -1,24 +1,192 @@
 import os
+import time
 import asyncio
 import json
 from dingtalk_stream import AckMessage, ChatbotHandler, CallbackMessage, ChatbotMessage, AICardReplier
 from loguru import logger
 
+from config import Config
+from services.dingtalk_openapi import DingTalkOpenAPIClient, get_openapi_client, offload
+from utils.admission_control import AdmissionController, PriorityClasses, fair_flows, lane_key
+from utils.card_stream_scheduler import CardStreamScheduler, CardUpdate
+from utils.message_dedup import MessageDeduplicator, create_message_deduplicator
+from utils.rate_limiter import RateLimiter, create_rate_limiter, limit_message
+from utils.metrics import (
+    CALLBACK_ACK_SECONDS, CARD_CREATE_SECONDS, FAILURES_TOTAL, FIRST_CARD_UPDATE_SECONDS,
+    REPLY_SECONDS, since
+)
+from utils.token_manager import TokenManager
+from utils.work_journal import CURRENT_ENTRY, KIND_INBOUND, WorkJournal, run_journaled
+
 # 这里可根据需要引入 n8n-on-dingtalk 的 ai_service/dingtalk_service 等
 
+# env.example和README中的示例值，说明没有填写真实的卡片模板ID
+CARD_TEMPLATE_PLACEHOLDERS = ("请填写你的钉钉AI卡片模板ID", "your_dingtalk_ai_card_template_id")
+
 class AICardHandler(ChatbotHandler):
-    def __init__(self, ai_service):
+    def __init__(self, ai_service, token_manager: TokenManager = None,
+                 openapi_client: DingTalkOpenAPIClient = None,
+                 deduplicator: MessageDeduplicator = None, journal: WorkJournal = None,
+                 rate_limiter: RateLimiter = None):
+        """
+        :param journal: 工作日志，ACK前记录已接受的消息，崩溃后重启时重放，为空则不启用
+        :param rate_limiter: 按用户和会话的限流与每日配额，为空时按配置创建
+        """
         super().__init__()
         self.ai_service = ai_service
+        self.openapi_client = openapi_client or get_openapi_client()
+        self.token_manager = token_manager or TokenManager(
+            Config.CLIENT_ID, Config.CLIENT_SECRET, self.openapi_client,
+            refresh_ahead=Config.TOKEN_REFRESH_AHEAD,
+            cache_file=Config.TOKEN_CACHE_FILE or None,
+            background_refresh=Config.TOKEN_BACKGROUND_REFRESH,
+        )
+        self.admission = AdmissionController(Config.MAX_CONCURRENT_REPLIES, Config.MAX_PENDING_REPLIES,
+                                             Config.MAX_PENDING_PER_FLOW)
+        self.priority_classes = PriorityClasses.from_config(Config)
+        self.deduplicator = deduplicator if deduplicator is not None else create_message_deduplicator(Config)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else create_rate_limiter(Config)
+        self.journal = journal
+        # 关闭过程中不再接受新消息
+        self.draining = False
+        # 后台发送的提示回复，保留引用避免执行中被回收
+        self._reply_tasks = set()
         # 可扩展缓存、会话等
 
     async def process(self, callback_msg: CallbackMessage):
-        logger.debug(callback_msg)
-        incoming_message = ChatbotMessage.from_dict(callback_msg.data)
-        logger.info(f"收到用户消息: {incoming_message}")
-        task = asyncio.create_task(self._process_async(incoming_message))
+        received_at = time.monotonic()
+        if self.draining:
+            # 返回非OK状态，钉钉稍后重新投递，由其他连接（其他worker或重启后的进程）处理；
+            # 必须在去重之前返回，否则重新投递的消息会被当作重复消息丢弃
+            return AckMessage.STATUS_SYSTEM_EXCEPTION, "shutting down"
+        try:
+            logger.debug(callback_msg)
+            # 丢弃重连或ACK超时后重复投递的消息，避免重复调用n8n和重复投放卡片
+            if self.deduplicator is not None and await self.deduplicator.is_duplicate(callback_msg.data.get("msgId")):
+                return AckMessage.STATUS_OK, "OK"
+            incoming_message = ChatbotMessage.from_dict(callback_msg.data)
+            logger.info(f"收到用户消息: {incoming_message}")
+            if self.rate_limiter is not None:
+                exceeded = await self.rate_limiter.check(incoming_message.sender_staff_id,
+                                                         incoming_message.conversation_id)
+                if exceeded is not None:
+                    # 超出限流或每日配额，直接回复提示，不调用n8n
+                    self._reply_in_background(limit_message(Config, exceeded), incoming_message)
+                    return AckMessage.STATUS_OK, "OK"
+            # ACK前落盘，进程崩溃后重启时重放
+            entry_id = await self.journal.record(KIND_INBOUND, callback_msg.data) if self.journal else None
+            if not self._submit(incoming_message, received_at, entry_id):
+                # 超出处理能力，快速回复繁忙提示
+                if self.journal is not None:
+                    self.journal.complete(entry_id)
+                self._reply_in_background(Config.BUSY_REPLY_MESSAGE, incoming_message)
+            return AckMessage.STATUS_OK, "OK"
+        finally:
+            CALLBACK_ACK_SECONDS.observe(since(received_at))
+
+    def _submit(self, incoming_message: ChatbotMessage, received_at: float, entry_id: int = None) -> bool:
+        """
+        提交处理，同一会话的消息按顺序处理，不同会话并行，排队时按发送者和会话加权公平调度
+        :param entry_id: 工作日志条目ID，处理结束后标记完成
+        :return: 是否被接受，队列已满或该用户/会话排队过多时返回False
+        """
+        user_id = incoming_message.sender_staff_id
+        conversation_id = incoming_message.conversation_id
+        key = lane_key(Config.MESSAGE_ORDERING_SCOPE, user_id, conversation_id)
+        priority = self.priority_classes.classify(incoming_message.conversation_type, conversation_id, user_id)
+        return self.admission.submit(run_journaled, self.journal, entry_id, self._process_async,
+                                     incoming_message, received_at, key=key,
+                                     flows=fair_flows(user_id, conversation_id),
+                                     weight=self.priority_classes.weight(priority), priority=priority)
+
+    async def replay_journal(self) -> int:
+        """
+        重放之前的进程（崩溃、被强制结束或关闭时未处理完）已接受但未完成的消息，
+        不经过去重，以免重新投递的记录把它们当作重复消息丢弃
+        :return: 重放的消息数
+        """
+        if self.journal is None:
+            return 0
+        entries = await self.journal.recover(Config.JOURNAL_REPLAY_MAX_AGE, Config.JOURNAL_MAX_ATTEMPTS)
+        replayed = 0
+        for entry in entries:
+            if entry.kind != KIND_INBOUND:
+                logger.warning(f"AI卡片模式不处理的日志条目，已丢弃: id={entry.id}, kind={entry.kind}")
+                self.journal.complete(entry.id)
+                continue
+            incoming_message = ChatbotMessage.from_dict(entry.payload)
+            if self._submit(incoming_message, time.monotonic(), entry.id):
+                replayed += 1
+            else:
+                # 条目保留，下次启动时再重放
+                logger.warning(f"处理队列已满，暂不重放: id={entry.id}")
+        if entries:
+            logger.info(f"重放上次未完成的消息: {replayed}/{len(entries)}")
+        return replayed
+
+    async def warm_up(self) -> bool:
+        """
+        预热：建立到钉钉OpenAPI的长连接、获取access_token并检查卡片模板配置
+        :return: 全部成功返回True
+        """
+        connected, access_token = await asyncio.gather(
+            self.openapi_client.warm_up(), self.token_manager.get_token())
+        if not access_token:
+            logger.warning("预热时获取access_token失败，首条消息时会重试")
+        return connected and bool(access_token) and self.check_card_template()
+
+    @staticmethod
+    def check_card_template() -> bool:
+        """检查是否配置了AI卡片模板ID，未配置时所有卡片都会投放失败"""
+        card_template_id = os.getenv("DINGTALK_AI_CARD_TEMPLATE_ID", "").strip()
+        if not card_template_id or card_template_id in CARD_TEMPLATE_PLACEHOLDERS:
+            logger.error("未配置AI卡片模板ID（DINGTALK_AI_CARD_TEMPLATE_ID），AI卡片将无法投放")
+            return False
+        return True
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        停止接受新消息，等待已接受的消息处理完
+        超时后取消仍在处理的消息，已投放的卡片以失败状态结束并提示用户，不会一直显示输入中
+        :param timeout: 最长等待时间（秒）
+        :return: 是否在超时前全部处理完
+        """
+        self.draining = True
+        stats = self.admission.stats()
+        logger.info(f"等待处理中的消息完成: running={stats['running']}, queue_depth={stats['queue_depth']}, "
+                    f"timeout={timeout}s")
+        drained = await self.admission.drain(timeout)
+        if not drained:
+            stats = self.admission.stats()
+            logger.warning(f"未能在{timeout}秒内处理完，取消剩余消息: running={stats['running']}, "
+                           f"queue_depth={stats['queue_depth']}")
+        # 取消仍在执行的任务，卡片在_process_async中以失败状态结束
+        await self.admission.close()
+        return drained
+
+    def abort_drain(self):
+        """不再等待处理中的消息，立即取消"""
+        self.admission.abort_drain()
+
+    async def close(self):
+        """关闭资源"""
+        await self.admission.close()
+        await self.token_manager.close()
+        if self.deduplicator is not None:
+            await self.deduplicator.close()
+        if self.rate_limiter is not None:
+            await self.rate_limiter.close()
+
+    def _reply_in_background(self, text: str, incoming_message: ChatbotMessage):
+        """
+        在后台通过会话webhook回复提示，不阻塞ACK
+        :param text: 回复内容
+        :param incoming_message: 钉钉消息对象
+        """
+        task = asyncio.create_task(offload(self.reply_text, text, incoming_message))
+        self._reply_tasks.add(task)
+        task.add_done_callback(self._reply_tasks.discard)
         task.add_done_callback(self._handle_task_exception)
-        return AckMessage.STATUS_OK, "OK"
 
     def _handle_task_exception(self, task):
         try:
@@ -28,39 +196,122 @@ class AICardHandler(ChatbotHandler):
         except Exception as e:
             logger.error(f"处理异步任务异常时出错: {e}")
 
-    async def _process_async(self, incoming_message: ChatbotMessage):
+    async def _process_async(self, incoming_message: ChatbotMessage, received_at: float = None):
+        """
+        :param received_at: 收到消息的时间（time.monotonic()），用于统计各阶段耗时
+        """
+        received_at = received_at or time.monotonic()
         try:
             if incoming_message.message_type != "text":
-                self.reply_text("对不起，我目前只支持文字消息~", incoming_message)
+                # 会话webhook回复只有同步SDK实现，放到线程池中执行
+                await offload(self.reply_text, "对不起，我目前只支持文字消息~", incoming_message)
                 return
 
             # 统一读取卡片模板ID
             card_template_id = os.getenv("DINGTALK_AI_CARD_TEMPLATE_ID")
             content_key = "content"
             card_data = {content_key: ""}
-            card_instance = AICardReplier(self.dingtalk_client, incoming_message)
+            access_token = await self.token_manager.get_token()
+            if not access_token:
+                logger.error("获取access_token失败，无法投放AI卡片")
+                FAILURES_TOTAL.inc(stage="token")
+                return
             # 投放卡片
-            card_instance_id = card_instance.create_and_send_card(card_template_id, card_data, callback_type="STREAM")
-            # 流式更新卡片内容
-            buffer = ""
-            async for content_value in self.ai_service.stream_reply(incoming_message):
-                buffer += content_value
-                card_instance.streaming(
-                    card_instance_id,
-                    content_key=content_key,
-                    content_value=buffer,
-                    append=False,
-                    finished=False,
-                    failed=False,
-                )
-            # 最后一次 finished=True
-            card_instance.streaming(
-                card_instance_id,
-                content_key=content_key,
-                content_value=buffer,
-                append=False,
-                finished=True,
-                failed=False,
+            card_instance_id = AICardReplier.gen_card_id(incoming_message)
+            body = self._build_card_body(incoming_message, card_template_id, card_instance_id, card_data)
+            card_started = time.monotonic()
+            created = await self.openapi_client.create_and_deliver_card(access_token, body)
+            CARD_CREATE_SECONDS.observe(since(card_started))
+            if not created:
+                logger.error("AI卡片投放失败")
+                FAILURES_TOTAL.inc(stage="card_create")
+                return
+
+            first_update = True
+
+            async def send_update(update: CardUpdate) -> bool:
+                nonlocal first_update
+                sent = await self._send_card_update(card_instance_id, content_key, update)
+                if sent and first_update:
+                    first_update = False
+                    FIRST_CARD_UPDATE_SECONDS.observe(since(received_at))
+                return sent
+
+            # 流式更新卡片内容，分段合并后按频率限制以增量方式发送
+            scheduler = CardStreamScheduler(
+                send_update,
+                max_updates_per_second=Config.AI_CARD_MAX_UPDATES_PER_SECOND,
+                max_update_length=Config.AI_CARD_MAX_UPDATE_LENGTH,
             )
+            try:
+                async for content_value in self.ai_service.stream_reply(incoming_message):
+                    scheduler.push(content_value)
+            except asyncio.CancelledError:
+                # 关闭时未能在期限内完成，以失败状态结束卡片
+                logger.warning(f"服务关闭，中断AI卡片流式更新: {card_instance_id}")
+                FAILURES_TOTAL.inc(stage="shutdown")
+                # 已记录在工作日志中的消息会在重启后重放，不要让用户重新提问，以免收到两次回复
+                notice = Config.SHUTDOWN_RESUME_MESSAGE if CURRENT_ENTRY.get() is not None \
+                    else Config.SHUTDOWN_REPLY_MESSAGE
+                await scheduler.finish(failed=True, content="\n\n" + notice)
+                raise
+            except Exception as e:
+                logger.exception(f"流式获取AI回复异常: {e}")
+                FAILURES_TOTAL.inc(stage="reply")
+                await scheduler.finish(failed=True, content="\n\n（回复中断，请稍后再试）")
+                REPLY_SECONDS.observe(since(received_at), handler="card")
+                return
+            # 最后一次 finished=True
+            await scheduler.finish()
+            REPLY_SECONDS.observe(since(received_at), handler="card")
+            logger.info(f"AI卡片流式更新完成，共{scheduler.updates_sent}次更新")
         except Exception as e:
-            logger.exception(f"处理消息时发生未知错误: {e}") 
\ No newline at end of file
+            logger.exception(f"处理消息时发生未知错误: {e}")
+            FAILURES_TOTAL.inc(stage="reply")
+
+    def _build_card_body(self, incoming_message: ChatbotMessage, card_template_id: str,
+                         card_instance_id: str, card_data: dict) -> dict:
+        """
+        构建创建并投放AI卡片的请求体，群聊投放到群，单聊投放到机器人会话
+        """
+        body = {
+            "cardTemplateId": card_template_id,
+            "outTrackId": card_instance_id,
+            "cardData": {"cardParamMap": card_data},
+            "callbackType": "STREAM",
+            "imGroupOpenSpaceModel": {"supportForward": True},
+            "imRobotOpenSpaceModel": {"supportForward": True},
+        }
+        hosting_extension = None
+        if incoming_message.hosting_context is not None:
+            hosting_extension = {
+                "hostingRepliedContext": json.dumps({"userId": incoming_message.hosting_context.user_id})
+            }
+
+        # 2：群聊，1：单聊
+        if incoming_message.conversation_type == "2":
+            body["openSpaceId"] = f"dtv1.card//IM_GROUP.{incoming_message.conversation_id}"
+            body["imGroupOpenDeliverModel"] = {"robotCode": Config.ROBOT_CODE}
+            if hosting_extension:
+                body["imGroupOpenDeliverModel"]["extension"] = hosting_extension
+        else:
+            body["openSpaceId"] = f"dtv1.card//IM_ROBOT.{incoming_message.sender_staff_id}"
+            body["imRobotOpenDeliverModel"] = {"spaceType": "IM_ROBOT"}
+            if hosting_extension:
+                body["imRobotOpenDeliverModel"]["extension"] = hosting_extension
+        return body
+
+    async def _send_card_update(self, card_instance_id: str, content_key: str, update: CardUpdate) -> bool:
+        access_token = await self.token_manager.get_token()
+        if not access_token:
+            logger.error("获取access_token失败，无法更新AI卡片")
+            return False
+        return await self.openapi_client.streaming_card(
+            access_token,
+            card_instance_id,
+            key=content_key,
+            content=update.content,
+            append=update.append,
+            finished=update.finished,
+            failed=update.failed,
+        )
@@ -1,11 +1,21 @@
+import time
 import logging
 import asyncio
-from typing import Optional
+from typing import AsyncIterator, Optional
 import dingtalk_stream
 from dingtalk_stream import AckMessage
 
+from utils.admission_control import AdmissionController, PriorityClasses, fair_flows, lane_key
+from utils.message_dedup import create_message_deduplicator
+from utils.markdown_segmenter import MarkdownPaginator
+from utils.metrics import CALLBACK_ACK_SECONDS, FAILURES_TOTAL, REPLY_SECONDS, since
+from utils.rate_limiter import create_rate_limiter, limit_message
+from utils.resilience import CircuitOpenError
+from utils.send_scheduler import PRIORITY_NOTICE
 from utils.token_manager import TokenManager
+from utils.work_journal import KIND_INBOUND, KIND_OUTBOUND, WorkJournal, run_journaled
 from services.ai_service import AIService
+from services.dingtalk_openapi import offload
 from services.dingtalk_service import DingTalkService
 from config import Config
 
@@ -17,9 +27,24 @@ class AIChatbotHandler(dingtalk_stream.ChatbotHandler):
     def __init__(self, config: Config):
         super(dingtalk_stream.ChatbotHandler, self).__init__()
         self.config = config
-        self.token_manager = TokenManager(config.CLIENT_ID, config.CLIENT_SECRET)
+        self.token_manager = TokenManager(
+            config.CLIENT_ID, config.CLIENT_SECRET,
+            refresh_ahead=config.TOKEN_REFRESH_AHEAD,
+            cache_file=config.TOKEN_CACHE_FILE or None,
+            background_refresh=config.TOKEN_BACKGROUND_REFRESH,
+        )
         self.ai_service = AIService(config.N8N_WEBHOOK_URL, config.N8N_API_KEY)
-        self.dingtalk_service = DingTalkService(config.ROBOT_CODE)
+        self.journal = WorkJournal(config.JOURNAL_PATH) if config.JOURNAL_PATH else None
+        if self.journal is not None:
+            self.journal.open()
+        self.dingtalk_service = DingTalkService(config.ROBOT_CODE, journal=self.journal)
+        self.admission = AdmissionController(config.MAX_CONCURRENT_REPLIES, config.MAX_PENDING_REPLIES,
+                                             config.MAX_PENDING_PER_FLOW)
+        self.priority_classes = PriorityClasses.from_config(config)
+        self.deduplicator = create_message_deduplicator(config)
+        self.rate_limiter = create_rate_limiter(config)
+        # 后台发送的提示回复，保留引用避免执行中被回收
+        self._reply_tasks = set()
     
     async def process(self, callback: dingtalk_stream.CallbackMessage):
         """
@@ -27,7 +52,12 @@ class AIChatbotHandler(dingtalk_stream.ChatbotHandler):
         :param callback: 回调消息对象
         :return: 处理结果
         """
+        received_at = time.monotonic()
         try:
+            # 丢弃重连或ACK超时后重复投递的消息
+            if self.deduplicator and await self.deduplicator.is_duplicate(callback.data.get('msgId')):
+                return AckMessage.STATUS_OK, 'OK'
+            
             # 解析消息
             incoming_message = dingtalk_stream.ChatbotMessage.from_dict(callback.data)
             
@@ -37,23 +67,102 @@ class AIChatbotHandler(dingtalk_stream.ChatbotHandler):
                 logger.warning("无法提取用户消息内容")
                 return AckMessage.STATUS_OK, 'OK'
             
-            # 获取用户信息
-            user_id = getattr(incoming_message, 'sender_staff_id', None)
-            user_name = getattr(incoming_message, 'sender_nick', None)
-            conversation_id = incoming_message.conversation_id
+            logger.info(f"收到用户消息: {getattr(incoming_message, 'sender_nick', None)}"
+                        f"({getattr(incoming_message, 'sender_staff_id', None)}): {user_message}")
             
-            logger.info(f"收到用户消息: {user_name}({user_id}): {user_message}")
+            # 超出限流或每日配额时直接回复提示，不调用n8n
+            if self.rate_limiter is not None:
+                exceeded = await self.rate_limiter.check(getattr(incoming_message, 'sender_staff_id', None),
+                                                         incoming_message.conversation_id)
+                if exceeded is not None:
+                    self._reply_in_background(limit_message(self.config, exceeded), incoming_message)
+                    return AckMessage.STATUS_OK, 'OK'
             
-            # 异步处理AI回复
-            asyncio.create_task(self._process_ai_response(
-                user_message, user_id, user_name, conversation_id
-            ))
+            # ACK前落盘，进程崩溃后重启时重放
+            entry_id = await self.journal.record(KIND_INBOUND, callback.data) if self.journal else None
+            
+            # 异步处理AI回复，超出处理能力时快速回复繁忙提示
+            if not self._submit(incoming_message, user_message, received_at, entry_id):
+                if self.journal is not None:
+                    self.journal.complete(entry_id)
+                self._reply_in_background(self.config.BUSY_REPLY_MESSAGE, incoming_message)
             
             return AckMessage.STATUS_OK, 'OK'
             
         except Exception as e:
             logger.error(f"处理消息异常: {e}")
             return AckMessage.STATUS_OK, 'OK'  # 返回OK避免重试
+        finally:
+            CALLBACK_ACK_SECONDS.observe(since(received_at))
+    
+    def _reply_in_background(self, text: str, incoming_message):
+        """
+        在后台通过会话webhook回复提示，不阻塞ACK
+        :param text: 回复内容
+        :param incoming_message: 钉钉消息对象
+        """
+        task = asyncio.create_task(offload(self.reply_text, text, incoming_message))
+        self._reply_tasks.add(task)
+        task.add_done_callback(self._reply_tasks.discard)
+        task.add_done_callback(self._handle_task_exception)
+    
+    def _handle_task_exception(self, task):
+        try:
+            exception = task.exception()
+            if exception:
+                logger.error(f"异步处理任务异常: {exception}")
+        except Exception as e:
+            logger.error(f"处理异步任务异常时出错: {e}")
+    
+    def _submit(self, incoming_message, user_message: str, received_at: float, entry_id: int = None) -> bool:
+        """
+        提交AI回复任务，同一会话的消息按顺序处理，排队时按发送者和会话加权公平调度
+        :param entry_id: 工作日志条目ID，处理结束后标记完成
+        :return: 是否被接受，队列已满或该用户/会话排队过多时返回False
+        """
+        user_id = getattr(incoming_message, 'sender_staff_id', None)
+        user_name = getattr(incoming_message, 'sender_nick', None)
+        conversation_id = incoming_message.conversation_id
+        key = lane_key(self.config.MESSAGE_ORDERING_SCOPE, user_id, conversation_id)
+        priority = self.priority_classes.classify(
+            getattr(incoming_message, 'conversation_type', None), conversation_id, user_id)
+        return self.admission.submit(
+            run_journaled, self.journal, entry_id, self._process_ai_response,
+            user_message, user_id, user_name, conversation_id, received_at,
+            key=key, flows=fair_flows(user_id, conversation_id),
+            weight=self.priority_classes.weight(priority), priority=priority
+        )
+    
+    async def replay_journal(self) -> int:
+        """
+        重放之前的进程未完成的消息和发送失败的群消息，不经过去重
+        :return: 重放的条目数
+        """
+        if self.journal is None:
+            return 0
+        entries = await self.journal.recover(self.config.JOURNAL_REPLAY_MAX_AGE, self.config.JOURNAL_MAX_ATTEMPTS)
+        replayed = 0
+        for entry in entries:
+            if entry.kind == KIND_INBOUND:
+                incoming_message = dingtalk_stream.ChatbotMessage.from_dict(entry.payload)
+                user_message = self._extract_user_message(incoming_message)
+                if not user_message:
+                    self.journal.complete(entry.id)
+                elif self._submit(incoming_message, user_message, time.monotonic(), entry.id):
+                    replayed += 1
+                else:
+                    # 条目保留，下次启动时再重放
+                    logger.warning(f"处理队列已满，暂不重放: id={entry.id}")
+            elif entry.kind == KIND_OUTBOUND:
+                access_token = await self.token_manager.get_token()
+                if access_token and await self.dingtalk_service.resend(access_token, entry):
+                    replayed += 1
+            else:
+                logger.warning(f"未知的日志条目，已丢弃: id={entry.id}, kind={entry.kind}")
+                self.journal.complete(entry.id)
+        if entries:
+            logger.info(f"重放上次未完成的工作: {replayed}/{len(entries)}")
+        return replayed
     
     def _extract_user_message(self, message) -> Optional[str]:
         """
@@ -79,70 +188,127 @@ class AIChatbotHandler(dingtalk_stream.ChatbotHandler):
             return None
     
     async def _process_ai_response(self, user_message: str, user_id: str, 
-                                 user_name: str, conversation_id: str):
+                                 user_name: str, conversation_id: str, received_at: float = None):
         """
         异步处理AI回复
         :param user_message: 用户消息
         :param user_id: 用户ID
         :param user_name: 用户名
         :param conversation_id: 会话ID
+        :param received_at: 收到消息的时间（time.monotonic()），用于统计回复总耗时
         """
+        received_at = received_at or time.monotonic()
+        # 长回复按页发送，每页写满后立即发送，不必等待完整回复
+        paginator = MarkdownPaginator(self.config.MAX_MESSAGE_LENGTH)
+        pages_sent = 0
+        received = False
         try:
-            # 调用AI服务获取回复
-            ai_response = await self.ai_service.get_ai_response(
-                user_message, user_id, conversation_id
-            )
+            try:
+                async for delta in self._reply_deltas(user_message, user_id, conversation_id):
+                    received = True
+                    for page in paginator.feed(delta):
+                        pages_sent += 1
+                        if not await self._send_page(page, pages_sent, user_name, conversation_id):
+                            await self._send_error_message(conversation_id, user_name)
+                            return
+            except Exception as e:
+                if not received:
+                    raise
+                # 已经收到部分回复，发送已有内容并提示中断
+                logger.error(f"AI回复中断: {e}")
+                FAILURES_TOTAL.inc(stage="webhook")
+                paginator.feed("\n\n（回复中断，请稍后再试）")
             
-            if not ai_response:
+            if not received:
                 logger.error("获取AI回复失败")
                 await self._send_error_message(conversation_id, user_name)
                 return
             
-            # 获取access_token
-            access_token = self.token_manager.get_token()
-            if not access_token:
-                logger.error("获取access_token失败")
-                await self._send_error_message(conversation_id, user_name)
-                return
-            
-            # 格式化并发送Markdown消息
-            title, content = self.dingtalk_service.format_markdown_content(
-                ai_response, user_name
-            )
+            for page in paginator.flush():
+                pages_sent += 1
+                if not await self._send_page(page, pages_sent, user_name, conversation_id):
+                    await self._send_error_message(conversation_id, user_name)
+                    return
             
-            success = self.dingtalk_service.send_markdown_message(
-                access_token, conversation_id, title, content
-            )
-            
-            if success:
-                logger.info(f"AI回复发送成功: {user_name}")
-            else:
-                logger.error(f"AI回复发送失败: {user_name}")
-                await self._send_error_message(conversation_id, user_name)
+            REPLY_SECONDS.observe(since(received_at), handler="markdown")
+            logger.info(f"AI回复发送成功: {user_name}，共{pages_sent}页")
                 
         except Exception as e:
             logger.error(f"处理AI回复异常: {e}")
             await self._send_error_message(conversation_id, user_name)
     
+    async def _reply_deltas(self, user_message: str, user_id: str, conversation_id: str) -> AsyncIterator[str]:
+        """
+        获取AI回复：开启N8N_STREAMING时边接收边返回文本增量，否则等待完整回复后一次性返回
+        两种方式同样经过回复缓存、请求合并、重试和对冲；熔断时不返回内容，由调用方回复降级提示
+        :yield: AI回复文本
+        """
+        if not self.config.N8N_STREAMING:
+            ai_response = await self.ai_service.get_ai_response(user_message, user_id, conversation_id)
+            if ai_response:
+                yield ai_response
+            return
+        try:
+            async for delta in self.ai_service.stream_ai_response(user_message, user_id, conversation_id):
+                yield delta
+        except CircuitOpenError:
+            # 与非流式调用一致，熔断时按没有回复处理
+            logger.warning("n8n webhook熔断中，快速失败")
+    
+    async def _send_page(self, page: str, page_no: int, user_name: str, conversation_id: str) -> bool:
+        """
+        发送一页AI回复
+        :param page: 分页后的Markdown内容
+        :param page_no: 页码，从1开始
+        :return: 发送是否成功
+        """
+        access_token = await self.token_manager.get_token()
+        if not access_token:
+            logger.error("获取access_token失败")
+            return False
+        
+        title, content = self.dingtalk_service.format_markdown_content(page, user_name, page=page_no)
+        if not content:
+            return True
+        success = await self.dingtalk_service.send_markdown_message(
+            access_token, conversation_id, title, content
+        )
+        if not success:
+            logger.error(f"AI回复发送失败: {user_name}，第{page_no}页")
+        return success
+    
     async def _send_error_message(self, conversation_id: str, user_name: str):
         """
         发送错误消息
         :param conversation_id: 会话ID
         :param user_name: 用户名
         """
+        FAILURES_TOTAL.inc(stage="reply")
         try:
-            access_token = self.token_manager.get_token()
+            access_token = await self.token_manager.get_token()
             if access_token:
                 error_message = f"抱歉，我暂时无法回复您的问题，请稍后再试。"
+                if self.ai_service.degraded:
+                    error_message = self.config.N8N_DEGRADED_MESSAGE
                 if user_name:
                     error_message = f"@{user_name} {error_message}"
                 
-                self.dingtalk_service.send_text_message(
-                    access_token, conversation_id, error_message
+                # 同一个群排队时，错误提示排在其他用户的回复之后
+                await self.dingtalk_service.send_text_message(
+                    access_token, conversation_id, error_message, priority=PRIORITY_NOTICE
                 )
         except Exception as e:
             logger.error(f"发送错误消息异常: {e}")
     
     async def close(self):
         """关闭资源"""
-        await self.ai_service.close() 
+        await self.admission.close()
+        await self.token_manager.close()
+        await self.ai_service.close()
+        await self.dingtalk_service.close()
+        if self.deduplicator:
+            await self.deduplicator.close()
+        if self.rate_limiter is not None:
+            await self.rate_limiter.close()
+        if self.journal is not None:
+            await self.journal.close() 
@@ -4,22 +4,34 @@
 功能：接收钉钉消息 -> 调用n8n Webhook获取AI回复 -> 发送Markdown消息到钉钉群
 """
 
-import logging
-import signal
+import os
 import sys
+import shutil
+import time
+import signal
 import asyncio
+import logging
+import tempfile
 from typing import Optional
 
 import dingtalk_stream
 
 from config import Config
 from services.ai_service import AIService
+from services.dingtalk_openapi import get_openapi_client
 from handlers.ai_card_handler import AICardHandler
+from utils.metrics import MetricsServer
+from utils.local_state import LocalStateServer
+from utils.supervisor import WORKER_ID_ENV, WorkerSupervisor
+from utils.work_journal import WorkJournal
 
 # 全局变量
 client: Optional[dingtalk_stream.DingTalkStreamClient] = None
 handler: Optional[AICardHandler] = None
 ai_service: Optional[AIService] = None
+metrics_server: Optional[MetricsServer] = None
+journal: Optional[WorkJournal] = None
+shutdown_event: Optional[asyncio.Event] = None
 
 def setup_logger():
     """设置日志配置"""
@@ -29,11 +41,13 @@ def setup_logger():
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
     
-    # 创建控制台处理器
+    # 创建控制台处理器，多进程模式下标注worker编号
+    worker_id = os.getenv(WORKER_ID_ENV)
+    prefix = f'[worker {worker_id}] ' if worker_id is not None else ''
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(
         logging.Formatter(
-            '%(asctime)s %(name)-12s %(levelname)-8s %(message)s [%(filename)s:%(lineno)d]'
+            prefix + '%(asctime)s %(name)-12s %(levelname)-8s %(message)s [%(filename)s:%(lineno)d]'
         )
     )
     
@@ -42,34 +56,89 @@ def setup_logger():
     
     return logger
 
+async def stop_stream(stream_task: asyncio.Task):
+    """断开Stream长连接，不再接收新消息"""
+    # SDK把取消当作网络异常，等待后重连，需要再次取消才会退出
+    while not stream_task.done():
+        stream_task.cancel()
+        await asyncio.wait([stream_task], timeout=0.1)
+
 async def shutdown():
+    """关闭处理器和HTTP会话，应在处理中的消息完成后调用"""
     global ai_service
+    if handler:
+        await handler.close()
+        logging.getLogger(__name__).info("AI处理器已关闭")
     if ai_service:
         await ai_service.close()
         logging.getLogger(__name__).info("AIService已关闭")
+    await get_openapi_client().close()
+    if journal:
+        await journal.close()
 
-def signal_handler(signum, frame):
-    """信号处理器，用于优雅关闭"""
+def signal_handler(signum):
+    """信号处理器：第一次收到时开始优雅关闭，再次收到时不再等待处理中的消息"""
     logger = logging.getLogger(__name__)
-    logger.info(f"收到信号 {signum}，开始优雅关闭...")
-    
-    if client:
-        logger.info("关闭钉钉流式客户端...")
-        client.stop()
+    if not shutdown_event.is_set():
+        logger.info(f"收到信号 {signum}，开始优雅关闭...")
+        shutdown_event.set()
+    elif handler:
+        logger.warning(f"再次收到信号 {signum}，不再等待处理中的消息")
+        handler.abort_drain()
+
+async def warm_up():
+    """预热：建立到n8n和钉钉OpenAPI的长连接、获取token、检查卡片模板，失败只记录警告，不影响启动"""
+    logger = logging.getLogger(__name__)
+    warm_up_started = time.monotonic()
+    try:
+        results = await asyncio.wait_for(asyncio.gather(ai_service.warm_up(), handler.warm_up()),
+                                         Config.STARTUP_WARMUP_TIMEOUT)
+        ok = all(results)
+    except asyncio.TimeoutError:
+        ok = False
+        logger.warning(f"预热超过{Config.STARTUP_WARMUP_TIMEOUT}秒，跳过剩余项目")
+    logger.info(f"预热完成，耗时{time.monotonic() - warm_up_started:.2f}秒" + ("" if ok else "，部分项目失败"))
+
+async def replay_journal():
+    """重放上次崩溃或强制结束时未完成的消息，失败只记录错误"""
+    try:
+        await handler.replay_journal()
+    except Exception as e:
+        logging.getLogger(__name__).error(f"重放工作日志失败: {e}")
+
+async def serve():
+    """
+    （可选）预热后运行Stream客户端，直到收到SIGINT/SIGTERM，然后依次：
+    断开Stream连接（钉钉把新消息投递给其他连接）、等待处理中的消息完成、关闭HTTP会话
+    """
+    global shutdown_event
+    logger = logging.getLogger(__name__)
+    shutdown_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, signal_handler, signum)
+        except NotImplementedError:
+            # Windows的事件循环不支持add_signal_handler
+            signal.signal(signum, lambda s, frame: loop.call_soon_threadsafe(signal_handler, s))
     
-    if handler:
-        logger.info("关闭AI处理器...")
-        asyncio.create_task(handler.close())
+    if Config.STARTUP_WARMUP:
+        await warm_up()
     
-    # 新增：关闭AIService
-    loop = asyncio.get_event_loop()
-    if loop.is_running():
-        loop.create_task(shutdown())
-    else:
-        loop.run_until_complete(shutdown())
+    logger.info("钉钉AI机器人启动成功，开始监听消息...")
+    logger.info(f"机器人名称: {Config.BOT_NAME}")
+    logger.info(f"n8n Webhook: {Config.N8N_WEBHOOK_URL}")
+    stream_task = asyncio.create_task(client.start())
+    replay_task = asyncio.create_task(replay_journal())
+    await shutdown_event.wait()
     
-    logger.info("程序已关闭")
-    sys.exit(0)
+    logger.info("断开钉钉Stream连接...")
+    replay_task.cancel()
+    await stop_stream(stream_task)
+    drained = await handler.drain(Config.SHUTDOWN_DRAIN_TIMEOUT)
+    if drained:
+        logger.info("处理中的消息已全部完成")
+    await shutdown()
 
 def validate_config():
     """验证配置"""
@@ -88,9 +157,63 @@ def validate_config():
         print("\n您可以在 .env 文件中设置这些变量，或者直接在环境变量中设置。")
         return False
 
+def stream_health():
+    """Stream长连接状态，用于健康检查"""
+    websocket = client.websocket if client else None
+    if websocket is None or not websocket.open:
+        return False, "未连接"
+    return True, "已连接"
+
+def start_metrics_server():
+    """启动指标与健康检查HTTP服务"""
+    global metrics_server
+    if Config.METRICS_PORT <= 0:
+        return
+    # 多进程模式下各worker使用不同的端口
+    port = Config.METRICS_PORT + int(os.getenv(WORKER_ID_ENV, '0'))
+    metrics_server = MetricsServer(Config.METRICS_HOST, port)
+    metrics_server.add_health_check("stream", stream_health)
+    metrics_server.add_health_check("token", handler.token_manager.health)
+    metrics_server.start()
+
+def journal_path() -> str:
+    """多进程模式下每个worker使用自己的日志文件，重启后的worker重放同编号的worker留下的条目"""
+    worker_id = os.getenv(WORKER_ID_ENV)
+    if worker_id is None:
+        return Config.JOURNAL_PATH
+    root, ext = os.path.splitext(Config.JOURNAL_PATH)
+    return f"{root}.worker{worker_id}{ext}"
+
+def run_supervisor():
+    """
+    多进程模式：启动共享状态服务和worker进程，阻塞直到关闭
+    :return: 退出码
+    """
+    logger = logging.getLogger(__name__)
+    runtime_dir = tempfile.mkdtemp(prefix='dingtalk-bot-')
+    state_server = LocalStateServer(os.path.join(runtime_dir, 'state.sock'))
+    state_server.start()
+    env = {'LOCAL_STATE_SOCKET': state_server.path}
+    if not Config.TOKEN_CACHE_FILE:
+        env['TOKEN_CACHE_FILE'] = os.path.join(runtime_dir, 'token.json')
+    supervisor = WorkerSupervisor(
+        [sys.executable, os.path.abspath(__file__)],
+        Config.WORKER_PROCESSES,
+        env=env,
+        restart_delay=Config.WORKER_RESTART_DELAY,
+        shutdown_timeout=Config.WORKER_SHUTDOWN_TIMEOUT,
+    )
+    logger.info(f"多进程模式，启动{Config.WORKER_PROCESSES}个worker...")
+    try:
+        return supervisor.run()
+    finally:
+        state_server.stop()
+        shutil.rmtree(runtime_dir, ignore_errors=True)
+        logger.info("程序已关闭")
+
 def main():
     """主函数"""
-    global client, handler, ai_service
+    global client, handler, ai_service, journal
     
     # 设置日志
     logger = setup_logger()
@@ -100,6 +223,9 @@ def main():
     if not validate_config():
         sys.exit(1)
     
+    if Config.WORKER_PROCESSES > 1 and os.getenv(WORKER_ID_ENV) is None:
+        sys.exit(run_supervisor())
+    
     try:
         # 创建钉钉流式客户端
         credential = dingtalk_stream.Credential(Config.CLIENT_ID, Config.CLIENT_SECRET)
@@ -107,8 +233,11 @@ def main():
         
         # 创建AI服务
         ai_service = AIService(Config.N8N_WEBHOOK_URL, Config.N8N_API_KEY)
-        # 创建AI卡片处理器
-        handler = AICardHandler(ai_service)
+        # 创建工作日志和AI卡片处理器
+        if Config.JOURNAL_PATH:
+            journal = WorkJournal(journal_path())
+            journal.open()
+        handler = AICardHandler(ai_service, journal=journal)
         
         # 注册消息处理器
         client.register_callback_handler(
@@ -116,23 +245,20 @@ def main():
             handler
         )
         
-        # 设置信号处理器
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
-        
-        logger.info("钉钉AI机器人启动成功，开始监听消息...")
-        logger.info(f"机器人名称: {Config.BOT_NAME}")
-        logger.info(f"n8n Webhook: {Config.N8N_WEBHOOK_URL}")
+        start_metrics_server()
         
-        # 启动客户端
-        client.start_forever()
+        # 预热后启动客户端，收到退出信号后优雅关闭
+        asyncio.run(serve())
+        logger.info("程序已关闭")
         
     except KeyboardInterrupt:
         logger.info("收到键盘中断信号")
-        signal_handler(signal.SIGINT, None)
     except Exception as e:
         logger.error(f"程序运行异常: {e}")
         sys.exit(1)
+    finally:
+        if metrics_server:
+            metrics_server.stop()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -1,40 +1,146 @@
-import json
+import time
+import codecs
 import logging
 import aiohttp
 import asyncio
-from typing import Optional, Dict, Any
-import re
+from urllib.parse import urljoin
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator, Union
 from config import Config
+from services.conversation_memory import (
+    HistoryStore, PromptBuilder, Turn, create_history_store, history_key
+)
+from services.request_coalescer import RequestCoalescer
+from services.response_cache import ResponseCache, create_response_cache, response_key
+from services.webhook_pool import WebhookEndpoint, WebhookPool
+from utils.markdown_segmenter import MarkdownSegmenter
+from utils.metrics import CACHE_HITS_TOTAL, FAILURES_TOTAL, TIMEOUTS_TOTAL, WEBHOOK_SECONDS
+from utils import fast_json
+from utils.resilience import CircuitBreaker, CircuitOpenError, HedgePolicy, RetryPolicy, parse_statuses
+from utils.response_extractor import ResponseExtractor
+from utils.stream_decoder import (
+    SSEDecoder, NDJSONDecoder, extract_stream_text, is_n8n_stream_object
+)
 
 logger = logging.getLogger(__name__)
 
 class AIService:
     """AI服务类，负责调用n8n webhook获取AI回复"""
     
-    def __init__(self, webhook_url: str, api_key: str = None):
-        self.webhook_url = webhook_url
+    def __init__(self, webhook_url: Union[str, List[str]], api_key: str = None,
+                 history_store: HistoryStore = None, prompt_builder: PromptBuilder = None,
+                 response_cache: ResponseCache = None, coalescer: RequestCoalescer = None):
+        """
+        :param webhook_url: n8n webhook地址，多个地址（列表或逗号分隔）时按负载均衡策略分发
+        :param history_store: 对话历史存储，为空时按配置创建（未启用则不携带历史）
+        :param prompt_builder: 拼接历史prompt的构建器，为空时按配置创建
+        :param response_cache: 重复问题的回复缓存，为空时按配置创建（未启用则不缓存）
+        :param coalescer: 相同问题的进行中请求合并器，为空时按配置创建（未启用则不合并）
+        """
+        self.pool = WebhookPool(
+            webhook_url,
+            strategy=Config.N8N_LOAD_BALANCING,
+            failure_threshold=Config.N8N_ENDPOINT_FAILURE_THRESHOLD,
+            eject_seconds=Config.N8N_ENDPOINT_EJECT_SECONDS,
+            health_check_interval=Config.N8N_HEALTH_CHECK_INTERVAL,
+            health_check_path=Config.N8N_HEALTH_CHECK_PATH,
+        )
+        self.webhook_url = self.pool.primary_url
         self.api_key = api_key
         self.session = None
+        self.history_store = history_store if history_store is not None else create_history_store(Config)
+        self.prompt_builder = prompt_builder or PromptBuilder(Config.CONVERSATION_PROMPT_MAX_LENGTH)
+        self.response_cache = response_cache if response_cache is not None else create_response_cache(Config, self.webhook_url)
+        if coalescer is None and Config.REQUEST_COALESCING_ENABLED:
+            coalescer = RequestCoalescer()
+        self.coalescer = coalescer
+        self.retry_policy = RetryPolicy(
+            max_attempts=Config.N8N_RETRY_MAX_ATTEMPTS,
+            base_delay=Config.N8N_RETRY_BASE_DELAY,
+            max_delay=Config.N8N_RETRY_MAX_DELAY,
+            retry_statuses=parse_statuses(Config.N8N_RETRY_STATUSES),
+        )
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=Config.N8N_CIRCUIT_FAILURE_THRESHOLD,
+            recovery_timeout=Config.N8N_CIRCUIT_RECOVERY_TIMEOUT,
+            name="n8n",
+        )
+        self.hedge_policy = HedgePolicy(
+            percentile=Config.N8N_HEDGE_PERCENTILE,
+            budget=Config.N8N_HEDGE_BUDGET,
+            min_samples=Config.N8N_HEDGE_MIN_SAMPLES,
+        ) if Config.N8N_HEDGING_ENABLED else None
+        # 流式调用只对冲等待响应头的阶段，延迟分布与完整请求不同，单独统计
+        self.stream_hedge_policy = HedgePolicy(
+            percentile=Config.N8N_HEDGE_PERCENTILE,
+            budget=Config.N8N_HEDGE_BUDGET,
+            min_samples=Config.N8N_HEDGE_MIN_SAMPLES,
+        ) if Config.N8N_HEDGING_ENABLED else None
+        # 回复字段路径在启动时编译一次
+        self.response_extractor = ResponseExtractor(Config.N8N_RESPONSE_PATHS)
+    
+    @property
+    def degraded(self) -> bool:
+        """n8n webhook是否处于熔断状态"""
+        return self.circuit_breaker.is_open
     
     async def _get_session(self) -> aiohttp.ClientSession:
         """获取或创建HTTP会话"""
         if self.session is None or self.session.closed:
             timeout = aiohttp.ClientTimeout(total=30)
-            self.session = aiohttp.ClientSession(timeout=timeout)
+            self.session = aiohttp.ClientSession(timeout=timeout, json_serialize=fast_json.dumps)
+        self.pool.start_health_checks(self.session)
         return self.session
     
-    async def get_ai_response(self, user_message: str, user_id: str = None, 
-                            conversation_id: str = None) -> Optional[str]:
+    async def _load_history(self, user_id: str = None, conversation_id: str = None) -> List[Turn]:
+        """读取会话历史，未启用或读取失败时返回空列表"""
+        key = history_key(Config.CONVERSATION_MEMORY_SCOPE, user_id, conversation_id)
+        if self.history_store is None or not key:
+            return []
+        try:
+            return await self.history_store.get_history(key)
+        except Exception as e:
+            logger.error(f"读取对话历史异常: {e}")
+            return []
+    
+    async def _save_turn(self, user_message: str, ai_response: str,
+                         user_id: str = None, conversation_id: str = None):
+        """保存本轮问答到会话历史"""
+        key = history_key(Config.CONVERSATION_MEMORY_SCOPE, user_id, conversation_id)
+        if self.history_store is None or not key or not ai_response:
+            return
+        try:
+            await self.history_store.append_turn(key, user_message, ai_response)
+        except Exception as e:
+            logger.error(f"保存对话历史异常: {e}")
+    
+    def _cache_key(self, user_message: str, user_id: str = None, conversation_id: str = None,
+                   history: List[Turn] = None) -> Optional[str]:
         """
-        调用n8n webhook获取AI回复
-        :param user_message: 用户消息内容
-        :param user_id: 用户ID
-        :param conversation_id: 会话ID
-        :return: AI回复内容，失败返回None
+        计算回复缓存的key
+        带有对话历史时回答依赖上下文，不使用缓存
+        """
+        if self.response_cache is None or history:
+            return None
+        return self.response_cache.make_key(user_message, user_id, conversation_id)
+    
+    def _coalesce_key(self, user_message: str, user_id: str = None, conversation_id: str = None,
+                      history: List[Turn] = None) -> Optional[str]:
+        """
+        计算进行中请求合并的key
+        带有对话历史时请求内容各不相同，不合并
+        """
+        if self.coalescer is None or history:
+            return None
+        return response_key(Config.REQUEST_COALESCING_SCOPE, user_message, user_id, conversation_id)
+    
+    def _build_request(self, user_message: str, user_id: str = None,
+                       conversation_id: str = None,
+                       history: List[Turn] = None) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """
+        构建webhook请求数据和请求头
+        启用对话历史时额外携带history（长度预算内的最近轮次）和拼接好的prompt
+        :return: (payload, headers) 元组
         """
-        session = await self._get_session()
-        
-        # 构建请求数据
         payload = {
             "message": user_message,
             "user_id": user_id,
@@ -42,6 +148,11 @@ class AIService:
             "timestamp": asyncio.get_event_loop().time()
         }
         
+        if self.history_store is not None:
+            turns = self.prompt_builder.select_turns(history or [], user_message)
+            payload["history"] = turns
+            payload["prompt"] = self.prompt_builder.build(turns, user_message)
+        
         headers = {
             "Content-Type": "application/json"
         }
@@ -50,120 +161,622 @@ class AIService:
         if self.api_key:
             headers["Authorization"] = f"Bearer {self.api_key}"
         
+        return payload, headers
+    
+    async def get_ai_response(self, user_message: str, user_id: str = None, 
+                            conversation_id: str = None) -> Optional[str]:
+        """
+        调用n8n webhook获取AI回复
+        :param user_message: 用户消息内容
+        :param user_id: 用户ID
+        :param conversation_id: 会话ID
+        :return: AI回复内容，失败返回None
+        """
+        # 构建请求数据
+        history = await self._load_history(user_id, conversation_id)
+        cache_key = self._cache_key(user_message, user_id, conversation_id, history)
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                logger.info(f"命中回复缓存: {self.response_cache.stats()}")
+                CACHE_HITS_TOTAL.inc()
+                await self._save_turn(user_message, cached, user_id, conversation_id)
+                return cached
+        payload, headers = self._build_request(user_message, user_id, conversation_id, history)
+        
+        flight_key = self._coalesce_key(user_message, user_id, conversation_id, history)
+        if flight_key:
+            ai_response = await self.coalescer.call(flight_key, lambda: self._post_webhook(payload, headers))
+        else:
+            ai_response = await self._post_webhook(payload, headers)
+        
+        if cache_key and ai_response:
+            self.response_cache.set(cache_key, ai_response)
+        await self._save_turn(user_message, ai_response, user_id, conversation_id)
+        return ai_response
+    
+    async def _post_webhook(self, payload: Dict[str, Any], headers: Dict[str, str]) -> Optional[str]:
+        """
+        发送webhook请求并解析完整响应，失败返回None
+        网络错误和可重试的状态码按退避策略重试，所有尝试共用N8N_WEBHOOK_TIMEOUT的总时长；
+        熔断器打开时直接失败，不再等待超时
+        """
+        session = await self._get_session()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + Config.N8N_WEBHOOK_TIMEOUT
+        tried = []
+        
+        for attempt in range(self.retry_policy.max_attempts):
+            if not self.circuit_breaker.allow():
+                logger.warning("n8n webhook熔断中，快速失败")
+                FAILURES_TOTAL.inc(stage="circuit_open")
+                return None
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            
+            # 重试时优先换一个地址
+            endpoint = self.pool.pick(exclude=tried)
+            tried.append(endpoint)
+            try:
+                status, ai_response = await self._post_webhook_hedged(
+                    session, endpoint, tried, payload, headers, remaining
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"网络请求异常: {e!r}（第{attempt + 1}次尝试）")
+                if isinstance(e, asyncio.TimeoutError):
+                    TIMEOUTS_TOTAL.inc(stage="webhook")
+                self.circuit_breaker.record_failure()
+            except Exception as e:
+                # 非网络类的意外错误，不能说明地址健康与否，不计入熔断
+                logger.error(f"获取AI回复异常: {e}")
+                FAILURES_TOTAL.inc(stage="webhook")
+                return None
+            else:
+                if status == 200:
+                    self.circuit_breaker.record_success()
+                    return ai_response
+                if not self.retry_policy.is_retryable(status):
+                    # 非过载类错误（如配置错误）不重试，也不计入熔断
+                    FAILURES_TOTAL.inc(stage="webhook")
+                    self.circuit_breaker.record_success()
+                    return None
+                self.circuit_breaker.record_failure()
+            
+            delay = self.retry_policy.delay(attempt)
+            if attempt + 1 >= self.retry_policy.max_attempts or loop.time() + delay >= deadline:
+                break
+            await asyncio.sleep(delay)
+        
+        logger.error("n8n webhook调用失败，已放弃重试")
+        FAILURES_TOTAL.inc(stage="webhook")
+        return None
+    
+    async def _post_webhook_hedged(self, session: aiohttp.ClientSession, endpoint: WebhookEndpoint,
+                                   tried: List[WebhookEndpoint], payload: Dict[str, Any],
+                                   headers: Dict[str, str], timeout: float) -> Tuple[int, Optional[str]]:
+        """
+        发送一次webhook请求，开启对冲时超过最近延迟的百分位仍未返回则再发一个请求
+        优先发往另一个地址，先成功的结果生效，另一个请求被取消
+        :param tried: 本次调用已用过的地址，对冲请求使用的地址也会加入
+        :return: (HTTP状态码, 解析后的AI回复) 元组
+        """
+        primary = asyncio.ensure_future(self._post_webhook_once(session, endpoint, payload, headers, timeout))
+        if self.hedge_policy is None:
+            return await primary
+        self.hedge_policy.record_request()
+        hedge_delay = self.hedge_policy.delay()
+        if hedge_delay is None or hedge_delay >= timeout:
+            return await primary
+        
+        tasks = [primary]
+        # 被外部取消时所有请求都要取消
+        winner = None
         try:
-            logger.info(f"调用n8n webhook: {self.webhook_url}")
-            logger.debug(f"请求数据: {payload}")
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if done or not self.hedge_policy.try_acquire():
+                winner = primary
+                return await primary
+            
+            hedge_endpoint = self.pool.pick(exclude=tried)
+            tried.append(hedge_endpoint)
+            logger.info(f"n8n webhook超过{hedge_delay:.2f}秒未返回，发起对冲请求: {hedge_endpoint.url}")
+            tasks.append(asyncio.ensure_future(
+                self._post_webhook_once(session, hedge_endpoint, payload, headers, timeout - hedge_delay)
+            ))
             
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result()[0] == 200:
+                        winner = task
+                        return task.result()
+                if not pending:
+                    # 两个请求都没有成功，返回后完成的那个结果（异常会原样抛出）
+                    winner = done.pop()
+                    return winner.result()
+        finally:
+            # 取消落败或未完成的请求，并等待它们结束，取走已失败请求的异常
+            losers = [task for task in tasks if task is not winner]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+    
+    async def _post_webhook_once(self, session: aiohttp.ClientSession, endpoint: WebhookEndpoint,
+                                 payload: Dict[str, Any], headers: Dict[str, str],
+                                 timeout: float) -> Tuple[int, Optional[str]]:
+        """
+        向一个地址发送一次webhook请求
+        :param endpoint: 地址池中选出的地址
+        :param timeout: 本次请求的超时时间（秒）
+        :return: (HTTP状态码, 解析后的AI回复) 元组
+        """
+        logger.info(f"调用n8n webhook: {endpoint.url}")
+        logger.debug(f"请求数据: {payload}")
+        
+        started = self.pool.begin(endpoint)
+        healthy = False
+        try:
             async with session.post(
-                self.webhook_url,
+                endpoint.url,
                 json=payload,
-                headers=headers
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout)
             ) as response:
-                
                 if response.status == 200:
-                    response_data = await response.json()
+                    # 不校验Content-Type，避免响应头不规范时被当作网络错误重试；
+                    # 边读边提取回复字段，提取完成后不再读取n8n附带的其他数据
+                    ai_response = await self.response_extractor.read(response)
+                    healthy = True
+                    if self.hedge_policy is not None:
+                        self.hedge_policy.observe(time.monotonic() - started)
                     logger.info("n8n webhook调用成功")
-                    logger.info(f"收到的原始响应数据: {response_data}")
-                    
-                    # 解析响应数据，根据n8n的实际返回格式调整
-                    ai_response = self._parse_ai_response(response_data)
-                    return ai_response
+                    if ai_response is None:
+                        logger.warning(f"n8n响应中没有找到回复字段，请检查N8N_RESPONSE_PATHS: {Config.N8N_RESPONSE_PATHS}")
+                    return response.status, ai_response
                 else:
+                    # 只有过载类状态码计为该地址失败
+                    healthy = not self.retry_policy.is_retryable(response.status)
                     error_text = await response.text()
                     logger.error(f"n8n webhook调用失败: HTTP {response.status}, {error_text}")
-                    return None
-                    
-        except aiohttp.ClientError as e:
-            logger.error(f"网络请求异常: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"获取AI回复异常: {e}")
-            return None
+                    return response.status, None
+        except asyncio.CancelledError:
+            # 对冲中落败被取消，不计入该地址的失败
+            healthy = None
+            raise
+        finally:
+            self.pool.end(endpoint, started, healthy)
+            if healthy is not None:
+                WEBHOOK_SECONDS.observe(time.monotonic() - started, mode="request")
     
-    def _parse_ai_response(self, response_data: Dict[str, Any]) -> Optional[str]:
+    def _parse_ai_response(self, response_data: Any) -> Optional[str]:
         """
-        解析n8n返回的AI回复数据
-        根据实际的n8n webhook返回格式调整此方法
+        从已解析的n8n响应中提取AI回复
+        按N8N_RESPONSE_PATHS配置的字段路径依次查找，响应为列表时在第一个元素上查找
         """
+        ai_response = self.response_extractor.extract(response_data)
+        if ai_response is None:
+            fields = list(response_data)[:20] if isinstance(response_data, dict) else type(response_data).__name__
+            logger.warning(f"无法解析AI响应格式，请检查N8N_RESPONSE_PATHS: {fields}")
+        return ai_response
+    
+    async def warm_up(self) -> bool:
+        """
+        预热：解析各n8n实例的域名并建立长连接，首条消息不再承担DNS解析和TCP/TLS握手的耗时
+        访问的是健康检查地址，不会触发工作流
+        :return: 所有实例都能连接时返回True，不要求健康检查返回200
+        """
+        session = await self._get_session()
+        results = await asyncio.gather(*(self._warm_up_endpoint(session, endpoint)
+                                         for endpoint in self.pool.endpoints))
+        return all(results)
+    
+    async def _warm_up_endpoint(self, session: aiohttp.ClientSession, endpoint: WebhookEndpoint) -> bool:
+        url = urljoin(endpoint.url, self.pool.health_check_path)
         try:
-            data_to_parse = response_data
-            # n8n webhook 经常返回包含单个元素的列表
-            if isinstance(response_data, list) and response_data:
-                data_to_parse = response_data[0]
-
-            # 常见的响应格式示例，请根据实际情况调整
-            if isinstance(data_to_parse, dict):
-                # 格式1: {"response": "AI回复内容"}
-                if "response" in data_to_parse:
-                    return data_to_parse["response"]
-                
-                # 格式2: {"data": {"reply": "AI回复内容"}}
-                elif "data" in data_to_parse and isinstance(data_to_parse["data"], dict):
-                    if "reply" in data_to_parse["data"]:
-                        return data_to_parse["data"]["reply"]
-                
-                # 格式3: {"message": "AI回复内容"}
-                elif "message" in data_to_parse:
-                    return data_to_parse["message"]
-                
-                # 格式4: n8n Respond to Webhook 节点的常见格式 {"output": "AI回复内容"}
-                elif "output" in data_to_parse:
-                    return data_to_parse["output"]
-
-                # 格式5: 直接返回字符串内容
-                elif "content" in data_to_parse:
-                    return data_to_parse["content"]
-            
-            # 如果响应是字符串，直接返回
-            elif isinstance(data_to_parse, str):
-                return data_to_parse
-            
-            logger.warning(f"无法解析AI响应格式: {response_data}")
-            return None
-            
-        except Exception as e:
-            logger.error(f"解析AI响应异常: {e}")
-            return None
+            async with session.get(url) as response:
+                await response.read()
+            logger.info(f"已连接n8n实例: {url}, HTTP {response.status}")
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"n8n实例预热失败: {url}, {e!r}")
+            return False
     
     async def close(self):
         """关闭HTTP会话"""
         if self.session and not self.session.closed:
             await self.session.close()
             logger.info("AI服务HTTP会话已关闭")
+        if self.history_store is not None:
+            await self.history_store.close()
+        await self.pool.close()
+
+    async def stream_ai_response(self, user_message: str, user_id: str = None,
+                                 conversation_id: str = None) -> AsyncIterator[str]:
+        """
+        流式调用n8n webhook，边接收边返回AI回复的文本增量
+        支持SSE、NDJSON（包括n8n流式响应）和分块纯文本；普通JSON响应读取完整后解析，一次性返回
+        :param user_message: 用户消息内容
+        :param user_id: 用户ID
+        :param conversation_id: 会话ID
+        :yield: AI回复文本增量
+        """
+        history = await self._load_history(user_id, conversation_id)
+        cache_key = self._cache_key(user_message, user_id, conversation_id, history)
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                logger.info(f"命中回复缓存: {self.response_cache.stats()}")
+                CACHE_HITS_TOTAL.inc()
+                yield cached
+                await self._save_turn(user_message, cached, user_id, conversation_id)
+                return
+        payload, headers = self._build_request(user_message, user_id, conversation_id, history)
+        
+        flight_key = self._coalesce_key(user_message, user_id, conversation_id, history)
+        if flight_key:
+            stream = self.coalescer.stream(flight_key, lambda: self._stream_webhook(payload, headers))
+        else:
+            stream = self._stream_webhook(payload, headers)
+        
+        parts = []
+        async for delta in stream:
+            parts.append(delta)
+            yield delta
+        
+        ai_response = "".join(parts)
+        if cache_key and ai_response:
+            self.response_cache.set(cache_key, ai_response)
+        await self._save_turn(user_message, ai_response, user_id, conversation_id)
+    
+    async def _stream_webhook(self, payload: Dict[str, Any], headers: Dict[str, str]) -> AsyncIterator[str]:
+        """
+        发送webhook请求并按响应类型增量解析
+        输出第一段内容之前失败（网络错误、超时、可重试的状态码）时按退避策略重试，优先换一个地址，
+        等待响应头的时间计入所有尝试共用的N8N_WEBHOOK_TIMEOUT总时长；已经输出内容后失败直接抛出，
+        避免重复输出。熔断器打开时抛出CircuitOpenError
+        """
+        session = await self._get_session()
+        headers["Accept"] = "text/event-stream, application/x-ndjson, application/json, text/plain"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + Config.N8N_WEBHOOK_TIMEOUT
+        tried = []
+        error = None
+        
+        for attempt in range(self.retry_policy.max_attempts):
+            if not self.circuit_breaker.allow():
+                FAILURES_TOTAL.inc(stage="circuit_open")
+                raise CircuitOpenError("n8n webhook熔断中")
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            
+            # 重试时优先换一个地址
+            endpoint = self.pool.pick(exclude=tried)
+            tried.append(endpoint)
+            yielded = False
+            try:
+                endpoint, started, response = await self._open_stream_hedged(
+                    session, endpoint, tried, payload, headers, remaining
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"网络请求异常: {e!r}（第{attempt + 1}次尝试）")
+                if isinstance(e, asyncio.TimeoutError):
+                    TIMEOUTS_TOTAL.inc(stage="webhook")
+                self.circuit_breaker.record_failure()
+                error = e
+            else:
+                healthy = False
+                try:
+                    async with response:
+                        if response.status != 200:
+                            error_text = await response.text()
+                            logger.error(f"n8n webhook调用失败: HTTP {response.status}, {error_text}")
+                            if not self.retry_policy.is_retryable(response.status):
+                                # 非过载类错误（如配置错误）不重试，也不计入熔断
+                                healthy = True
+                                self.circuit_breaker.record_success()
+                                FAILURES_TOTAL.inc(stage="webhook")
+                                return
+                            self.circuit_breaker.record_failure()
+                            error = None
+                        else:
+                            self.circuit_breaker.record_success()
+                            async for delta in self._decode_stream(response):
+                                yielded = True
+                                yield delta
+                            healthy = True
+                            return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if yielded:
+                        raise
+                    # 还没有输出内容，可以重试
+                    logger.error(f"读取流式响应异常: {e!r}（第{attempt + 1}次尝试）")
+                    if isinstance(e, asyncio.TimeoutError):
+                        TIMEOUTS_TOTAL.inc(stage="webhook")
+                    self.circuit_breaker.record_failure()
+                    error = e
+                finally:
+                    self.pool.end(endpoint, started, healthy)
+                    WEBHOOK_SECONDS.observe(time.monotonic() - started, mode="stream")
+            
+            delay = self.retry_policy.delay(attempt)
+            if attempt + 1 >= self.retry_policy.max_attempts or loop.time() + delay >= deadline:
+                break
+            await asyncio.sleep(delay)
+        
+        logger.error("n8n webhook调用失败，已放弃重试")
+        if error is not None:
+            raise error
+        FAILURES_TOTAL.inc(stage="webhook")
+    
+    async def _open_stream_hedged(self, session: aiohttp.ClientSession, endpoint: WebhookEndpoint,
+                                  tried: List[WebhookEndpoint], payload: Dict[str, Any], headers: Dict[str, str],
+                                  timeout: float) -> Tuple[WebhookEndpoint, float, aiohttp.ClientResponse]:
+        """
+        发起流式请求，开启对冲时超过最近响应头延迟的百分位仍未收到响应头则再发一个请求
+        优先发往另一个地址，先返回200的请求生效，另一个请求被取消或关闭；只对冲输出内容之前的阶段
+        :param tried: 本次调用已用过的地址，对冲请求使用的地址也会加入
+        :return: 同_open_stream
+        """
+        primary = asyncio.ensure_future(self._open_stream(session, endpoint, payload, headers, timeout))
+        policy = self.stream_hedge_policy
+        if policy is None:
+            return await primary
+        policy.record_request()
+        hedge_delay = policy.delay()
+        if hedge_delay is None or hedge_delay >= timeout:
+            return await primary
+        
+        tasks = [primary]
+        # 被外部取消时所有请求都要取消
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if done or not policy.try_acquire():
+                winner = primary
+                return await primary
+            
+            hedge_endpoint = self.pool.pick(exclude=tried)
+            tried.append(hedge_endpoint)
+            logger.info(f"n8n webhook超过{hedge_delay:.2f}秒未返回响应头，发起对冲请求: {hedge_endpoint.url}")
+            tasks.append(asyncio.ensure_future(
+                self._open_stream(session, hedge_endpoint, payload, headers, timeout - hedge_delay)
+            ))
+            
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result()[2].status == 200:
+                        winner = task
+                        return task.result()
+                if not pending:
+                    # 两个请求都没有成功，返回后完成的那个结果（异常会原样抛出）
+                    winner = done.pop()
+                    return winner.result()
+        finally:
+            # 取消未完成的请求并等待它们结束（取走已失败请求的异常），关闭落败请求已收到的响应
+            losers = [task for task in tasks if task is not winner]
+            for task in losers:
+                task.cancel()
+            for result in await asyncio.gather(*losers, return_exceptions=True):
+                if not isinstance(result, BaseException):
+                    loser_endpoint, started, response = result
+                    response.release()
+                    self.pool.end(loser_endpoint, started, None)
+    
+    async def _open_stream(self, session: aiohttp.ClientSession, endpoint: WebhookEndpoint,
+                           payload: Dict[str, Any], headers: Dict[str, str],
+                           timeout: float) -> Tuple[WebhookEndpoint, float, aiohttp.ClientResponse]:
+        """
+        向一个地址发起流式请求，收到响应头后返回，由调用方读取响应体并调用pool.end
+        :param timeout: 等待响应头的最长时间（秒）；之后读取不限制总时长，只限制两次数据到达之间的间隔
+        :return: (地址, pool.begin的返回值, 响应) 元组
+        """
+        logger.info(f"流式调用n8n webhook: {endpoint.url}")
+        logger.debug(f"请求数据: {payload}")
+        started = self.pool.begin(endpoint)
+        try:
+            response = await asyncio.wait_for(session.post(
+                endpoint.url,
+                json=payload,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=Config.N8N_WEBHOOK_TIMEOUT)
+            ), timeout)
+        except asyncio.CancelledError:
+            # 对冲中落败被取消，不计入该地址的失败
+            self.pool.end(endpoint, started, None)
+            raise
+        except BaseException:
+            self.pool.end(endpoint, started, False)
+            WEBHOOK_SECONDS.observe(time.monotonic() - started, mode="stream")
+            raise
+        if response.status == 200 and self.stream_hedge_policy is not None:
+            self.stream_hedge_policy.observe(time.monotonic() - started)
+        return endpoint, started, response
+    
+    async def _decode_stream(self, response: aiohttp.ClientResponse) -> AsyncIterator[str]:
+        """按响应类型增量解析webhook响应"""
+        mode = self._detect_stream_mode(response.content_type)
+        logger.info(f"n8n webhook响应类型: {response.content_type}, 读取模式: {mode or 'sniff'}")
+        text_decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="replace")
+        sse_decoder = SSEDecoder()
+        ndjson_decoder = NDJSONDecoder()
+        body = ""
+        
+        async for chunk in response.content.iter_any():
+            text = text_decoder.decode(chunk)
+            if not text:
+                continue
+            
+            # Content-Type为application/json时，n8n流式响应也可能是逐行JSON，根据首行判断
+            if mode is None:
+                body += text
+                if "\n" not in body:
+                    continue
+                mode = "ndjson" if self._is_n8n_stream_line(body.split("\n", 1)[0]) else "json"
+                if mode == "json":
+                    continue
+                text, body = body, ""
+            
+            if mode == "json":
+                body += text
+            elif mode == "sse":
+                for data in sse_decoder.feed(text):
+                    delta = self._parse_stream_data(data)
+                    if delta:
+                        yield delta
+            elif mode == "ndjson":
+                for obj in ndjson_decoder.feed(text):
+                    delta = extract_stream_text(obj)
+                    if delta:
+                        yield delta
+            else:
+                yield text
+        
+        tail = text_decoder.decode(b"", final=True)
+        if mode == "sse":
+            for data in sse_decoder.feed(tail) + sse_decoder.flush():
+                delta = self._parse_stream_data(data)
+                if delta:
+                    yield delta
+        elif mode == "ndjson":
+            for obj in ndjson_decoder.feed(tail) + ndjson_decoder.flush():
+                delta = extract_stream_text(obj)
+                if delta:
+                    yield delta
+        elif mode == "text":
+            if tail:
+                yield tail
+        else:
+            # 非流式响应，整体解析
+            ai_response = self._parse_complete_body(body + tail)
+            if ai_response:
+                yield ai_response
+    
+    @staticmethod
+    def _detect_stream_mode(content_type: str) -> Optional[str]:
+        """
+        根据Content-Type判断响应读取模式
+        :return: sse/ndjson/text，无法判断时返回None（需要根据响应内容判断）
+        """
+        if content_type == "text/event-stream":
+            return "sse"
+        if content_type in ("application/x-ndjson", "application/jsonl", "application/stream+json"):
+            return "ndjson"
+        if content_type.startswith("text/"):
+            return "text"
+        return None
+    
+    @staticmethod
+    def _is_n8n_stream_line(line: str) -> bool:
+        """判断响应首行是否为n8n流式响应消息"""
+        try:
+            return is_n8n_stream_object(fast_json.loads(line))
+        except ValueError:
+            return False
+    
+    @staticmethod
+    def _parse_stream_data(data: str) -> Optional[str]:
+        """解析SSE事件data，JSON格式提取文本字段，否则按纯文本处理"""
+        if data == "[DONE]":
+            return None
+        if data[:1] in ("{", "["):
+            try:
+                return extract_stream_text(fast_json.loads(data))
+            except ValueError:
+                pass
+        return data
+    
+    def _parse_complete_body(self, body: str) -> Optional[str]:
+        """解析完整读取的非流式响应体"""
+        if not body.strip():
+            return None
+        try:
+            ai_response = self.response_extractor.parse(body)
+        except ValueError:
+            # 没有流式标记的逐行JSON
+            decoder = NDJSONDecoder()
+            deltas = [extract_stream_text(obj) for obj in decoder.feed(body) + decoder.flush()]
+            return "".join(delta for delta in deltas if delta) or None
+        if ai_response is None:
+            logger.warning(f"n8n响应中没有找到回复字段，请检查N8N_RESPONSE_PATHS: {Config.N8N_RESPONSE_PATHS}")
+        return ai_response
 
-    async def stream_reply(self, incoming_message) -> str:
+    async def stream_reply(self, incoming_message) -> AsyncIterator[str]:
         """
-        伪流式返回n8n回复内容，供AI卡片handler实时更新。
+        流式返回n8n回复内容，供AI卡片handler实时更新。
+        开启N8N_STREAMING时边接收边分段输出，否则等待完整回复后再分段。
+        分段不会切开Markdown代码块。
         :param incoming_message: ChatbotMessage对象
         :yield: AI回复内容分段
         """
         user_message = getattr(getattr(incoming_message, 'text', None), 'content', '')
         user_id = getattr(incoming_message, 'sender_staff_id', None)
         conversation_id = getattr(incoming_message, 'conversation_id', None)
-        try:
-            ai_response = await asyncio.wait_for(
-                self.get_ai_response(user_message, user_id, conversation_id),
-                timeout=Config.N8N_WEBHOOK_TIMEOUT  # 支持env配置
-            )
-            if not ai_response:
-                logger.warning(f"n8n webhook返回空内容，user_message={user_message}, user_id={user_id}, conversation_id={conversation_id}")
-                yield "AI回复为空，请稍后重试。"
+        segmenter = MarkdownSegmenter()
+        
+        if not Config.N8N_STREAMING:
+            try:
+                ai_response = await asyncio.wait_for(
+                    self.get_ai_response(user_message, user_id, conversation_id),
+                    timeout=Config.N8N_WEBHOOK_TIMEOUT  # 支持env配置
+                )
+                if not ai_response:
+                    logger.warning(f"n8n webhook返回空内容，user_message={user_message}, user_id={user_id}, conversation_id={conversation_id}")
+                    yield Config.N8N_DEGRADED_MESSAGE if self.degraded else "AI回复为空，请稍后重试。"
+                    return
+            except asyncio.TimeoutError:
+                logger.error(f"n8n webhook调用超时（{Config.N8N_WEBHOOK_TIMEOUT}秒），user_message={user_message}, user_id={user_id}, conversation_id={conversation_id}")
+                TIMEOUTS_TOTAL.inc(stage="webhook")
+                yield "AI思考时间较长，请稍后再试。"
                 return
+            except Exception as e:
+                logger.error(f"n8n webhook调用异常: {e}, user_message={user_message}, user_id={user_id}, conversation_id={conversation_id}")
+                FAILURES_TOTAL.inc(stage="webhook")
+                yield f"AI服务异常：{e}"
+                return
+            for segment in segmenter.feed(ai_response):
+                yield segment
+            tail = segmenter.flush()
+            if tail:
+                yield tail
+            return
+        
+        received = False
+        try:
+            async for delta in self.stream_ai_response(user_message, user_id, conversation_id):
+                if not received:
+                    logger.info("收到n8n首个流式分块")
+                    received = True
+                for segment in segmenter.feed(delta):
+                    yield segment
         except asyncio.TimeoutError:
-            logger.error(f"n8n webhook调用超时（30秒），user_message={user_message}, user_id={user_id}, conversation_id={conversation_id}")
-            yield "AI思考时间较长，请稍后再试。"
+            logger.error(f"n8n webhook流式读取超时（{Config.N8N_WEBHOOK_TIMEOUT}秒），user_message={user_message}, user_id={user_id}, conversation_id={conversation_id}")
+            TIMEOUTS_TOTAL.inc(stage="webhook")
+            tail = segmenter.flush()
+            if tail:
+                yield tail
+            yield "\n\n（回复中断，请稍后再试）" if received else "AI思考时间较长，请稍后再试。"
+            return
+        except CircuitOpenError:
+            logger.warning(f"n8n webhook熔断中，快速返回降级提示，user_id={user_id}, conversation_id={conversation_id}")
+            yield Config.N8N_DEGRADED_MESSAGE
             return
         except Exception as e:
             logger.error(f"n8n webhook调用异常: {e}, user_message={user_message}, user_id={user_id}, conversation_id={conversation_id}")
-            yield f"AI服务异常：{e}"
+            FAILURES_TOTAL.inc(stage="webhook")
+            tail = segmenter.flush()
+            if tail:
+                yield tail
+            yield "\n\n（回复中断，请稍后再试）" if received else f"AI服务异常：{e}"
             return
-        # 简单按句号、换行分段模拟流式
-        segments = re.split(r'(。|！|？|\n)', ai_response)
-        buffer = ''
-        for seg in segments:
-            buffer += seg
-            if seg in ['。', '！', '？', '\n']:
-                yield buffer
-                buffer = ''
-        if buffer:
-            yield buffer 
+        
+        tail = segmenter.flush()
+        if tail:
+            yield tail
+        if not received:
+            logger.warning(f"n8n webhook返回空内容，user_message={user_message}, user_id={user_id}, conversation_id={conversation_id}")
+            yield "AI回复为空，请稍后重试。"
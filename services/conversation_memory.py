@@ -0,0 +1,233 @@
+import json
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 一轮对话：{"user": 用户消息, "ai": AI回复}
+Turn = Dict[str, str]
+
+
+class HistoryStore:
+    """对话历史存储基类，按会话key保存最近N轮对话"""
+
+    def __init__(self, max_turns: int = 10, ttl: int = 3600):
+        """
+        :param max_turns: 每个会话保留的最大轮数
+        :param ttl: 会话无活动多少秒后过期
+        """
+        self.max_turns = max_turns
+        self.ttl = ttl
+
+    async def get_history(self, key: str) -> List[Turn]:
+        """获取会话历史，按时间从早到晚排列"""
+        raise NotImplementedError
+
+    async def append_turn(self, key: str, user_message: str, ai_response: str):
+        """追加一轮对话，超出max_turns时丢弃最早的一轮"""
+        raise NotImplementedError
+
+    async def clear(self, key: str):
+        """清除会话历史"""
+        raise NotImplementedError
+
+    async def close(self):
+        """释放资源"""
+        return
+
+
+class InMemoryHistoryStore(HistoryStore):
+    """
+    进程内对话历史存储
+    每个会话使用定长环形缓冲区保存最近N轮，会话总数超过上限时淘汰最久未使用的会话，
+    无活动超过TTL的会话在访问时过期。
+    """
+
+    def __init__(self, max_turns: int = 10, ttl: int = 3600, max_conversations: int = 10000):
+        super().__init__(max_turns, ttl)
+        self.max_conversations = max_conversations
+        self._conversations: OrderedDict[str, Tuple[deque, float]] = OrderedDict()
+
+    async def get_history(self, key: str) -> List[Turn]:
+        entry = self._conversations.get(key)
+        if entry is None:
+            return []
+        turns, expire_at = entry
+        if time.monotonic() >= expire_at:
+            del self._conversations[key]
+            return []
+        self._conversations.move_to_end(key)
+        return list(turns)
+
+    async def append_turn(self, key: str, user_message: str, ai_response: str):
+        entry = self._conversations.get(key)
+        if entry is None or time.monotonic() >= entry[1]:
+            turns = deque(maxlen=self.max_turns)
+        else:
+            turns = entry[0]
+        turns.append({"user": user_message, "ai": ai_response})
+        self._conversations[key] = (turns, time.monotonic() + self.ttl)
+        self._conversations.move_to_end(key)
+        self._evict()
+
+    async def clear(self, key: str):
+        self._conversations.pop(key, None)
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def _evict(self):
+        # 先清理最久未使用一端已过期的会话，再按LRU淘汰超出上限的会话
+        now = time.monotonic()
+        while self._conversations:
+            key, (_, expire_at) = next(iter(self._conversations.items()))
+            if expire_at > now and len(self._conversations) <= self.max_conversations:
+                break
+            del self._conversations[key]
+
+
+class RedisHistoryStore(HistoryStore):
+    """
+    Redis对话历史存储，每个会话一个list，读写都通过pipeline一次往返完成
+    client为redis.asyncio兼容的客户端（测试时可传入fakeredis）
+    """
+
+    def __init__(self, client, max_turns: int = 10, ttl: int = 3600, key_prefix: str = "dingtalk_bot:history:"):
+        super().__init__(max_turns, ttl)
+        self.client = client
+        self.key_prefix = key_prefix
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisHistoryStore":
+        """根据Redis地址创建存储，需要安装redis包"""
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("使用Redis存储对话历史需要安装redis: pip install redis")
+        return cls(redis.from_url(url), **kwargs)
+
+    def _key(self, key: str) -> str:
+        return self.key_prefix + key
+
+    async def get_history(self, key: str) -> List[Turn]:
+        redis_key = self._key(key)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.lrange(redis_key, 0, -1)
+            pipe.expire(redis_key, self.ttl)
+            raw_turns, _ = await pipe.execute()
+        return self._decode(raw_turns)
+
+    async def get_histories(self, keys: List[str]) -> Dict[str, List[Turn]]:
+        """批量获取多个会话的历史，一次往返"""
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.lrange(self._key(key), 0, -1)
+            results = await pipe.execute()
+        return {key: self._decode(raw_turns) for key, raw_turns in zip(keys, results)}
+
+    async def append_turn(self, key: str, user_message: str, ai_response: str):
+        redis_key = self._key(key)
+        value = json.dumps({"user": user_message, "ai": ai_response}, ensure_ascii=False)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.rpush(redis_key, value)
+            pipe.ltrim(redis_key, -self.max_turns, -1)
+            pipe.expire(redis_key, self.ttl)
+            await pipe.execute()
+
+    async def clear(self, key: str):
+        await self.client.delete(self._key(key))
+
+    async def close(self):
+        close = getattr(self.client, "aclose", None) or getattr(self.client, "close", None)
+        if close:
+            await close()
+
+    @staticmethod
+    def _decode(raw_turns) -> List[Turn]:
+        turns = []
+        for raw in raw_turns or []:
+            try:
+                turns.append(json.loads(raw))
+            except ValueError:
+                logger.warning(f"无法解析的对话历史: {raw!r}")
+        return turns
+
+
+class PromptBuilder:
+    """
+    把对话历史拼接为prompt，并保证总长度不超过预算
+    超出预算时优先丢弃最早的对话轮次，当前消息始终保留
+    """
+
+    def __init__(self, max_length: int = 4000, length_function: Callable[[str], int] = len):
+        """
+        :param max_length: prompt长度预算
+        :param length_function: 长度计算函数，默认按字符数，可传入token计数函数
+        """
+        self.max_length = max_length
+        self.length_function = length_function
+
+    @staticmethod
+    def format_turn(turn: Turn) -> str:
+        return f"用户：{turn.get('user', '')}\nAI：{turn.get('ai', '')}\n"
+
+    def select_turns(self, history: List[Turn], user_message: str) -> List[Turn]:
+        """从最近的轮次开始选取，直到达到长度预算"""
+        budget = self.max_length - self.length_function(f"用户：{user_message}\n")
+        selected = []
+        for turn in reversed(history):
+            cost = self.length_function(self.format_turn(turn))
+            if cost > budget:
+                break
+            budget -= cost
+            selected.append(turn)
+        selected.reverse()
+        return selected
+
+    def build(self, history: List[Turn], user_message: str) -> str:
+        """
+        拼接prompt，格式为：
+        用户：你好
+        AI：你好，有什么可以帮您？
+        用户：{当前消息}
+        """
+        turns = self.select_turns(history, user_message)
+        return "".join(self.format_turn(turn) for turn in turns) + f"用户：{user_message}\n"
+
+
+def history_key(scope: str, user_id: Optional[str], conversation_id: Optional[str]) -> Optional[str]:
+    """
+    计算会话历史的key
+    :param scope: conversation（按会话）、user（按用户）、conversation_user（会话内按用户区分）
+    :return: key，缺少必要ID时返回None
+    """
+    if scope == "user":
+        return f"user:{user_id}" if user_id else None
+    if scope == "conversation_user":
+        return f"conv:{conversation_id}:user:{user_id}" if conversation_id and user_id else None
+    return f"conv:{conversation_id}" if conversation_id else None
+
+
+def create_history_store(config) -> Optional[HistoryStore]:
+    """
+    根据配置创建对话历史存储
+    :return: 存储实例，未启用时返回None
+    """
+    backend = config.CONVERSATION_MEMORY_BACKEND.lower()
+    if backend in ("", "none"):
+        return None
+    if backend == "redis":
+        return RedisHistoryStore.from_url(
+            config.REDIS_URL,
+            max_turns=config.CONVERSATION_MEMORY_MAX_TURNS,
+            ttl=config.CONVERSATION_MEMORY_TTL,
+        )
+    if backend == "memory":
+        return InMemoryHistoryStore(
+            max_turns=config.CONVERSATION_MEMORY_MAX_TURNS,
+            ttl=config.CONVERSATION_MEMORY_TTL,
+            max_conversations=config.CONVERSATION_MEMORY_MAX_CONVERSATIONS,
+        )
+    raise ValueError(f"不支持的对话历史存储: {config.CONVERSATION_MEMORY_BACKEND}")
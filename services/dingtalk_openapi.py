@@ -0,0 +1,169 @@
+import asyncio
+import functools
+import logging
+import platform
+import uuid
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import aiohttp
+
+from config import Config
+from utils import fast_json
+
+logger = logging.getLogger(__name__)
+
+
+async def offload(func: Callable, *args, **kwargs) -> Any:
+    """
+    在线程池中执行无法改写为异步的同步SDK调用，避免阻塞事件循环
+    :param func: 同步函数
+    :return: 函数返回值
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+class DingTalkOpenAPIClient:
+    """钉钉OpenAPI异步客户端，机器人、OAuth、卡片接口共用一个长连接池"""
+
+    def __init__(self, endpoint: str = None, pool_size: int = None, timeout: float = None):
+        self.endpoint = (endpoint or Config.DINGTALK_OPENAPI_ENDPOINT).rstrip("/")
+        self.pool_size = pool_size or Config.DINGTALK_HTTP_POOL_SIZE
+        self.timeout = timeout or Config.DINGTALK_HTTP_TIMEOUT
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.user_agent = f"n8n-on-dingtalk-bot Python/{platform.python_version()}"
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """获取或创建共享的HTTP会话"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                json_serialize=fast_json.dumps,
+            )
+        return self.session
+
+    async def _request(self, method: str, path: str, access_token: str = None,
+                       body: Dict[str, Any] = None) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """
+        发送OpenAPI请求
+        :return: (HTTP状态码, 响应JSON)，网络异常时状态码为0
+        """
+        session = await self._get_session()
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "User-Agent": self.user_agent,
+        }
+        if access_token:
+            headers["x-acs-dingtalk-access-token"] = access_token
+
+        url = self.endpoint + path
+        try:
+            async with session.request(method, url, json=body, headers=headers) as response:
+                text = await response.text()
+                try:
+                    data = fast_json.loads(text) if text else {}
+                except ValueError:
+                    data = {"raw": text}
+                if response.status != 200:
+                    logger.error(f"钉钉OpenAPI调用失败: {method} {path}, HTTP {response.status}, {text}")
+                return response.status, data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"钉钉OpenAPI网络异常: {method} {path}, {e!r}")
+            return 0, None
+
+    async def warm_up(self) -> bool:
+        """
+        预热：解析域名并建立一条长连接，首次调用接口时不再承担DNS解析和TLS握手的耗时
+        :return: 连接成功返回True，不关心HTTP状态码
+        """
+        session = await self._get_session()
+        try:
+            async with session.head(self.endpoint + "/", headers={"User-Agent": self.user_agent}) as response:
+                await response.read()
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"钉钉OpenAPI预热失败: {e!r}")
+            return False
+
+    async def get_access_token(self, app_key: str, app_secret: str) -> Optional[Dict[str, Any]]:
+        """
+        获取企业内部应用的access_token
+        :return: {"accessToken": ..., "expireIn": ...}，失败返回None
+        """
+        status, data = await self._request("POST", "/v1.0/oauth2/accessToken", body={
+            "appKey": app_key,
+            "appSecret": app_secret,
+        })
+        if status != 200 or not data or not data.get("accessToken"):
+            return None
+        return data
+
+    async def org_group_send(self, access_token: str, robot_code: str, open_conversation_id: str,
+                             msg_key: str, msg_param: str) -> bool:
+        """
+        机器人发送群消息
+        :param msg_key: 消息模板，如sampleMarkdown、sampleText
+        :param msg_param: 消息参数JSON字符串
+        :return: 发送是否成功
+        """
+        status, data = await self._request("POST", "/v1.0/robot/groupMessages/send", access_token, {
+            "msgParam": msg_param,
+            "msgKey": msg_key,
+            "openConversationId": open_conversation_id,
+            "robotCode": robot_code,
+        })
+        logger.debug(f"发送响应: {data}")
+        return status == 200
+
+    async def create_and_deliver_card(self, access_token: str, body: Dict[str, Any]) -> bool:
+        """
+        创建并投放卡片
+        :param body: 请求体，包含cardTemplateId、outTrackId、openSpaceId等
+        :return: 是否成功
+        """
+        status, _ = await self._request("POST", "/v1.0/card/instances/createAndDeliver", access_token, body)
+        return status == 200
+
+    async def streaming_card(self, access_token: str, out_track_id: str, key: str, content: str,
+                             append: bool = False, finished: bool = False, failed: bool = False) -> bool:
+        """
+        AI卡片流式更新
+        :param out_track_id: 卡片实例ID
+        :param key: 流式更新的变量名
+        :param content: 更新内容，append为True时为增量
+        :return: 是否成功
+        """
+        status, _ = await self._request("PUT", "/v1.0/card/streaming", access_token, {
+            "outTrackId": out_track_id,
+            "guid": str(uuid.uuid1()),
+            "key": key,
+            "content": content,
+            "isFull": not append,
+            "isFinalize": finished,
+            "isError": failed,
+        })
+        return status == 200
+
+    async def close(self):
+        """关闭HTTP会话"""
+        if self.session and not self.session.closed:
+            await self.session.close()
+            logger.info("钉钉OpenAPI HTTP会话已关闭")
+
+
+_shared_client: Optional[DingTalkOpenAPIClient] = None
+
+
+def get_openapi_client() -> DingTalkOpenAPIClient:
+    """获取进程内共享的OpenAPI客户端"""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = DingTalkOpenAPIClient()
+    return _shared_client
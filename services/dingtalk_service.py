@@ -1,128 +1,169 @@
-import json
 import logging
 from typing import Optional
-from alibabacloud_dingtalk.robot_1_0.client import Client as DingTalkRobotClient
-from alibabacloud_dingtalk.robot_1_0 import models as robot_models
-from alibabacloud_tea_openapi import models as open_api_models
-from alibabacloud_tea_util import models as util_models
+
+from config import Config
+from services.dingtalk_openapi import DingTalkOpenAPIClient, get_openapi_client
+from utils import fast_json
+from utils.send_scheduler import PRIORITY_REPLY, GroupSendScheduler
+from utils.work_journal import CURRENT_ENTRY, KIND_OUTBOUND, JournalEntry, WorkJournal
 
 logger = logging.getLogger(__name__)
 
+def encode_msg_param(params: dict) -> str:
+    """
+    编码机器人消息的msgParam
+    :param params: 消息参数，如 {"title": ..., "text": ...}
+    :return: JSON字符串，保留中文不转义
+    """
+    return fast_json.dumps(params)
+
 class DingTalkService:
     """钉钉服务类，负责发送消息到钉钉群"""
     
-    def __init__(self, robot_code: str):
+    def __init__(self, robot_code: str, openapi_client: DingTalkOpenAPIClient = None,
+                 scheduler: GroupSendScheduler = None, journal: WorkJournal = None):
+        """
+        :param scheduler: 群消息发送调度器，负责限流、优先级排队和合并，默认按Config创建
+        :param journal: 工作日志，发送前记录、发送成功后删除，发送失败或崩溃时下次启动重发，为空则不启用
+        """
         self.robot_code = robot_code
-        self.config = open_api_models.Config()
-        self.config.protocol = 'https'
-        self.config.region_id = 'central'
-        self.client = DingTalkRobotClient(self.config)
+        self.client = openapi_client or get_openapi_client()
+        self.journal = journal
+        self.scheduler = scheduler or GroupSendScheduler(
+            self._send,
+            group_rate=Config.DINGTALK_SEND_GROUP_PER_MINUTE / 60,
+            group_burst=Config.DINGTALK_SEND_GROUP_BURST,
+            app_rate=Config.DINGTALK_SEND_APP_PER_SECOND,
+            app_burst=Config.DINGTALK_SEND_APP_PER_SECOND,
+            merge=Config.DINGTALK_SEND_MERGE,
+            merge_max_length=Config.MAX_MESSAGE_LENGTH,
+        )
     
-    def send_markdown_message(self, access_token: str, open_conversation_id: str, 
-                            title: str, content: str) -> bool:
+    async def _send(self, access_token: str, open_conversation_id: str, msg_key: str, params: dict) -> bool:
+        """调度器实际发送一条群消息"""
+        return await self.client.org_group_send(
+            access_token,
+            self.robot_code,
+            open_conversation_id,
+            msg_key=msg_key,
+            msg_param=encode_msg_param(params)
+        )
+    
+    async def _submit(self, access_token: str, open_conversation_id: str, msg_key: str, params: dict,
+                      priority: int, entry_id: int = None) -> bool:
+        """
+        记录到工作日志后提交给发送调度器，发送成功后标记完成
+        :param entry_id: 重发日志中的条目时传入，不再重复记录
+        """
+        if self.journal is not None and entry_id is None:
+            entry_id = await self.journal.record(KIND_OUTBOUND, {
+                "open_conversation_id": open_conversation_id,
+                "msg_key": msg_key,
+                "params": params,
+                "priority": priority,
+            }, parent=CURRENT_ENTRY.get())
+        success = await self.scheduler.submit(access_token, open_conversation_id, msg_key, params, priority=priority)
+        if success and self.journal is not None:
+            self.journal.complete(entry_id)
+        return success
+    
+    async def resend(self, access_token: str, entry: JournalEntry) -> bool:
+        """
+        重发工作日志中未发送成功的群消息
+        :param entry: outbound条目
+        :return: 发送是否成功
+        """
+        payload = entry.payload
+        try:
+            return await self._submit(access_token, payload["open_conversation_id"], payload["msg_key"],
+                                      payload["params"], payload.get("priority", PRIORITY_REPLY), entry_id=entry.id)
+        except Exception as err:
+            logger.error(f"重发群消息失败: {err}")
+            return False
+    
+    async def send_markdown_message(self, access_token: str, open_conversation_id: str, 
+                            title: str, content: str, priority: int = PRIORITY_REPLY) -> bool:
         """
         发送Markdown消息到钉钉群
         :param access_token: 钉钉access_token
         :param open_conversation_id: 群会话ID
         :param title: 消息标题
         :param content: Markdown内容
+        :param priority: 排队时的优先级，数值越小越先发送
         :return: 发送是否成功
         """
         try:
-            # 构建Markdown消息参数
-            msg_param = json.dumps({
-                "title": title,
-                "text": content
-            }, ensure_ascii=False)
-            
-            # 设置请求头
-            headers = robot_models.OrgGroupSendHeaders()
-            headers.x_acs_dingtalk_access_token = access_token
-            
-            # 构建请求
-            request = robot_models.OrgGroupSendRequest(
-                msg_param=msg_param,
-                msg_key="sampleMarkdown",  # Markdown消息类型
-                open_conversation_id=open_conversation_id,
-                robot_code=self.robot_code
-            )
-            
-            # 发送消息
-            response = self.client.org_group_send_with_options(
-                request,
-                headers,
-                util_models.RuntimeOptions()
+            # 发送消息（Markdown消息类型），超出限流时排队等待
+            success = await self._submit(
+                access_token,
+                open_conversation_id,
+                "sampleMarkdown",
+                {"title": title, "text": content},
+                priority
             )
             
-            logger.info("Markdown消息发送成功")
-            logger.debug(f"发送响应: {response}")
-            return True
+            if success:
+                logger.info("Markdown消息发送成功")
+            else:
+                logger.error("Markdown消息发送失败")
+            return success
             
         except Exception as err:
             logger.error(f"发送Markdown消息失败: {err}")
             return False
     
-    def send_text_message(self, access_token: str, open_conversation_id: str, 
-                         content: str) -> bool:
+    async def send_text_message(self, access_token: str, open_conversation_id: str, 
+                         content: str, priority: int = PRIORITY_REPLY) -> bool:
         """
         发送文本消息到钉钉群
         :param access_token: 钉钉access_token
         :param open_conversation_id: 群会话ID
         :param content: 文本内容
+        :param priority: 排队时的优先级，数值越小越先发送
         :return: 发送是否成功
         """
         try:
-            # 构建文本消息参数
-            msg_param = json.dumps({
-                "content": content
-            }, ensure_ascii=False)
-            
-            # 设置请求头
-            headers = robot_models.OrgGroupSendHeaders()
-            headers.x_acs_dingtalk_access_token = access_token
-            
-            # 构建请求
-            request = robot_models.OrgGroupSendRequest(
-                msg_param=msg_param,
-                msg_key="sampleText",  # 文本消息类型
-                open_conversation_id=open_conversation_id,
-                robot_code=self.robot_code
-            )
-            
-            # 发送消息
-            response = self.client.org_group_send_with_options(
-                request,
-                headers,
-                util_models.RuntimeOptions()
+            # 发送消息（文本消息类型），超出限流时排队等待
+            success = await self._submit(
+                access_token,
+                open_conversation_id,
+                "sampleText",
+                {"content": content},
+                priority
             )
             
-            logger.info("文本消息发送成功")
-            logger.debug(f"发送响应: {response}")
-            return True
+            if success:
+                logger.info("文本消息发送成功")
+            else:
+                logger.error("文本消息发送失败")
+            return success
             
         except Exception as err:
             logger.error(f"发送文本消息失败: {err}")
             return False
     
-    def format_markdown_content(self, ai_response: str, user_name: str = None) -> tuple:
+    async def close(self):
+        """停止发送调度，排队中的消息视为发送失败"""
+        await self.scheduler.close()
+    
+    def format_markdown_content(self, ai_response: str, user_name: str = None, page: int = 1) -> tuple:
         """
         格式化AI回复为Markdown内容
-        :param ai_response: AI回复内容
+        长回复由MarkdownPaginator分页后逐页调用，这里不再截断
+        :param ai_response: AI回复内容（一页）
         :param user_name: 用户名
+        :param page: 页码，从第2页开始在标题中注明
         :return: (title, content) 元组
         """
         title = f"🤖 {self._get_bot_name()} 回复"
         if user_name:
             title += f" @{user_name}"
+        if page > 1:
+            title += f"（第{page}页）"
         
         # 格式化内容，确保Markdown格式正确
         content = ai_response.strip()
         
-        # 如果内容太长，进行截断
-        max_length = 2000  # 钉钉Markdown消息长度限制
-        if len(content) > max_length:
-            content = content[:max_length-3] + "..."
-        
         return title, content
     
     def _get_bot_name(self) -> str:
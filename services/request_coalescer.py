@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _StreamFlight:
+    """一次进行中的流式请求，记录已收到的分块供所有等待者读取"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        # 替换Event，已在等待的读者被唤醒，之后的读者等待下一次变化
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class RequestCoalescer:
+    """
+    进行中请求合并（single-flight）
+    相同key的并发请求共用一次上游调用，所有等待者得到同一结果；
+    流式请求的每个分块都会转发给所有等待者。请求结束后立即移除，不会返回过期结果。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        """当前进行中的上游请求数"""
+        return len(self._calls) + len(self._streams)
+
+    async def call(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        合并执行一次性请求
+        :param key: 请求key
+        :param func: 发起上游请求的协程函数，同一key只会执行一次
+        :return: 请求结果
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+            logger.info(f"合并相同的进行中请求: key={key}, coalesced={self.coalesced}")
+        # shield：某个等待者被取消时不影响上游请求和其他等待者
+        return await asyncio.shield(task)
+
+    async def stream(self, key: str, func: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        合并执行流式请求，后加入的等待者会先收到已到达的分块
+        :param key: 请求key
+        :param func: 返回上游分块异步迭代器的函数，同一key只会执行一次
+        :yield: 分块
+        """
+        flight = self._streams.get(key)
+        if flight is None:
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            flight.task = asyncio.get_running_loop().create_task(self._pump(key, flight, func))
+        else:
+            self.coalesced += 1
+            logger.info(f"合并相同的进行中流式请求: key={key}, coalesced={self.coalesced}")
+
+        index = 0
+        while True:
+            while index < len(flight.chunks):
+                yield flight.chunks[index]
+                index += 1
+            if flight.done:
+                break
+            await flight.changed.wait()
+        if flight.error is not None:
+            raise flight.error
+
+    async def _pump(self, key: str, flight: _StreamFlight, func: Callable[[], AsyncIterator[str]]):
+        try:
+            async for chunk in func():
+                flight.chunks.append(chunk)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._streams.pop(key, None)
+            flight.notify()
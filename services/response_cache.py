@@ -0,0 +1,150 @@
+import re
+import time
+import logging
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 归一化时去掉的句末标点
+TRAILING_PUNCTUATION = "?？!！。.~～…"
+
+
+def normalize_message(message: str) -> str:
+    """
+    归一化用户问题：全半角统一、忽略大小写、合并空白、去掉句末标点
+    "怎么请假？" 和 "怎么请假" 视为同一个问题
+    """
+    text = unicodedata.normalize("NFKC", message or "").lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(TRAILING_PUNCTUATION).strip()
+
+
+def response_key(scope: str, message: str, user_id: str = None, conversation_id: str = None) -> Optional[str]:
+    """
+    计算回复key，回复缓存和进行中请求合并共用
+    :param scope: global（所有人共享）、conversation（按会话）、user（按用户）
+    :return: key，消息为空或缺少作用域所需的ID时返回None
+    """
+    text = normalize_message(message)
+    if not text:
+        return None
+    if scope == "conversation":
+        return f"conv:{conversation_id}:{text}" if conversation_id else None
+    if scope == "user":
+        return f"user:{user_id}:{text}" if user_id else None
+    return f"global:{text}"
+
+
+class ResponseCache:
+    """
+    AI回复缓存，用于重复的FAQ类问题
+    按LRU淘汰，条目超过TTL后失效，总数和总字节数都有上限
+    """
+
+    def __init__(self, ttl: int = 600, max_entries: int = 1000, max_bytes: int = 10 * 1024 * 1024,
+                 scope: str = "global"):
+        """
+        :param ttl: 缓存有效期（秒）
+        :param max_entries: 最大条目数
+        :param max_bytes: 缓存内容的最大总字节数
+        :param scope: global（所有人共享）、conversation（按会话）、user（按用户）
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.scope = scope
+        self._entries: OrderedDict[str, Tuple[str, float, int]] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, message: str, user_id: str = None, conversation_id: str = None) -> Optional[str]:
+        """
+        计算缓存key
+        :return: key，消息为空或缺少作用域所需的ID时返回None（不缓存）
+        """
+        return response_key(self.scope, message, user_id, conversation_id)
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，未命中或已过期返回None"""
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry[1]:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: str):
+        """写入缓存，超过容量时淘汰最久未使用的条目"""
+        size = len(key.encode("utf-8")) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.monotonic() + self.ttl, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        """清空缓存"""
+        self._entries.clear()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """命中率等统计信息"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+def _split_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def workflow_cache_allowed(webhook_url: str, allowlist: str = "", denylist: str = "") -> bool:
+    """
+    判断某个n8n工作流是否允许缓存回复
+    名单中的每一项是webhook URL或其中的一部分（如webhook ID），逗号分隔；
+    配置了白名单时只有白名单内的工作流允许缓存，黑名单优先
+    """
+    if any(item in webhook_url for item in _split_list(denylist)):
+        return False
+    allowed = _split_list(allowlist)
+    return not allowed or any(item in webhook_url for item in allowed)
+
+
+def create_response_cache(config, webhook_url: str) -> Optional[ResponseCache]:
+    """
+    根据配置创建回复缓存
+    :return: 缓存实例，未启用或该工作流不允许缓存时返回None
+    """
+    if not config.RESPONSE_CACHE_ENABLED:
+        return None
+    if not workflow_cache_allowed(webhook_url, config.RESPONSE_CACHE_WORKFLOW_ALLOWLIST,
+                                  config.RESPONSE_CACHE_WORKFLOW_DENYLIST):
+        logger.info(f"该工作流未启用回复缓存: {webhook_url}")
+        return None
+    return ResponseCache(
+        ttl=config.RESPONSE_CACHE_TTL,
+        max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes=config.RESPONSE_CACHE_MAX_BYTES,
+        scope=config.RESPONSE_CACHE_SCOPE,
+    )
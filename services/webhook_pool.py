@@ -0,0 +1,172 @@
+import time
+import random
+import asyncio
+import logging
+from typing import Iterable, List, Optional, Union
+from urllib.parse import urljoin
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+def parse_webhook_urls(value: Union[str, Iterable[str]]) -> List[str]:
+    """解析webhook地址，支持列表或逗号分隔的字符串"""
+    if isinstance(value, str):
+        value = value.split(",")
+    return [url.strip() for url in value if url and url.strip()]
+
+
+class WebhookEndpoint:
+    """一个n8n webhook地址及其负载、延迟和健康状态"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.ewma_latency = 0.0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def __repr__(self):
+        return (f"WebhookEndpoint({self.url}, outstanding={self.outstanding}, "
+                f"ewma={self.ewma_latency:.3f}s, healthy={self.healthy})")
+
+
+class WebhookPool:
+    """
+    n8n webhook地址池
+    按最少进行中请求数（least_outstanding）或EWMA延迟（ewma）选择地址；
+    连续失败的地址被暂时移出（被动健康检查），到期后自动恢复；
+    开启主动健康检查时定期访问各实例的健康检查地址，失败移出，成功立即恢复
+    """
+
+    def __init__(self, urls: Union[str, Iterable[str]], strategy: str = "least_outstanding",
+                 failure_threshold: int = 3, eject_seconds: float = 30,
+                 health_check_interval: float = 0, health_check_path: str = "/healthz",
+                 ewma_alpha: float = 0.3):
+        """
+        :param urls: webhook地址列表，或逗号分隔的字符串
+        :param strategy: least_outstanding（最少进行中请求）或ewma（延迟加权）
+        :param failure_threshold: 连续失败多少次后移出
+        :param eject_seconds: 移出时长（秒）
+        :param health_check_interval: 主动健康检查间隔（秒），0表示不检查
+        :param health_check_path: 健康检查路径，相对于webhook地址所在的n8n实例
+        :param ewma_alpha: EWMA平滑系数
+        """
+        self.endpoints = [WebhookEndpoint(url) for url in parse_webhook_urls(urls)]
+        if not self.endpoints:
+            raise ValueError("至少需要一个n8n webhook地址")
+        if strategy not in ("least_outstanding", "ewma"):
+            raise ValueError(f"不支持的负载均衡策略: {strategy}")
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self.health_check_interval = health_check_interval
+        self.health_check_path = health_check_path
+        self.ewma_alpha = ewma_alpha
+        self._health_task: Optional[asyncio.Task] = None
+
+    @property
+    def primary_url(self) -> str:
+        return self.endpoints[0].url
+
+    def _score(self, endpoint: WebhookEndpoint) -> float:
+        if self.strategy == "ewma":
+            # 延迟越高、排队越多得分越高；还没有延迟数据的地址优先试探
+            return endpoint.ewma_latency * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def pick(self, exclude: Iterable[WebhookEndpoint] = ()) -> WebhookEndpoint:
+        """
+        选择一个地址
+        :param exclude: 尽量避开的地址（如本次请求已经失败过的）
+        :return: 地址，所有地址都不可用时返回最早恢复的那个
+        """
+        excluded = set(id(endpoint) for endpoint in exclude)
+        candidates = [e for e in self.endpoints if e.healthy and id(e) not in excluded] \
+            or [e for e in self.endpoints if e.healthy] \
+            or [min(self.endpoints, key=lambda e: e.ejected_until)]
+        best = min(self._score(e) for e in candidates)
+        return random.choice([e for e in candidates if self._score(e) == best])
+
+    def begin(self, endpoint: WebhookEndpoint) -> float:
+        """
+        记录请求开始
+        :return: 开始时间，结束时传给end
+        """
+        endpoint.outstanding += 1
+        return time.monotonic()
+
+    def end(self, endpoint: WebhookEndpoint, started: float, success: Optional[bool]):
+        """
+        记录请求结束，更新延迟并处理被动健康检查
+        :param success: 请求是否成功，None表示请求被主动取消，不计入统计
+        """
+        endpoint.outstanding -= 1
+        if success is None:
+            return
+        if success:
+            latency = time.monotonic() - started
+            endpoint.ewma_latency = latency if endpoint.ewma_latency == 0 else \
+                self.ewma_alpha * latency + (1 - self.ewma_alpha) * endpoint.ewma_latency
+            endpoint.failures = 0
+            return
+        endpoint.failures += 1
+        if len(self.endpoints) > 1 and endpoint.failures >= self.failure_threshold and endpoint.healthy:
+            self._eject(endpoint, f"连续失败{endpoint.failures}次")
+
+    def _eject(self, endpoint: WebhookEndpoint, reason: str):
+        endpoint.ejected_until = time.monotonic() + self.eject_seconds
+        logger.warning(f"n8n webhook地址移出轮询{self.eject_seconds}秒: {endpoint.url}, {reason}")
+
+    def _restore(self, endpoint: WebhookEndpoint):
+        if not endpoint.healthy:
+            logger.info(f"n8n webhook地址恢复: {endpoint.url}")
+        endpoint.ejected_until = 0.0
+        endpoint.failures = 0
+
+    def start_health_checks(self, session: aiohttp.ClientSession):
+        """启动主动健康检查（需要在事件循环中调用，重复调用无影响）"""
+        if self.health_check_interval <= 0 or len(self.endpoints) < 2:
+            return
+        if self._health_task is not None and not self._health_task.done():
+            return
+        self._health_task = asyncio.get_running_loop().create_task(self._health_check_loop(session))
+
+    async def _health_check_loop(self, session: aiohttp.ClientSession):
+        while not session.closed:
+            await asyncio.gather(*(self.check(endpoint, session) for endpoint in self.endpoints))
+            await asyncio.sleep(self.health_check_interval)
+
+    async def check(self, endpoint: WebhookEndpoint, session: aiohttp.ClientSession) -> bool:
+        """
+        主动检查一个地址
+        :return: 健康返回True
+        """
+        url = urljoin(endpoint.url, self.health_check_path)
+        try:
+            timeout = aiohttp.ClientTimeout(total=max(1.0, min(5.0, self.health_check_interval)))
+            async with session.get(url, timeout=timeout) as response:
+                ok = response.status == 200
+                reason = f"健康检查返回HTTP {response.status}"
+        except Exception as e:
+            ok = False
+            reason = f"健康检查异常: {e!r}"
+        if ok:
+            self._restore(endpoint)
+        elif endpoint.healthy:
+            self._eject(endpoint, reason)
+        return ok
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._health_task = None
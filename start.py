@@ -7,6 +7,7 @@
 import os
 import sys
 import subprocess
+import importlib.util
 from pathlib import Path
 
 def check_python_version():
@@ -19,18 +20,15 @@ def check_python_version():
     return True
 
 def check_dependencies():
-    """检查依赖包"""
-    try:
-        import dingtalk_stream
-        import alibabacloud_dingtalk
-        import requests
-        import aiohttp
-        print("✅ 依赖包检查通过")
-        return True
-    except ImportError as e:
-        print(f"❌ 缺少依赖包: {e}")
+    """检查依赖包（只查找不导入，不增加启动耗时）"""
+    missing = [name for name in ("dingtalk_stream", "requests", "aiohttp", "loguru", "dotenv")
+               if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f"❌ 缺少依赖包: {', '.join(missing)}")
         print("请运行: pip install -r requirements.txt")
         return False
+    print("✅ 依赖包检查通过")
+    return True
 
 def check_env_file():
     """检查环境变量文件"""
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+入站消息准入控制测试
+"""
+
+import asyncio
+
+from utils.admission_control import (
+    MIN_FINISH_PRUNE, PRIORITY_DM, PRIORITY_GROUP, PRIORITY_VIP, AdmissionController, FairQueue, PriorityClasses,
+    fair_flows, lane_key,
+)
+
+
+def test_limits_concurrency_and_sheds_when_full():
+    controller = AdmissionController(max_concurrency=2, max_queue_size=3)
+    peak = 0
+    active = 0
+
+    async def job():
+        nonlocal peak, active
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.02)
+        active -= 1
+
+    async def scenario():
+        results = [controller.submit(job) for _ in range(10)]
+        # 让worker取走前两个任务后再提交
+        await asyncio.sleep(0)
+        results.append(controller.submit(job))
+        await asyncio.sleep(0.2)
+        stats = controller.stats()
+        await controller.close()
+        return results, stats
+
+    results, stats = asyncio.run(scenario())
+    assert peak == 2
+    # 2个排队任务被worker取走前，队列只能容纳3个
+    assert results[:3] == [True] * 3 and results[3:10] == [False] * 7
+    assert results[10] is True
+    assert stats["accepted"] == 4 and stats["rejected"] == 7 and stats["completed"] == 4
+    assert stats["queue_depth"] == 0 and stats["running"] == 0
+    assert stats["max_wait_time"] >= 0.02
+
+
+def test_worker_survives_task_exception():
+    controller = AdmissionController(max_concurrency=1, max_queue_size=10)
+    done = []
+
+    async def failing():
+        raise RuntimeError("boom")
+
+    async def ok():
+        done.append(True)
+
+    async def scenario():
+        controller.submit(failing)
+        controller.submit(ok)
+        await asyncio.sleep(0.05)
+        await controller.close()
+
+    asyncio.run(scenario())
+    assert done == [True]
+
+
+def test_same_key_runs_in_order_and_lanes_are_reclaimed():
+    controller = AdmissionController(max_concurrency=4, max_queue_size=100)
+    events = []
+
+    async def job(key, index):
+        events.append(("start", key, index))
+        await asyncio.sleep(0.01 * (3 - index))
+        events.append(("end", key, index))
+
+    async def scenario():
+        for index in range(3):
+            for key in ("a", "b"):
+                controller.submit(job, key, index, key=key)
+        await asyncio.sleep(0.01)
+        # 两个会话并行，各自只有一个任务在执行
+        assert controller.running == 2
+        await asyncio.sleep(0.1)
+        lanes = controller.active_lanes
+        await controller.close()
+        return lanes
+
+    assert asyncio.run(scenario()) == 0
+    for key in ("a", "b"):
+        order = [(kind, index) for kind, k, index in events if k == key]
+        assert order == [("start", 0), ("end", 0), ("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+
+
+def test_lane_key_scopes():
+    assert lane_key("conversation", "u1", "c1") == "c1"
+    assert lane_key("conversation_user", "u1", "c1") == "c1:u1"
+    assert lane_key("none", "u1", "c1") is None
+
+
+def test_drain_waits_for_accepted_tasks():
+    controller = AdmissionController(max_concurrency=1, max_queue_size=10)
+    done = []
+
+    async def job(delay):
+        await asyncio.sleep(delay)
+        done.append(delay)
+
+    async def scenario():
+        assert await controller.drain(0.1)
+        controller.submit(job, 0.02)
+        controller.submit(job, 0.02)
+        # 排队中的任务也要等待
+        drained = await controller.drain(1)
+        controller.submit(job, 1)
+        timed_out = not await controller.drain(0.05)
+        asyncio.get_running_loop().call_later(0.01, controller.abort_drain)
+        aborted = not await controller.drain(1)
+        await controller.close()
+        return drained, timed_out, aborted
+
+    assert asyncio.run(scenario()) == (True, True, True)
+    assert done == [0.02, 0.02]
+
+
+def test_fair_queue_interleaves_flows_by_weight():
+    async def scenario():
+        queue = FairQueue()
+        for i in range(6):
+            queue.put(("heavy", i), ["user:heavy"])
+        queue.put(("light", 0), ["user:light"])
+        for i in range(4):
+            queue.put(("vip", i), ["user:vip"], weight=2)
+        return [await queue.get() for _ in range(len(queue))]
+
+    order = asyncio.run(scenario())
+    # 后到的用户不必等刷屏用户的任务全部处理完
+    assert order.index(("light", 0)) <= 2
+    # 权重为2的流获得两倍份额
+    leading = [flow for flow, _ in order[:7]]
+    assert leading.count("vip") == 2 * leading.count("heavy")
+
+
+def test_fair_queue_forgets_finished_flows_under_sustained_load():
+    async def scenario():
+        queue = FairQueue()
+        queue.put(("first", 0), ["user:first"])
+        sizes = []
+        # 队列始终非空，每个任务来自不同的用户
+        for i in range(5000):
+            queue.put(("user", i), [f"user:{i}", "conversation:c1"])
+            await queue.get()
+            sizes.append(len(queue._finish))
+        return sizes
+
+    sizes = asyncio.run(scenario())
+    assert max(sizes) <= 2 * MIN_FINISH_PRUNE
+
+
+def test_flooding_user_does_not_delay_others():
+    controller = AdmissionController(max_concurrency=1, max_queue_size=100, max_pending_per_flow=5)
+    started = []
+
+    async def job(user):
+        started.append(user)
+        await asyncio.sleep(0.005)
+
+    async def scenario():
+        flooded = [controller.submit(job, "heavy", flows=fair_flows("heavy", "c1")) for _ in range(8)]
+        light = controller.submit(job, "light", flows=fair_flows("light", "c2"))
+        await controller.drain(1)
+        stats = controller.stats()
+        await controller.close()
+        return flooded, light, stats
+
+    flooded, light, stats = asyncio.run(scenario())
+    # 单个用户超过排队上限的消息被拒绝，不影响其他用户
+    assert flooded == [True] * 5 + [False] * 3 and light is True
+    assert started.index("light") <= 1
+    assert stats["rejected"] == 3
+
+
+def test_priority_classes():
+    classes = PriorityClasses("vip:8,dm:3,bad", vip_conversations="vip-group", vip_users=" boss ")
+    assert classes.classify("2", "vip-group", "u1") == PRIORITY_VIP
+    assert classes.classify("1", "c1", "boss") == PRIORITY_VIP
+    assert classes.classify("1", "c1", "u1") == PRIORITY_DM
+    assert classes.classify("2", "c1", "u1") == PRIORITY_GROUP
+    assert classes.weight(PRIORITY_VIP) == 8 and classes.weight(PRIORITY_DM) == 3
+    assert classes.weight(PRIORITY_GROUP) == 1
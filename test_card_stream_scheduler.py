@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+AI卡片流式更新调度器测试
+"""
+
+import asyncio
+
+from utils.card_stream_scheduler import MAX_FINISH_FAILURES, CardStreamScheduler
+
+
+async def _run(segments, results=None, max_updates_per_second=20.0, delay=0.0, max_update_length=0):
+    updates = []
+    results = list(results or [])
+
+    async def send(update):
+        updates.append(update)
+        return results.pop(0) if results else True
+
+    scheduler = CardStreamScheduler(send, max_updates_per_second=max_updates_per_second,
+                                    max_update_length=max_update_length)
+    for segment in segments:
+        scheduler.push(segment)
+        await asyncio.sleep(delay)
+    await scheduler.finish()
+    return scheduler, updates
+
+
+def test_coalesces_and_sends_deltas():
+    segments = [f"第{i}句。" for i in range(50)]
+    scheduler, updates = asyncio.run(_run(segments, delay=0.002))
+
+    assert len(updates) < len(segments)
+    assert [u.seq for u in updates] == list(range(1, len(updates) + 1))
+    assert updates[0].append is False
+    assert all(u.append for u in updates[1:])
+    assert updates[-1].finished and not any(u.finished for u in updates[:-1])
+    assert "".join(u.content for u in updates) == "".join(segments) == scheduler.content
+
+
+def test_failed_update_falls_back_to_full_content():
+    segments = ["a", "b", "c"]
+    _, updates = asyncio.run(_run(segments, results=[True, False], delay=0.06))
+
+    assert updates[1].append is True
+    # 第二次失败后，下一次更新发送完整内容
+    assert updates[2].append is False
+    assert updates[2].content == "abc"
+    assert updates[-1].finished
+
+
+def test_finish_without_content_still_sends_final_update():
+    _, updates = asyncio.run(_run([]))
+    assert len(updates) == 1
+    assert updates[0].finished and updates[0].content == ""
+
+
+def test_long_content_is_paged_into_the_same_card():
+    segments = [f"第{i}行内容\n" for i in range(100)]
+    scheduler, updates = asyncio.run(_run(segments, max_updates_per_second=100.0, max_update_length=100))
+
+    assert len(updates) > 7
+    assert all(len(u.content) <= 100 for u in updates)
+    # 尽量在换行处分页
+    assert all(u.content.endswith("\n") for u in updates[:-1])
+    assert updates[0].append is False and all(u.append for u in updates[1:])
+    assert updates[-1].finished and not any(u.finished for u in updates[:-1])
+    assert "".join(u.content for u in updates) == "".join(segments) == scheduler.content
+
+
+def test_failed_page_is_resent_and_card_still_finishes():
+    segments = [f"第{i}行内容\n" for i in range(30)]
+
+    async def scenario():
+        updates = []
+        results = [True, False]
+
+        async def send(update):
+            updates.append(update)
+            return results.pop(0) if results else True
+
+        scheduler = CardStreamScheduler(send, max_updates_per_second=100.0, max_update_length=100)
+        for segment in segments:
+            scheduler.push(segment)
+        # 全部内容在结束时分页发送，第二页发送失败
+        await scheduler.finish()
+        return updates
+
+    updates = asyncio.run(scenario())
+    assert updates[1].append and not updates[1].finished
+    # 失败后从头重发完整内容，并最终结束卡片
+    assert updates[2].append is False and updates[2].content == updates[0].content
+    assert updates[-1].finished and not updates[-1].failed
+    assert "".join(u.content for u in updates[2:]) == "".join(segments)
+
+
+def test_card_is_finished_even_if_pages_keep_failing():
+    segments = [f"第{i}行内容\n" for i in range(30)]
+    _, updates = asyncio.run(_run(segments, results=[True] + [False] * 10, max_updates_per_second=100.0,
+                                  max_update_length=100))
+
+    assert updates[-1].finished and updates[-1].failed
+    assert sum(u.finished for u in updates) == 1
+    assert len(updates) == 1 + MAX_FINISH_FAILURES + 1
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+对话历史存储测试
+Redis后端使用fakeredis在本地模拟（未安装fakeredis时跳过）
+"""
+
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+from services.ai_service import AIService
+from services.conversation_memory import (
+    InMemoryHistoryStore, PromptBuilder, RedisHistoryStore, history_key
+)
+
+
+async def _append_rounds(store, key, rounds):
+    for i in range(rounds):
+        await store.append_turn(key, f"问题{i}", f"回答{i}")
+
+
+def test_memory_store_keeps_last_turns():
+    store = InMemoryHistoryStore(max_turns=3, ttl=60)
+
+    async def scenario():
+        await _append_rounds(store, "conv:1", 5)
+        return await store.get_history("conv:1")
+
+    history = asyncio.run(scenario())
+    assert [turn["user"] for turn in history] == ["问题2", "问题3", "问题4"]
+
+
+def test_memory_store_lru_and_ttl_eviction():
+    store = InMemoryHistoryStore(max_turns=3, ttl=60, max_conversations=2)
+
+    async def scenario():
+        await _append_rounds(store, "a", 1)
+        await _append_rounds(store, "b", 1)
+        await store.get_history("a")  # a 最近使用过
+        await _append_rounds(store, "c", 1)
+        assert await store.get_history("b") == []
+        assert len(store) == 2
+
+        store.ttl = 0.01
+        await _append_rounds(store, "d", 1)
+        time.sleep(0.02)
+        assert await store.get_history("d") == []
+
+    asyncio.run(scenario())
+
+
+def test_prompt_builder_respects_budget():
+    history = [{"user": "你好", "ai": "你好，有什么可以帮您？"},
+               {"user": "写个加法", "ai": "def add(a, b): return a + b"}]
+    builder = PromptBuilder(max_length=60)
+
+    prompt = builder.build(history, "再写个减法")
+    assert len(prompt) <= 60
+    assert prompt.endswith("用户：再写个减法\n")
+    # 预算只够最近一轮
+    assert "写个加法" in prompt and "你好" not in prompt
+
+    assert PromptBuilder(max_length=10).build(history, "再写个减法") == "用户：再写个减法\n"
+
+
+def test_history_key_scopes():
+    assert history_key("conversation", "u1", "c1") == "conv:c1"
+    assert history_key("user", "u1", "c1") == "user:u1"
+    assert history_key("conversation_user", "u1", "c1") == "conv:c1:user:u1"
+    assert history_key("user", None, "c1") is None
+
+
+def test_redis_store_with_fake_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    store = RedisHistoryStore(fakeredis.FakeAsyncRedis(), max_turns=2, ttl=60)
+
+    async def scenario():
+        await _append_rounds(store, "conv:1", 3)
+        await _append_rounds(store, "conv:2", 1)
+        history = await store.get_history("conv:1")
+        histories = await store.get_histories(["conv:1", "conv:2", "conv:3"])
+        ttl = await store.client.ttl(store._key("conv:1"))
+        await store.clear("conv:1")
+        cleared = await store.get_history("conv:1")
+        await store.close()
+        return history, histories, ttl, cleared
+
+    history, histories, ttl, cleared = asyncio.run(scenario())
+    assert [turn["ai"] for turn in history] == ["回答1", "回答2"]
+    assert len(histories["conv:2"]) == 1 and histories["conv:3"] == []
+    assert 0 < ttl <= 60
+    assert cleared == []
+
+
+def test_ai_service_sends_and_saves_history():
+    payloads = []
+
+    async def handler(request):
+        payloads.append(await request.json())
+        return web.json_response({"output": f"回答{len(payloads)}"})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/webhook", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        ai_service = AIService(f"http://127.0.0.1:{port}/webhook", history_store=InMemoryHistoryStore())
+        try:
+            await ai_service.get_ai_response("问题1", "u1", "c1")
+            await ai_service.get_ai_response("问题2", "u1", "c1")
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+    assert payloads[0]["history"] == []
+    assert payloads[1]["history"] == [{"user": "问题1", "ai": "回答1"}]
+    assert payloads[1]["message"] == "问题2"
+    assert payloads[1]["prompt"] == "用户：问题1\nAI：回答1\n用户：问题2\n"
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+钉钉OpenAPI异步客户端测试
+使用本地模拟的OpenAPI服务，验证token获取、群消息发送和AI卡片接口
+"""
+
+import asyncio
+
+from aiohttp import web
+
+from services.dingtalk_openapi import DingTalkOpenAPIClient, offload
+from services.dingtalk_service import DingTalkService
+from utils.token_manager import TokenManager
+
+
+async def _with_fake_openapi(scenario):
+    requests = []
+
+    async def record(request):
+        requests.append((request.method, request.path, request.headers.get("x-acs-dingtalk-access-token"),
+                         await request.json()))
+        if request.path == "/v1.0/oauth2/accessToken":
+            return web.json_response({"accessToken": "token-1", "expireIn": 7200})
+        if request.path == "/v1.0/robot/groupMessages/send" and request.headers.get("x-acs-dingtalk-access-token") != "token-1":
+            return web.json_response({"code": "InvalidAuthentication"}, status=401)
+        return web.json_response({"success": True})
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", record)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    client = DingTalkOpenAPIClient(f"http://127.0.0.1:{port}", pool_size=4, timeout=5)
+    try:
+        await scenario(client)
+    finally:
+        await client.close()
+        await runner.cleanup()
+    return requests
+
+
+def test_token_and_group_send():
+    async def scenario(client):
+        token_manager = TokenManager("key", "secret", client)
+        assert await token_manager.get_token() == "token-1"
+        # 第二次使用缓存
+        assert await token_manager.get_token() == "token-1"
+
+        service = DingTalkService("robot", client)
+        assert await service.send_markdown_message("token-1", "cid", "标题", "内容")
+        assert not await service.send_text_message("bad-token", "cid", "内容")
+
+    requests = asyncio.run(_with_fake_openapi(scenario))
+    paths = [path for _, path, _, _ in requests]
+    assert paths.count("/v1.0/oauth2/accessToken") == 1
+    _, _, token, body = requests[1]
+    assert token == "token-1"
+    assert body["msgKey"] == "sampleMarkdown"
+    assert body["robotCode"] == "robot" and body["openConversationId"] == "cid"
+
+
+def test_card_streaming():
+    async def scenario(client):
+        assert await client.create_and_deliver_card("token-1", {"outTrackId": "card-1"})
+        assert await client.streaming_card("token-1", "card-1", "content", "你好", append=True, finished=True)
+
+    requests = asyncio.run(_with_fake_openapi(scenario))
+    method, path, _, body = requests[1]
+    assert (method, path) == ("PUT", "/v1.0/card/streaming")
+    assert body["isFull"] is False and body["isFinalize"] is True and body["content"] == "你好"
+
+
+def test_offload_runs_in_thread():
+    assert asyncio.run(offload(sum, [1, 2, 3])) == 6
@@ -4,6 +4,7 @@
 用于测试消息发送功能
 """
 
+import asyncio
 import logging
 from utils.token_manager import TokenManager
 from services.dingtalk_service import DingTalkService
@@ -19,6 +20,9 @@ def setup_logger():
 
 def test_dingtalk_service():
     """测试钉钉服务"""
+    asyncio.run(_test_dingtalk_service())
+
+async def _test_dingtalk_service():
     logger = setup_logger()
     
     # 验证配置
@@ -36,7 +40,7 @@ def test_dingtalk_service():
     dingtalk_service = DingTalkService(Config.ROBOT_CODE)
     
     # 获取access_token
-    access_token = token_manager.get_token()
+    access_token = await token_manager.get_token()
     if not access_token:
         logger.error("获取access_token失败")
         return
@@ -69,7 +73,7 @@ def test_dingtalk_service():
         
         try:
             # 发送Markdown消息
-            success = dingtalk_service.send_markdown_message(
+            success = await dingtalk_service.send_markdown_message(
                 access_token=access_token,
                 open_conversation_id=test_conversation_id,
                 title=message['title'],
@@ -85,6 +89,7 @@ def test_dingtalk_service():
             logger.error(f"❌ 测试异常: {e}")
     
     logger.info("测试完成")
+    await dingtalk_service.client.close()
     logger.info("\n注意：请将 test_conversation_id 替换为实际的群会话ID进行测试")
 
 if __name__ == '__main__':
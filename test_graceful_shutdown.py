@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+优雅关闭测试：关闭时不再接受新消息，等待处理中的消息完成，超时未完成的卡片以失败状态结束
+"""
+
+import asyncio
+
+from dingtalk_stream import AckMessage, CallbackMessage, ChatbotMessage
+
+from config import Config
+from handlers.ai_card_handler import AICardHandler
+from utils.message_dedup import MessageDeduplicator
+
+
+class FakeTokenManager:
+    async def get_token(self):
+        return "token"
+
+    async def close(self):
+        pass
+
+
+class FakeOpenAPIClient:
+    def __init__(self):
+        self.updates = []
+
+    async def create_and_deliver_card(self, access_token, body):
+        return True
+
+    async def streaming_card(self, access_token, card_instance_id, key, content, append, finished, failed):
+        self.updates.append({"content": content, "finished": finished, "failed": failed})
+        return True
+
+
+class FakeAIService:
+    def __init__(self, hang: bool):
+        self.hang = hang
+
+    async def stream_reply(self, incoming_message):
+        yield "第一段"
+        if self.hang:
+            await asyncio.sleep(3600)
+        yield "第二段"
+
+
+def _message(msg_id: str) -> ChatbotMessage:
+    return ChatbotMessage.from_dict({
+        "msgId": msg_id, "conversationId": "c1", "conversationType": "1", "senderStaffId": "u1",
+        "msgtype": "text", "text": {"content": "你好"},
+    })
+
+
+def _handler(hang: bool):
+    openapi_client = FakeOpenAPIClient()
+    handler = AICardHandler(FakeAIService(hang), token_manager=FakeTokenManager(),
+                            openapi_client=openapi_client, deduplicator=MessageDeduplicator())
+    return handler, openapi_client
+
+
+def test_drain_lets_in_flight_reply_finish():
+    handler, openapi_client = _handler(hang=False)
+
+    async def scenario():
+        handler.admission.submit(handler._process_async, _message("m1"))
+        return await handler.drain(5)
+
+    assert asyncio.run(scenario())
+    assert openapi_client.updates[-1]["finished"] and not openapi_client.updates[-1]["failed"]
+    assert "第二段" in "".join(update["content"] for update in openapi_client.updates)
+
+
+def test_drain_timeout_marks_card_failed():
+    handler, openapi_client = _handler(hang=True)
+
+    async def scenario():
+        handler.admission.submit(handler._process_async, _message("m1"))
+        await asyncio.sleep(0.05)
+        return await handler.drain(0.1)
+
+    assert not asyncio.run(scenario())
+    last = openapi_client.updates[-1]
+    assert last["finished"] and last["failed"]
+    assert Config.SHUTDOWN_REPLY_MESSAGE in last["content"]
+
+
+def test_draining_handler_rejects_without_recording_dedup():
+    handler, _ = _handler(hang=False)
+    callback = CallbackMessage()
+    callback.data = {"msgId": "m1", "conversationId": "c1", "senderStaffId": "u1",
+                     "msgtype": "text", "text": {"content": "你好"}}
+
+    async def scenario():
+        handler.draining = True
+        status, _ = await handler.process(callback)
+        return status
+
+    assert asyncio.run(scenario()) == AckMessage.STATUS_SYSTEM_EXCEPTION
+    # 重新投递的消息不能被当作重复消息
+    assert handler.deduplicator.stats()["checked"] == 0
+
+
+def test_busy_reply_task_is_kept_until_sent():
+    handler, _ = _handler(hang=False)
+    handler.rate_limiter = None
+    handler._submit = lambda *args: False
+    replies = []
+    handler.reply_text = lambda text, incoming_message: replies.append(text)
+    callback = CallbackMessage()
+    callback.data = {"msgId": "m1", "conversationId": "c1", "senderStaffId": "u1",
+                     "msgtype": "text", "text": {"content": "你好"}}
+
+    async def scenario():
+        status, _ = await handler.process(callback)
+        # 后台回复执行期间保留引用，完成后释放
+        pending = len(handler._reply_tasks)
+        await asyncio.sleep(0.05)
+        return status, pending, len(handler._reply_tasks)
+
+    assert asyncio.run(scenario()) == (AckMessage.STATUS_OK, 1, 0)
+    assert replies == [Config.BUSY_REPLY_MESSAGE]
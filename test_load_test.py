@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+端到端压测脚本测试：用少量消息跑通替身服务和main.py
+"""
+
+import asyncio
+
+import pytest
+
+from benchmarks.fakes import parse_latency
+from benchmarks.load_test import build_parser, percentile, run_load_test
+
+
+def test_parse_latency_distributions():
+    assert parse_latency("0.2")() == 0.2
+    assert 0.1 <= parse_latency("uniform:0.1,0.3")() <= 0.3
+    assert parse_latency("lognormal:0.5,0.4")() > 0
+    with pytest.raises(ValueError):
+        parse_latency("pareto:1")
+
+
+def test_percentile_nearest_rank():
+    values = [i / 100 for i in range(1, 101)]
+    assert percentile(values, 50) == 0.5
+    assert percentile(values, 99) == 0.99
+    assert percentile([], 50) is None
+
+
+def test_load_test_end_to_end():
+    args = build_parser().parse_args([
+        "--messages", "20", "--rate", "0", "--conversations", "5",
+        "--n8n-latency", "fixed:0.01", "--n8n-chunks", "3", "--n8n-chunk-interval", "0.01",
+        "--openapi-latency", "fixed:0", "--drain-timeout", "30", "--stop-timeout", "2",
+    ])
+    result = asyncio.run(run_load_test(args))
+    assert result["drained"]
+    assert result["completed"] == 20 and result["lost"] == 0 and result["unmatched"] == 0
+    assert result["n8n_requests"] == 20
+    assert result["reply_latency"]["p99"] is not None and result["peak_rss_mb"]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+重复投递消息去重测试
+Redis共享使用fakeredis在本地模拟（未安装fakeredis时跳过）
+"""
+
+import asyncio
+import time
+
+import pytest
+from dingtalk_stream import CallbackMessage
+
+from handlers.ai_card_handler import AICardHandler
+from utils.message_dedup import MessageDeduplicator
+
+
+def test_duplicate_within_window_is_dropped():
+    dedup = MessageDeduplicator(ttl=60)
+
+    async def scenario():
+        return [await dedup.is_duplicate(msg_id) for msg_id in ("m1", "m2", "m1", None, "")]
+
+    assert asyncio.run(scenario()) == [False, False, True, False, False]
+    assert dedup.stats() == {"checked": 3, "duplicates": 1, "tracked": 2}
+
+
+def test_entries_expire_after_two_rotations():
+    dedup = MessageDeduplicator(ttl=0.01)
+
+    async def scenario():
+        await dedup.is_duplicate("m1")
+        time.sleep(0.015)
+        # 轮换一次后仍在上一代中
+        in_previous = await dedup.is_duplicate("m1")
+        time.sleep(0.025)
+        expired = await dedup.is_duplicate("m1")
+        return in_previous, expired
+
+    assert asyncio.run(scenario()) == (True, False)
+
+
+def test_shared_across_processes_with_fake_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    first = MessageDeduplicator(ttl=60, redis_client=fakeredis.FakeAsyncRedis(server=server))
+    second = MessageDeduplicator(ttl=60, redis_client=fakeredis.FakeAsyncRedis(server=server))
+
+    async def scenario():
+        return await first.is_duplicate("m1"), await second.is_duplicate("m1")
+
+    assert asyncio.run(scenario()) == (False, True)
+    assert second.duplicates == 1
+
+
+def test_card_handler_drops_redelivered_callback():
+    submitted = []
+
+    async def scenario():
+        handler = AICardHandler(ai_service=None, token_manager=object(),
+                                openapi_client=object(), deduplicator=MessageDeduplicator())
+        handler.admission.submit = lambda func, *args, **kwargs: submitted.append(args) or True
+        callback = CallbackMessage()
+        callback.data = {"msgId": "m1", "conversationId": "c1", "senderStaffId": "u1",
+                         "msgtype": "text", "text": {"content": "你好"}}
+        await handler.process(callback)
+        await handler.process(callback)
+        return handler.deduplicator.duplicates
+
+    assert asyncio.run(scenario()) == 1
+    assert len(submitted) == 1
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+指标与健康检查HTTP服务测试
+"""
+
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from services.ai_service import AIService
+from services.response_cache import ResponseCache
+from utils.metrics import (
+    CACHE_HITS_TOTAL, WEBHOOK_SECONDS, Counter, Histogram, MetricsRegistry, MetricsServer
+)
+
+
+def test_prometheus_text_format():
+    registry = MetricsRegistry()
+    latency = registry.register(Histogram("demo_seconds", "演示耗时", ["stage"], buckets=(0.1, 1)))
+    errors = registry.register(Counter("demo_errors_total", "演示错误"))
+    latency.observe(0.05, stage="a")
+    latency.observe(0.5, stage="a")
+    latency.observe(5, stage="a")
+    errors.inc()
+
+    text = registry.render()
+    assert "# TYPE demo_seconds histogram" in text
+    assert 'demo_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'demo_seconds_bucket{stage="a",le="1"} 2' in text
+    assert 'demo_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 'demo_seconds_count{stage="a"} 3' in text
+    assert "demo_errors_total 1" in text
+
+
+def test_metrics_and_health_endpoints():
+    server = MetricsServer("127.0.0.1", 0)
+    healthy = {"stream": True}
+    server.add_health_check("stream", lambda: (healthy["stream"], "已连接" if healthy["stream"] else "未连接"))
+    server.add_health_check("token", lambda: (True, "剩余有效期7000秒"))
+    server.start()
+
+    async def fetch(path):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{server.port}{path}") as response:
+                return response.status, await response.text()
+
+    try:
+        status, text = asyncio.run(fetch("/metrics"))
+        assert status == 200 and "dingtalk_bot_webhook_seconds" in text
+        assert asyncio.run(fetch("/healthz"))[0] == 200
+        healthy["stream"] = False
+        status, body = asyncio.run(fetch("/healthz"))
+        assert status == 503 and "未连接" in body
+    finally:
+        server.stop()
+
+
+def test_ai_service_records_webhook_latency_and_cache_hits():
+    async def handler(request):
+        return web.json_response({"output": "好的"})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/webhook", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        ai_service = AIService(f"http://127.0.0.1:{port}/webhook", response_cache=ResponseCache())
+        try:
+            await ai_service.get_ai_response("你好", "u1", "c1")
+            await ai_service.get_ai_response("你好", "u1", "c1")
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    requests_before = WEBHOOK_SECONDS.count(mode="request")
+    hits_before = CACHE_HITS_TOTAL.get()
+    asyncio.run(scenario())
+    assert WEBHOOK_SECONDS.count(mode="request") == requests_before + 1
+    assert CACHE_HITS_TOTAL.get() == hits_before + 1
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""
+微基准测试脚本测试：各项可以运行，基线读写和回退判断正确
+"""
+
+from benchmarks.micro import BENCHMARKS, compare, load_baseline, run_benchmarks, save_baseline
+
+
+def test_every_benchmark_runs():
+    results = run_benchmarks(list(BENCHMARKS), repeat=1, min_time=0.001)
+    assert set(results) == set(BENCHMARKS)
+    assert all(seconds > 0 for seconds in results.values())
+
+
+def test_baseline_roundtrip_and_regression_check(tmp_path):
+    path = tmp_path / "baseline.json"
+    results = run_benchmarks(["extract_user_message"], repeat=1, min_time=0.01)
+    save_baseline({"encode_msg_param": 1e-5}, path)
+    save_baseline(results, path)
+    baseline = load_baseline(path)
+    assert set(baseline) == {"encode_msg_param", "extract_user_message"}
+
+    assert compare({"encode_msg_param": 1.2e-5}, baseline, threshold=0.25) == []
+    assert compare({"encode_msg_param": 1.3e-5}, baseline, threshold=0.25) == ["encode_msg_param"]
+    assert compare({"new_benchmark": 1.0}, baseline, threshold=0.25) == []
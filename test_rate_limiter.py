@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+限流与每日配额测试：滑动窗口估算、每日配额、多进程共享计数、超出限制时不调用n8n
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from dingtalk_stream import CallbackMessage
+
+from handlers.ai_card_handler import AICardHandler
+from handlers.chatbot_handler import AIChatbotHandler
+from utils import rate_limiter
+from utils.local_state import LocalStateClient, LocalStateServer
+from utils.message_dedup import MessageDeduplicator
+from utils.rate_limiter import SCOPE_CONVERSATION, SCOPE_USER, Limit, RateLimiter
+from test_graceful_shutdown import FakeAIService, FakeOpenAPIClient, FakeTokenManager
+
+
+class _Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _callback(msg_id: str, user_id: str) -> CallbackMessage:
+    callback = CallbackMessage()
+    callback.data = {
+        "msgId": msg_id, "conversationId": "c1", "conversationType": "2", "senderStaffId": user_id,
+        "msgtype": "text", "text": {"content": "你好"},
+    }
+    return callback
+
+
+def test_sliding_window_counts_previous_window_proportionally(monkeypatch):
+    clock = _Clock(1000.0)
+    monkeypatch.setattr(rate_limiter.time, "time", clock)
+    limiter = RateLimiter([Limit("user_rate", SCOPE_USER, 4, 10, True)])
+
+    async def scenario():
+        results = [await limiter.check("u1", "c1") for _ in range(5)]
+        # 其他用户不受影响
+        results.append(await limiter.check("u2", "c1"))
+        # 进入下一窗口的一半：上一窗口的4次按一半计入，还剩2个名额
+        clock.now = 1015.0
+        results += [await limiter.check("u1", "c1") for _ in range(3)]
+        clock.now = 1030.0
+        results.append(await limiter.check("u1", "c1"))
+        return results
+
+    assert asyncio.run(scenario()) == [None] * 4 + ["user_rate", None, None, None, "user_rate", None]
+    assert limiter.stats()["limited"] == 2
+
+
+def test_daily_quota_resets_at_day_boundary(monkeypatch):
+    clock = _Clock(86400 * 100 + 10)
+    monkeypatch.setattr(rate_limiter.time, "time", clock)
+    limiter = RateLimiter([
+        Limit("user_rate", SCOPE_USER, 0, 60, True),
+        Limit("conversation_daily", SCOPE_CONVERSATION, 2, 86400, False),
+    ])
+
+    async def scenario():
+        results = [await limiter.check(f"u{i}", "c1") for i in range(3)]
+        clock.now += 86400 - 20
+        results.append(await limiter.check("u9", "c1"))
+        clock.now += 20
+        results.append(await limiter.check("u9", "c1"))
+        return results
+
+    # 被拒绝的请求不占用名额，第二天重新计数
+    assert asyncio.run(scenario()) == [None, None, "conversation_daily", "conversation_daily", None]
+    assert len(limiter.limits) == 1
+
+
+def test_workers_share_limits_through_local_state(tmp_path):
+    server = LocalStateServer(str(tmp_path / "state.sock"))
+    server.start()
+    limits = [Limit("user_rate", SCOPE_USER, 3, 60, True), Limit("user_daily", SCOPE_USER, 100, 86400, False)]
+    first = RateLimiter(limits, redis_client=LocalStateClient(server.path))
+    second = RateLimiter(limits, redis_client=LocalStateClient(server.path))
+
+    async def scenario():
+        try:
+            results = [await first.check("u1", "c1"), await second.check("u1", "c1"),
+                       await first.check("u1", "c1"), await second.check("u1", "c1")]
+            results.append(await first.check("u1", "c1"))
+            return results
+        finally:
+            await first.close()
+            await second.close()
+
+    try:
+        assert asyncio.run(scenario()) == [None, None, None, "user_rate", "user_rate"]
+        # 被拒绝的请求已回滚，不占用名额
+        assert sorted(value for value, _ in server._data.values()) == [3, 3]
+    finally:
+        server.stop()
+
+
+def test_card_handler_replies_locally_when_limited():
+    limiter = RateLimiter([Limit("user_rate", SCOPE_USER, 1, 60, True)])
+    handler = AICardHandler(FakeAIService(hang=False), token_manager=FakeTokenManager(),
+                            openapi_client=FakeOpenAPIClient(), deduplicator=MessageDeduplicator(),
+                            rate_limiter=limiter)
+    submitted = []
+    replies = []
+    handler._submit = lambda incoming_message, *args: submitted.append(incoming_message.message_id) or True
+    handler.reply_text = lambda text, incoming_message: replies.append(text)
+
+    async def scenario():
+        for msg_id in ("m1", "m2"):
+            await handler.process(_callback(msg_id, "u1"))
+        await handler.process(_callback("m3", "u2"))
+        # 后台回复执行期间保留引用，完成后释放
+        pending = len(handler._reply_tasks)
+        await asyncio.sleep(0.05)
+        await handler.close()
+        return pending, len(handler._reply_tasks)
+
+    assert asyncio.run(scenario()) == (1, 0)
+    assert submitted == ["m1", "m3"]
+    assert len(replies) == 1 and "频繁" in replies[0]
+
+
+def test_chatbot_handler_keeps_limited_reply_task():
+    handler = AIChatbotHandler.__new__(AIChatbotHandler)
+    handler.config = SimpleNamespace(RATE_LIMIT_MESSAGE="请求太频繁", DAILY_QUOTA_MESSAGE="今日额度已用完")
+    handler.deduplicator = None
+    handler.journal = None
+    handler.rate_limiter = RateLimiter([Limit("user_rate", SCOPE_USER, 1, 60, True)])
+    handler._reply_tasks = set()
+    submitted = []
+    replies = []
+    handler._submit = lambda incoming_message, *args: submitted.append(incoming_message.message_id) or True
+    handler.reply_text = lambda text, incoming_message: replies.append(text)
+
+    async def scenario():
+        for msg_id in ("m1", "m2"):
+            await handler.process(_callback(msg_id, "u1"))
+        # 后台回复执行期间保留引用，完成后释放
+        pending = len(handler._reply_tasks)
+        await asyncio.sleep(0.05)
+        return pending, len(handler._reply_tasks)
+
+    assert asyncio.run(scenario()) == (1, 0)
+    assert submitted == ["m1"] and replies == ["请求太频繁"]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+进行中请求合并测试
+"""
+
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from services.ai_service import AIService
+from services.request_coalescer import RequestCoalescer
+
+
+def test_call_shares_one_execution():
+    coalescer = RequestCoalescer()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return f"结果{calls}"
+
+    async def scenario():
+        results = await asyncio.gather(*(coalescer.call("k", fetch) for _ in range(5)))
+        later = await coalescer.call("k", fetch)
+        return results, later
+
+    results, later = asyncio.run(scenario())
+    assert results == ["结果1"] * 5
+    # 请求结束后不再合并，不会拿到旧结果
+    assert later == "结果2"
+    assert coalescer.coalesced == 4 and coalescer.in_flight == 0
+
+
+def test_stream_late_joiner_replays_chunks():
+    coalescer = RequestCoalescer()
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def produce():
+            yield "你"
+            yield "好"
+            await gate.wait()
+            yield "！"
+
+        async def consume():
+            return [chunk async for chunk in coalescer.stream("k", produce)]
+
+        first = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        gate.set()
+        return await first, await second
+
+    first, second = asyncio.run(scenario())
+    assert first == second == ["你", "好", "！"]
+    assert coalescer.coalesced == 1
+
+
+def test_stream_error_reaches_all_waiters():
+    coalescer = RequestCoalescer()
+
+    async def produce():
+        yield "部分"
+        await asyncio.sleep(0.01)
+        raise RuntimeError("上游中断")
+
+    async def consume(received):
+        async for chunk in coalescer.stream("k", produce):
+            received.append(chunk)
+
+    async def scenario():
+        received = [[], []]
+        results = await asyncio.gather(*(consume(r) for r in received), return_exceptions=True)
+        return received, results
+
+    received, results = asyncio.run(scenario())
+    assert received == [["部分"], ["部分"]]
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_ai_service_coalesces_identical_questions(streaming):
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return web.json_response({"output": "请在OA系统提交请假申请"})
+
+    async def ask(ai_service, user_id):
+        if streaming:
+            return "".join([d async for d in ai_service.stream_ai_response("怎么请假？", user_id, user_id)])
+        return await ai_service.get_ai_response("怎么请假", user_id, user_id)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/webhook", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        ai_service = AIService(f"http://127.0.0.1:{port}/webhook", coalescer=RequestCoalescer())
+        try:
+            return await asyncio.gather(*(ask(ai_service, f"u{i}") for i in range(3)))
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    answers = asyncio.run(scenario())
+    assert answers == ["请在OA系统提交请假申请"] * 3
+    assert calls == 1
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+n8n webhook重试与熔断测试
+"""
+
+import gc
+import asyncio
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+
+from config import Config
+from services.ai_service import AIService
+from utils.resilience import CircuitBreaker, HedgePolicy, RetryPolicy
+
+
+def test_retry_delay_is_jittered_and_capped():
+    policy = RetryPolicy(base_delay=0.5, max_delay=2)
+    delays = [policy.delay(attempt) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= delay <= 2 for delay in delays)
+    assert len(set(delays)) > 1
+    assert policy.is_retryable(503) and not policy.is_retryable(400)
+
+
+def test_circuit_breaker_half_open_single_probe():
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.01)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    time.sleep(0.015)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()  # 探测进行中，其他请求快速失败
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    time.sleep(0.015)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_hedge_policy_percentile_and_budget():
+    policy = HedgePolicy(percentile=90, budget=0.05, min_samples=10)
+    for i in range(9):
+        policy.observe(i / 10)
+    assert policy.delay() is None
+    policy.observe(0.9)
+    assert policy.delay() == 0.9
+
+    for _ in range(100):
+        policy.record_request()
+    hedges = sum(policy.try_acquire() for _ in range(100))
+    assert hedges == 5
+
+
+async def _serve(handler):
+    app = web.Application()
+    app.router.add_post("/webhook", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/webhook"
+
+
+def test_get_ai_response_retries_then_fails_fast():
+    statuses = [503, 200]
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        status = statuses.pop(0) if statuses else 503
+        if status != 200:
+            return web.Response(status=status, text="busy")
+        return web.json_response({"output": "好的"})
+
+    async def scenario():
+        runner, url = await _serve(handler)
+        ai_service = AIService(url)
+        ai_service.retry_policy = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.01)
+        ai_service.circuit_breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60)
+        try:
+            first = await ai_service.get_ai_response("你好", "u1", "c1")
+            # 持续503：两次失败后熔断，第三次尝试不再发出
+            second = await ai_service.get_ai_response("你好", "u1", "c1")
+            calls_before = calls
+            started = time.monotonic()
+            third = await ai_service.get_ai_response("你好", "u1", "c1")
+            return first, second, third, calls - calls_before, time.monotonic() - started, ai_service.degraded
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    first, second, third, extra_calls, elapsed, degraded = asyncio.run(scenario())
+    assert first == "好的"
+    assert second is None and third is None
+    assert calls == 4 and extra_calls == 0
+    assert elapsed < 0.5 and degraded
+
+
+def test_stream_reply_returns_degraded_message_when_open():
+    async def scenario():
+        ai_service = AIService("http://127.0.0.1:9/webhook")
+        ai_service.circuit_breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=60)
+        ai_service.circuit_breaker.record_failure()
+
+        class Message:
+            text = type("Text", (), {"content": "你好"})()
+            sender_staff_id = "u1"
+            conversation_id = "c1"
+
+        try:
+            return [segment async for segment in ai_service.stream_reply(Message())]
+        finally:
+            await ai_service.close()
+
+    assert asyncio.run(scenario()) == [Config.N8N_DEGRADED_MESSAGE]
+
+
+def test_slow_request_is_hedged_and_loser_cancelled():
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(1)
+        return web.json_response({"output": f"回答{calls}"})
+
+    async def scenario():
+        runner, url = await _serve(handler)
+        ai_service = AIService(url)
+        ai_service.hedge_policy = HedgePolicy(percentile=50, budget=1, min_samples=1)
+        ai_service.hedge_policy.observe(0.05)
+        try:
+            started = time.monotonic()
+            answer = await ai_service.get_ai_response("你好", "u1", "c1")
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(0.05)
+            return answer, elapsed, ai_service.pool.endpoints[0].outstanding
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    answer, elapsed, outstanding = asyncio.run(scenario())
+    assert answer == "回答2"
+    assert elapsed < 0.5
+    assert outstanding == 0 and calls == 2
+
+
+def test_slow_stream_headers_are_hedged():
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        call = calls
+        if call == 1:
+            await asyncio.sleep(1)
+        response = web.StreamResponse(headers={"Content-Type": "text/plain"})
+        await response.prepare(request)
+        await response.write(f"回答{call}".encode())
+        await response.write_eof()
+        return response
+
+    async def scenario():
+        runner, url = await _serve(handler)
+        ai_service = AIService(url)
+        ai_service.stream_hedge_policy = HedgePolicy(percentile=50, budget=1, min_samples=1)
+        ai_service.stream_hedge_policy.observe(0.05)
+        try:
+            started = time.monotonic()
+            answer = "".join([delta async for delta in ai_service.stream_ai_response("你好", "u1", "c1")])
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(0.05)
+            return answer, elapsed, ai_service.pool.endpoints[0].outstanding
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    answer, elapsed, outstanding = asyncio.run(scenario())
+    assert answer == "回答2"
+    assert elapsed < 0.5
+    assert outstanding == 0 and calls == 2
+
+
+def test_failed_hedge_loser_exception_is_retrieved():
+    errors = []
+
+    async def scenario():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context["message"]))
+        ai_service = AIService(["http://127.0.0.1:9/a", "http://127.0.0.1:9/b"])
+        primary_endpoint = ai_service.pool.endpoints[0]
+        ai_service.hedge_policy = HedgePolicy(percentile=50, budget=1, min_samples=1)
+        ai_service.hedge_policy.observe(0.01)
+        ai_service.stream_hedge_policy = HedgePolicy(percentile=50, budget=1, min_samples=1)
+        ai_service.stream_hedge_policy.observe(0.01)
+        answers = []
+        try:
+            for _ in range(10):
+                release = asyncio.Event()
+
+                async def finish(endpoint, result):
+                    # 两个请求在同一轮事件循环中结束，原始请求失败、对冲请求成功
+                    await release.wait()
+                    if endpoint is primary_endpoint:
+                        raise aiohttp.ClientError("连接被重置")
+                    return result
+
+                async def post_once(session, endpoint, payload, headers, timeout):
+                    return await finish(endpoint, (200, "回答"))
+
+                async def open_stream(session, endpoint, payload, headers, timeout):
+                    return await finish(endpoint, (endpoint, 0.0, SimpleNamespace(status=200)))
+
+                ai_service._post_webhook_once = post_once
+                ai_service._open_stream = open_stream
+                asyncio.get_running_loop().call_later(0.05, release.set)
+                answers.append(await ai_service._post_webhook_hedged(None, primary_endpoint, [primary_endpoint],
+                                                                    {}, {}, 1))
+                release = asyncio.Event()
+                asyncio.get_running_loop().call_later(0.05, release.set)
+                _, _, response = await ai_service._open_stream_hedged(None, primary_endpoint, [primary_endpoint],
+                                                                     {}, {}, 1)
+                answers.append(response.status)
+            # 落败的请求都已结束
+            leftover = len(asyncio.all_tasks()) - 1
+            gc.collect()
+            return answers, leftover
+        finally:
+            await ai_service.close()
+
+    answers, leftover = asyncio.run(scenario())
+    assert answers == [(200, "回答"), 200] * 10
+    assert leftover == 0 and errors == []
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+重复问题回复缓存测试
+"""
+
+import asyncio
+import time
+
+from aiohttp import web
+
+from services.ai_service import AIService
+from services.response_cache import ResponseCache, normalize_message, workflow_cache_allowed
+
+
+def test_normalize_message():
+    assert normalize_message("  怎么请假？ ") == normalize_message("怎么请假")
+    assert normalize_message("VPN  地址!") == normalize_message("ｖｐｎ 地址")
+
+
+def test_scopes():
+    assert ResponseCache(scope="global").make_key("你好", "u1", "c1") == "global:你好"
+    assert ResponseCache(scope="conversation").make_key("你好", "u1", "c1") == "conv:c1:你好"
+    assert ResponseCache(scope="user").make_key("你好", None, "c1") is None
+    assert ResponseCache().make_key("？") is None
+
+
+def test_lru_ttl_and_memory_cap():
+    cache = ResponseCache(ttl=60, max_entries=2, max_bytes=1000)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+    assert cache.get("b") is None and cache.get("a") == "1"
+
+    cache.set("big", "x" * 997)
+    assert len(cache) == 1 and cache.stats()["bytes"] <= 1000
+
+    cache.ttl = 0.01
+    cache.set("d", "4")
+    time.sleep(0.02)
+    assert cache.get("d") is None
+    assert cache.stats()["hits"] == 2
+
+
+def test_workflow_allow_and_deny():
+    url = "https://n8n.example.com/webhook/faq-123"
+    assert workflow_cache_allowed(url)
+    assert workflow_cache_allowed(url, allowlist="faq-123,other")
+    assert not workflow_cache_allowed(url, allowlist="other")
+    assert not workflow_cache_allowed(url, allowlist="faq-123", denylist="faq")
+
+
+def test_cached_answer_served_on_markdown_and_card_paths():
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        return web.json_response({"output": "请在OA系统提交请假申请"})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/webhook", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        ai_service = AIService(f"http://127.0.0.1:{port}/webhook", response_cache=ResponseCache())
+        try:
+            first = await ai_service.get_ai_response("怎么请假？", "u1", "c1")
+            streamed = [delta async for delta in ai_service.stream_ai_response("怎么请假", "u2", "c2")]
+            return first, streamed, ai_service.response_cache.stats()
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    first, streamed, stats = asyncio.run(scenario())
+    assert first == "请在OA系统提交请假申请"
+    assert streamed == [first]
+    assert calls == 1
+    assert stats["hits"] == 1 and stats["misses"] == 1
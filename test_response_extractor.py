@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+n8n响应回复字段提取测试
+"""
+
+import json
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+from services.ai_service import AIService
+from utils.response_extractor import SKIP_LIMIT, ResponseExtractor, compile_paths
+
+
+def test_compile_paths():
+    assert compile_paths("output, data.reply,choices.0.message.content") == [
+        ("output",), ("data", "reply"), ("choices", 0, "message", "content")
+    ]
+    with pytest.raises(ValueError):
+        compile_paths("data..reply")
+    with pytest.raises(ValueError):
+        compile_paths(" , ")
+
+
+def test_extract_follows_priority_and_lists():
+    extractor = ResponseExtractor("output,data.reply,message")
+    assert extractor.extract({"message": "m", "output": "o"}) == "o"
+    assert extractor.extract([{"data": {"reply": "r"}, "message": "m"}]) == "r"
+    assert extractor.extract({"output": {"nested": True}, "message": "m"}) == "m"
+    assert extractor.extract("纯文本") == "纯文本"
+    assert extractor.extract({"other": 1}) is None
+    assert ResponseExtractor("1.text").extract([{"text": "a"}, {"text": "b"}]) == "b"
+
+
+def test_parse_large_body_matches_full_decode():
+    extractor = ResponseExtractor()
+    steps = [{"observation": "o\"{[" * 50, "n": [1, None, {"a": True}]} for _ in range(2000)]
+    for payload in (
+        [{"output": "回复", "intermediateSteps": steps}],
+        {"intermediateSteps": steps, "message": "提示", "output": "回复"},
+        {"message": "提示", "padding": "x" * (SKIP_LIMIT * 2)},
+    ):
+        body = json.dumps(payload, ensure_ascii=False)
+        assert extractor.parse(body) == extractor.extract(payload)
+        assert extractor.parse(body.encode("utf-8")) == extractor.extract(payload)
+    assert extractor.parse("") is None
+    with pytest.raises(ValueError):
+        extractor.parse('{"x": [' + "1," * SKIP_LIMIT)
+
+
+def test_repeated_top_level_key_keeps_first_value_at_any_size():
+    extractor = ResponseExtractor()
+    padding = "x" * 100
+    bodies = [
+        '{"output": "第一次", "message": "提示", "output": "第二次"}',
+        # 超过完整读取上限，增量扫描
+        '[{"output": "第一次", "padding": "%s", "output": "第二次"}]' % (padding * 1000),
+        # 要跳过的字段超过SKIP_LIMIT，改为完整解析
+        '{"padding": "%s", "output": "第一次", "output": "第二次"}' % ("x" * (SKIP_LIMIT * 2)),
+    ]
+    for body in bodies:
+        assert extractor.parse(body) == "第一次"
+        assert extractor.parse(body.encode("utf-8")) == "第一次"
+    # 嵌套对象中的同名字段不影响顶层字段
+    assert extractor.parse('{"data": {"output": "内层"}, "output": "回复"}') == "回复"
+
+
+def test_read_stops_once_reply_is_extracted():
+    async def handler(request):
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        await response.write('[{"output": "流式回复", "intermediateSteps": ['.encode("utf-8"))
+        # n8n附带的执行数据迟迟没有发完
+        await asyncio.sleep(1.5)
+        await response.write(b"]}]")
+        return response
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/webhook", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        ai_service = AIService(f"http://127.0.0.1:{port}/webhook")
+        try:
+            started = time.monotonic()
+            answer = await ai_service.get_ai_response("你好", "u1", "c1")
+            return answer, time.monotonic() - started
+        finally:
+            await ai_service.close()
+            await runner.shutdown()
+            await runner.cleanup()
+
+    answer, elapsed = asyncio.run(scenario())
+    assert answer == "流式回复"
+    assert elapsed < 1
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+群消息发送调度测试：按群和按应用限流、回复优先于错误提示、排队消息合并
+"""
+
+import time
+import asyncio
+
+from utils.send_scheduler import PRIORITY_NOTICE, PRIORITY_REPLY, GroupSendScheduler, TokenBucket
+
+
+class _Recorder:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sent = []
+
+    async def __call__(self, access_token, conversation_id, msg_key, params):
+        self.sent.append((time.monotonic(), access_token, conversation_id, msg_key, params))
+        await asyncio.sleep(self.delay)
+        return True
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=2)
+    now = bucket.updated
+    bucket.take(now)
+    bucket.take(now)
+    assert abs(bucket.wait_time(now) - 0.5) < 1e-6
+    assert bucket.wait_time(now + 0.5) == 0
+    assert TokenBucket(rate=0, burst=1).wait_time(now) == 0
+
+
+def test_group_limit_does_not_block_other_groups():
+    recorder = _Recorder()
+    scheduler = GroupSendScheduler(recorder, group_rate=10, group_burst=1, app_rate=0, merge=False)
+
+    async def scenario():
+        start = time.monotonic()
+        results = await asyncio.gather(
+            scheduler.submit("t", "g1", "sampleText", {"content": "1"}),
+            scheduler.submit("t", "g1", "sampleText", {"content": "2"}),
+            scheduler.submit("t", "g2", "sampleText", {"content": "3"}),
+        )
+        await scheduler.close()
+        return start, results
+
+    start, results = asyncio.run(scenario())
+    assert results == [True, True, True]
+    sent_at = {params["content"]: at - start for at, _, _, _, params in recorder.sent}
+    assert sent_at["1"] < 0.05 and sent_at["3"] < 0.05
+    # 第二条等待g1的令牌补充（每秒10个）
+    assert 0.08 <= sent_at["2"] < 0.3
+
+
+def test_app_limit_applies_across_groups():
+    recorder = _Recorder()
+    scheduler = GroupSendScheduler(recorder, group_rate=0, app_rate=20, app_burst=1, merge=False)
+
+    async def scenario():
+        await asyncio.gather(*(scheduler.submit("t", f"g{i}", "sampleText", {"content": str(i)})
+                               for i in range(4)))
+        await scheduler.close()
+
+    asyncio.run(scenario())
+    times = [at for at, *_ in recorder.sent]
+    assert times[-1] - times[0] >= 0.13
+
+
+def test_replies_are_sent_before_notices():
+    recorder = _Recorder()
+    scheduler = GroupSendScheduler(recorder, group_rate=20, group_burst=1, app_rate=0, merge=False)
+
+    async def scenario():
+        await asyncio.gather(
+            scheduler.submit("t", "g", "sampleText", {"content": "first"}),
+            scheduler.submit("t", "g", "sampleText", {"content": "notice"}, priority=PRIORITY_NOTICE),
+            scheduler.submit("t", "g", "sampleMarkdown", {"title": "", "text": "reply"}, priority=PRIORITY_REPLY),
+        )
+        await scheduler.close()
+
+    asyncio.run(scenario())
+    order = [params.get("content", params.get("text")) for *_, params in recorder.sent]
+    assert order == ["first", "reply", "notice"]
+
+
+def test_queued_messages_to_same_group_are_merged():
+    recorder = _Recorder()
+    scheduler = GroupSendScheduler(recorder, group_rate=10, group_burst=1, app_rate=0,
+                                   merge=True, merge_max_length=30)
+
+    async def scenario():
+        first = await scheduler.submit("old", "g", "sampleMarkdown", {"title": "t1", "text": "a"})
+        # 群令牌用完后排队的消息
+        results = await asyncio.gather(
+            scheduler.submit("old", "g", "sampleMarkdown", {"title": "t2", "text": "b"}),
+            scheduler.submit("old", "g", "sampleText", {"content": "text"}),
+            scheduler.submit("new", "g", "sampleMarkdown", {"title": "t3", "text": "c"}),
+            # 超出合并长度，单独发送
+            scheduler.submit("new", "g", "sampleMarkdown", {"title": "t4", "text": "dddd"}),
+        )
+        await scheduler.close()
+        return [first] + results
+
+    assert asyncio.run(scenario()) == [True] * 5
+    sent = [(token, msg_key, params) for _, token, _, msg_key, params in recorder.sent]
+    assert sent == [
+        ("old", "sampleMarkdown", {"title": "t1", "text": "a"}),
+        # 合并后每一段保留各自的标题
+        ("new", "sampleMarkdown", {"title": "t2 等2条回复", "text": "**t2**\n\nb\n\n---\n\n**t3**\n\nc"}),
+        ("old", "sampleText", {"content": "text"}),
+        ("new", "sampleMarkdown", {"title": "t4", "text": "dddd"}),
+    ]
+    assert scheduler.merged == 1
+
+
+def test_close_fails_queued_messages():
+    recorder = _Recorder()
+    scheduler = GroupSendScheduler(recorder, group_rate=0.01, group_burst=1, app_rate=0, merge=False)
+
+    async def scenario():
+        first = asyncio.ensure_future(scheduler.submit("t", "g", "sampleText", {"content": "1"}))
+        second = asyncio.ensure_future(scheduler.submit("t", "g", "sampleText", {"content": "2"}))
+        await first
+        await scheduler.close()
+        return await second
+
+    assert asyncio.run(scenario()) is False
+    assert len(recorder.sent) == 1
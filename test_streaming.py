@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+流式读取测试
+覆盖Markdown增量分段、SSE/NDJSON解码，以及AIService对本地模拟n8n流式响应的读取
+"""
+
+import asyncio
+import json
+
+from aiohttp import web
+
+from types import SimpleNamespace
+
+from handlers.chatbot_handler import AIChatbotHandler
+from services.ai_service import AIService
+from services.dingtalk_service import DingTalkService
+from services.response_cache import ResponseCache
+from utils.send_scheduler import GroupSendScheduler
+from utils.markdown_segmenter import MarkdownPaginator, MarkdownSegmenter
+from utils.resilience import RetryPolicy
+from utils.stream_decoder import SSEDecoder, NDJSONDecoder, extract_stream_text
+
+
+def _segment(chunks):
+    segmenter = MarkdownSegmenter()
+    segments = []
+    for chunk in chunks:
+        segments.extend(segmenter.feed(chunk))
+    tail = segmenter.flush()
+    if tail:
+        segments.append(tail)
+    return segments
+
+
+def test_segmenter_splits_sentences():
+    segments = _segment(["你好。今天", "天气不错！要出门吗？", "\n好的"])
+    assert segments == ["你好。", "今天天气不错！", "要出门吗？", "\n", "好的"]
+
+
+def test_segmenter_keeps_code_block_whole():
+    text = "代码如下：\n```python\nprint('你好。')\n\nx = 1\n```\n完成。"
+    # 逐字喂入，模拟最碎的流式分块
+    segments = _segment(list(text))
+    assert "".join(segments) == text
+    assert "```python\nprint('你好。')\n\nx = 1\n```\n" in segments
+
+
+def test_segmenter_ignores_fence_after_sentence_cut():
+    segments = _segment(["好的。```\n", "下一行。"])
+    assert "".join(segments) == "好的。```\n下一行。"
+    assert segments[-1] == "下一行。"
+
+
+def _paginate(text, page_size, chunk=7):
+    paginator = MarkdownPaginator(page_size)
+    pages = []
+    for i in range(0, len(text), chunk):
+        pages.extend(paginator.feed(text[i:i + chunk]))
+    return pages + paginator.flush()
+
+
+def test_paginator_splits_between_blocks():
+    paragraph = "这是一段很长的说明文字。" * 6 + "\n"
+    code = "```python\n" + "".join(f"print({i})\n" for i in range(6)) + "```\n"
+    table = "| 名称 | 数量 |\n|---|---|\n" + "".join(f"| 项目{i} | {i} |\n" for i in range(6))
+    text = "\n".join([paragraph, code, table, paragraph, code, table])
+    pages = _paginate(text, 150)
+
+    assert len(pages) > 2
+    assert "".join(pages) == text
+    assert all(len(page) <= 150 for page in pages)
+    # 不会切开代码块和表格
+    assert all(page.count("```") % 2 == 0 for page in pages)
+    assert sum(page.count("| 项目") for page in pages if "|---|" in page) == 12
+
+
+def test_paginator_emits_pages_before_flush():
+    paginator = MarkdownPaginator(100)
+    pages = paginator.feed(("第一段内容。" * 10 + "\n\n") * 3)
+    assert pages and all(len(page) <= 100 for page in pages)
+
+
+def test_paginator_reopens_oversized_code_block_and_table():
+    code = "```\n" + "".join(f"line {i}\n" for i in range(60)) + "```\n"
+    pages = _paginate(code, 120)
+    assert len(pages) > 3
+    assert all(page.startswith("```\n") and page.endswith("```\n") for page in pages)
+    assert all(len(page) <= 120 for page in pages)
+
+    table = "| a | b |\n|---|---|\n" + "".join(f"| {i} | x |\n" for i in range(40))
+    pages = _paginate(table, 120)
+    assert all(page.startswith("| a | b |\n|---|---|\n") for page in pages)
+    rows = [line for page in pages for line in page.splitlines()[2:]]
+    assert rows == table.splitlines()[2:]
+
+
+def test_chatbot_handler_sends_long_reply_in_pages():
+    sent = []
+    reply = "".join(f"第{i}段：这是一段比较长的回复内容。\n\n" for i in range(40))
+
+    async def stream_ai_response(user_message, user_id, conversation_id):
+        for i in range(0, len(reply), 50):
+            yield reply[i:i + 50]
+
+    async def send(access_token, conversation_id, msg_key, params):
+        sent.append(params)
+        return True
+
+    async def get_token():
+        return "token"
+
+    handler = AIChatbotHandler.__new__(AIChatbotHandler)
+    handler.config = SimpleNamespace(N8N_STREAMING=True, MAX_MESSAGE_LENGTH=200)
+    handler.ai_service = SimpleNamespace(stream_ai_response=stream_ai_response)
+    handler.token_manager = SimpleNamespace(get_token=get_token)
+    handler.dingtalk_service = DingTalkService("robot", object(), GroupSendScheduler(send, group_rate=0, app_rate=0))
+
+    async def scenario():
+        await handler._process_ai_response("问题", "u1", "张三", "cid")
+        await handler.dingtalk_service.close()
+
+    asyncio.run(scenario())
+    assert len(sent) >= 4
+    assert all(len(params["text"]) <= 200 for params in sent)
+    assert sent[0]["title"].endswith("@张三") and sent[1]["title"].endswith("（第2页）")
+    # 内容完整，没有截断
+    assert "".join(params["text"] for params in sent).replace("\n", "") == reply.replace("\n", "")
+
+
+def test_sse_decoder():
+    decoder = SSEDecoder()
+    events = decoder.feed(": ping\ndata: {\"content\": \"你\"}\n\ndata: 好\r\n")
+    events += decoder.feed("\ndata: [DONE]")
+    events += decoder.flush()
+    assert events == ['{"content": "你"}', "好", "[DONE]"]
+
+
+def test_ndjson_decoder_and_extract():
+    decoder = NDJSONDecoder()
+    objects = decoder.feed('{"type": "begin"}\n{"type": "item", "content": "你')
+    objects += decoder.feed('好"}\n{"type": "end"}')
+    objects += decoder.flush()
+    assert [extract_stream_text(obj) for obj in objects] == [None, "你好", None]
+
+
+async def _collect(handler):
+    app = web.Application()
+    app.router.add_post("/webhook", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    ai_service = AIService(f"http://127.0.0.1:{port}/webhook")
+    try:
+        return [delta async for delta in ai_service.stream_ai_response("hi", "u1", "c1")]
+    finally:
+        await ai_service.close()
+        await runner.cleanup()
+
+
+def test_stream_ai_response_n8n_ndjson():
+    async def handler(request):
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        await response.write(b'{"type":"begin"}\n')
+        for word in ("你", "好"):
+            line = json.dumps({"type": "item", "content": word}, ensure_ascii=False) + "\n"
+            await response.write(line.encode("utf-8"))
+        await response.write(b'{"type":"end"}\n')
+        await response.write_eof()
+        return response
+
+    assert asyncio.run(_collect(handler)) == ["你", "好"]
+
+
+def test_stream_ai_response_sse():
+    async def handler(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write('data: {"delta": "你"}\n\n'.encode("utf-8"))
+        await response.write('data: {"delta": "好"}\n\ndata: [DONE]\n\n'.encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    assert asyncio.run(_collect(handler)) == ["你", "好"]
+
+
+def test_stream_ai_response_plain_json():
+    async def handler(request):
+        return web.json_response([{"output": "完整回复"}])
+
+    assert asyncio.run(_collect(handler)) == ["完整回复"]
+
+
+def test_chatbot_handler_streaming_retries_and_uses_cache():
+    hits = {"bad": 0, "good": 0}
+    sent = []
+
+    async def bad(request):
+        hits["bad"] += 1
+        return web.Response(status=503)
+
+    async def good(request):
+        hits["good"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/plain"})
+        await response.prepare(request)
+        await response.write("请假需要提前申请。".encode())
+        await response.write_eof()
+        return response
+
+    async def send(access_token, conversation_id, msg_key, params):
+        sent.append(params["text"])
+        return True
+
+    async def get_token():
+        return "token"
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/bad", bad)
+        app.router.add_post("/good", good)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        handler = AIChatbotHandler.__new__(AIChatbotHandler)
+        handler.config = SimpleNamespace(N8N_STREAMING=True, MAX_MESSAGE_LENGTH=200)
+        handler.ai_service = AIService([f"http://127.0.0.1:{port}/bad", f"http://127.0.0.1:{port}/good"],
+                                       response_cache=ResponseCache())
+        handler.ai_service.retry_policy = RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)
+        handler.token_manager = SimpleNamespace(get_token=get_token)
+        handler.dingtalk_service = DingTalkService("robot", object(),
+                                                   GroupSendScheduler(send, group_rate=0, app_rate=0))
+        try:
+            for user_id in ("u1", "u2"):
+                await handler._process_ai_response("怎么请假？", user_id, user_id, "cid")
+        finally:
+            await handler.dingtalk_service.close()
+            await handler.ai_service.close()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+    # 流式调用同样换地址重试，第二次提问命中缓存
+    assert sent == ["请假需要提前申请。"] * 2
+    assert hits["good"] == 1
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+多进程模式测试：worker崩溃重启、关闭信号转发、worker之间共享去重记录
+"""
+
+import sys
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from utils.local_state import LocalStateClient, LocalStateServer
+from utils.message_dedup import create_message_deduplicator
+from utils.supervisor import WorkerSupervisor
+
+# 第一次启动时立即崩溃，重启后一直运行到收到SIGTERM
+WORKER_SCRIPT = """
+import os, sys, signal, time
+path = os.path.join(sys.argv[1], "worker" + os.environ["DINGTALK_BOT_WORKER_ID"])
+started = os.path.exists(path)
+with open(path, "a") as f:
+    f.write("start\\n")
+if not started:
+    sys.exit(3)
+def stop(signum, frame):
+    with open(path, "a") as f:
+        f.write("stop\\n")
+    sys.exit(0)
+signal.signal(signal.SIGTERM, stop)
+while True:
+    time.sleep(0.05)
+"""
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_supervisor_restarts_crashed_workers_and_forwards_stop(tmp_path):
+    supervisor = WorkerSupervisor([sys.executable, "-c", WORKER_SCRIPT, str(tmp_path)], workers=2,
+                                  restart_delay=0.1, shutdown_timeout=5, poll_interval=0.05)
+    thread = threading.Thread(target=supervisor.run, kwargs={"install_signal_handlers": False})
+    thread.start()
+    try:
+        logs = [tmp_path / "worker0", tmp_path / "worker1"]
+        assert _wait_for(lambda: all(p.exists() and p.read_text().count("start") == 2 for p in logs))
+        assert [w.restarts for w in supervisor.workers] == [1, 1]
+    finally:
+        supervisor.stop()
+        thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert all(p.read_text().endswith("stop\n") for p in logs)
+
+
+def test_workers_share_dedup_through_local_state(tmp_path):
+    server = LocalStateServer(str(tmp_path / "state.sock"))
+    server.start()
+    config = SimpleNamespace(MESSAGE_DEDUP_BACKEND="memory", MESSAGE_DEDUP_TTL=60,
+                             LOCAL_STATE_SOCKET=server.path)
+    first = create_message_deduplicator(config)
+    second = create_message_deduplicator(config)
+
+    async def scenario():
+        try:
+            return [await first.is_duplicate("m1"), await second.is_duplicate("m1"),
+                    await second.is_duplicate("m2")]
+        finally:
+            await first.close()
+            await second.close()
+
+    try:
+        assert asyncio.run(scenario()) == [False, True, False]
+    finally:
+        server.stop()
+
+
+def test_local_state_set_nx_and_expiry(tmp_path):
+    server = LocalStateServer(str(tmp_path / "state.sock"))
+    server.start()
+    client = LocalStateClient(server.path)
+
+    async def scenario():
+        results = [
+            await client.set("k", "v", nx=True, ex=1),
+            await client.set("k", "other", nx=True),
+            await client.get("k"),
+        ]
+        server._data["k"] = ("v", time.monotonic() - 1)
+        results.append(await client.get("k"))
+        results.append(await client.delete("k"))
+        return results
+
+    try:
+        assert asyncio.run(scenario()) == [True, None, "v", None, 0]
+        # Stream SDK重连时会新建事件循环，客户端应自动重连
+        assert asyncio.run(client.set("k", 1)) is True
+    finally:
+        server.stop()
+
+
+def test_rolling_restart_replaces_workers_one_by_one(tmp_path):
+    supervisor = WorkerSupervisor([sys.executable, "-c", WORKER_SCRIPT, str(tmp_path)], workers=2,
+                                  restart_delay=0.1, shutdown_timeout=5, reload_grace=0.2, poll_interval=0.05)
+    thread = threading.Thread(target=supervisor.run, kwargs={"install_signal_handlers": False})
+    thread.start()
+    try:
+        logs = [tmp_path / "worker0", tmp_path / "worker1"]
+        assert _wait_for(lambda: all(p.exists() and p.read_text().count("start") == 2 for p in logs))
+        supervisor.reload()
+        # 新worker先启动，旧worker随后收到SIGTERM退出
+        assert _wait_for(lambda: all(p.read_text().split() == ["start", "start", "start", "stop"] for p in logs))
+    finally:
+        supervisor.stop()
+        thread.join(timeout=10)
+    assert all(p.read_text().count("stop") == 2 for p in logs)
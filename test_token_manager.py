@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+access_token缓存测试
+"""
+
+import os
+import time
+import fcntl
+import asyncio
+
+from utils.token_manager import TokenManager
+
+
+class FakeOpenAPIClient:
+    """模拟OAuth接口，记录调用次数"""
+
+    def __init__(self, fail=False, delay=0.05):
+        self.calls = 0
+        self.fail = fail
+        self.delay = delay
+
+    async def get_access_token(self, app_key, app_secret):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            return None
+        return {"accessToken": f"token-{self.calls}", "expireIn": 7200}
+
+
+def test_concurrent_callers_share_one_refresh():
+    client = FakeOpenAPIClient()
+    manager = TokenManager("key", "secret", client, background_refresh=False)
+
+    async def scenario():
+        return await asyncio.gather(*(manager.get_token() for _ in range(50)))
+
+    tokens = asyncio.run(scenario())
+    assert set(tokens) == {"token-1"}
+    assert client.calls == 1
+
+
+def test_stale_token_used_when_refresh_fails():
+    client = FakeOpenAPIClient(fail=True)
+    manager = TokenManager("key", "secret", client, refresh_ahead=300, background_refresh=False)
+    manager._token_cache = {"token": "old", "expire": time.time() + 60}
+
+    async def scenario():
+        # 刷新在后台进行，等待它结束后仍然使用旧token
+        token = await manager.get_token()
+        return token, await manager.refresh()
+
+    assert asyncio.run(scenario()) == ("old", "old")
+    assert client.calls == 1
+
+    manager._token_cache = {"token": "old", "expire": time.time() - 1}
+    assert asyncio.run(manager.get_token()) is None
+
+
+def test_background_refresh_ahead_of_expiry():
+    client = FakeOpenAPIClient(delay=0)
+    manager = TokenManager("key", "secret", client, refresh_ahead=300)
+    manager._token_cache = {"token": "old", "expire": time.time() + 300.05}
+
+    async def scenario():
+        assert await manager.get_token() == "old"
+        await asyncio.sleep(0.2)
+        await manager.close()
+
+    asyncio.run(scenario())
+    assert client.calls == 1
+    assert manager._token_cache["token"] == "token-1"
+
+
+def test_cache_file_shared_between_managers(tmp_path):
+    cache_file = str(tmp_path / "token.json")
+    first_client, second_client = FakeOpenAPIClient(), FakeOpenAPIClient()
+    first = TokenManager("key", "secret", first_client, cache_file=cache_file, background_refresh=False)
+    second = TokenManager("key", "secret", second_client, cache_file=cache_file, background_refresh=False)
+
+    assert asyncio.run(first.get_token()) == "token-1"
+    assert asyncio.run(second.get_token()) == "token-1"
+    assert second_client.calls == 0
+
+    # token被判定无效后不再从共享文件读取
+    second.clear_cache()
+    assert asyncio.run(second.get_token()) == "token-1"
+    assert second_client.calls == 1
+
+
+def test_token_in_refresh_window_is_returned_without_waiting():
+    client = FakeOpenAPIClient(delay=0.2)
+    manager = TokenManager("key", "secret", client, refresh_ahead=300, background_refresh=False)
+    manager._token_cache = {"token": "old", "expire": time.time() + 60}
+
+    async def scenario():
+        started = time.monotonic()
+        tokens = await asyncio.gather(*(manager.get_token() for _ in range(10)))
+        elapsed = time.monotonic() - started
+        await manager.refresh()
+        return tokens, elapsed, await manager.get_token()
+
+    tokens, elapsed, refreshed = asyncio.run(scenario())
+    # 仍然有效的token立即返回，只在后台刷新一次
+    assert tokens == ["old"] * 10 and elapsed < 0.1
+    assert refreshed == "token-1" and client.calls == 1
+
+
+def test_cancelled_refresh_releases_cache_file_lock(tmp_path):
+    cache_file = str(tmp_path / "token.json")
+    manager = TokenManager("key", "secret", FakeOpenAPIClient(), cache_file=cache_file, background_refresh=False)
+    # 模拟另一个进程正在刷新
+    holder = os.open(f"{cache_file}.lock", os.O_CREAT | os.O_RDWR, 0o600)
+    fcntl.flock(holder, fcntl.LOCK_EX)
+    open_fds = len(os.listdir("/proc/self/fd"))
+
+    async def scenario():
+        task = asyncio.ensure_future(manager.get_token())
+        await asyncio.sleep(0.05)
+        # 刷新在等待锁时被取消
+        manager._refreshing.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # 另一个进程释放锁后，被取消的刷新在线程池中拿到的锁立即释放
+        fcntl.flock(holder, fcntl.LOCK_UN)
+        await asyncio.sleep(0.1)
+
+    try:
+        asyncio.run(scenario())
+        assert len(os.listdir("/proc/self/fd")) == open_fds
+        fcntl.flock(holder, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    finally:
+        os.close(holder)
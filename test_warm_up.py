@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+启动预热测试：建立到n8n的长连接（只访问健康检查地址）、获取token、检查卡片模板配置
+"""
+
+import asyncio
+
+from aiohttp import web
+
+from handlers.ai_card_handler import AICardHandler
+from services.ai_service import AIService
+
+
+def test_ai_service_warm_up_hits_health_path_only():
+    requests = []
+
+    async def handler(request):
+        requests.append((request.method, request.path))
+        return web.Response(text="ok")
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        ai_service = AIService(f"http://127.0.0.1:{port}/webhook/bot,http://127.0.0.1:9/webhook/bot")
+        try:
+            return await ai_service.warm_up()
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    # 第二个实例无法连接
+    assert asyncio.run(scenario()) is False
+    assert requests == [("GET", "/healthz")]
+
+
+def test_card_handler_warm_up_fetches_token_and_checks_template(monkeypatch):
+    class FakeOpenAPIClient:
+        async def warm_up(self):
+            return True
+
+    class FakeTokenManager:
+        calls = 0
+
+        async def get_token(self):
+            self.calls += 1
+            return "token"
+
+    token_manager = FakeTokenManager()
+    handler = AICardHandler(ai_service=None, token_manager=token_manager, openapi_client=FakeOpenAPIClient())
+
+    monkeypatch.setenv("DINGTALK_AI_CARD_TEMPLATE_ID", "tpl-1.schema")
+    assert asyncio.run(handler.warm_up())
+    assert token_manager.calls == 1
+    monkeypatch.setenv("DINGTALK_AI_CARD_TEMPLATE_ID", "请填写你的钉钉AI卡片模板ID")
+    assert not asyncio.run(handler.warm_up())
+    monkeypatch.delenv("DINGTALK_AI_CARD_TEMPLATE_ID")
+    assert not AICardHandler.check_card_template()
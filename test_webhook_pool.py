@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+n8n webhook地址池测试
+"""
+
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from services.ai_service import AIService
+from services.webhook_pool import WebhookPool, parse_webhook_urls
+from utils.resilience import RetryPolicy
+
+
+def test_parse_webhook_urls():
+    assert parse_webhook_urls(" http://a/webhook/x , http://b/webhook/x,") == ["http://a/webhook/x", "http://b/webhook/x"]
+    assert parse_webhook_urls(["http://a"]) == ["http://a"]
+
+
+def test_least_outstanding_and_ewma_selection():
+    pool = WebhookPool("http://a,http://b")
+    a, b = pool.endpoints
+    started = pool.begin(a)
+    assert pool.pick() is b
+    pool.end(a, started, True)
+
+    pool = WebhookPool("http://a,http://b", strategy="ewma")
+    a, b = pool.endpoints
+    a.ewma_latency, b.ewma_latency = 0.2, 1.0
+    assert pool.pick() is a
+    a.outstanding = 10
+    assert pool.pick() is b
+
+
+def test_passive_ejection_and_restore():
+    pool = WebhookPool("http://a,http://b", failure_threshold=2, eject_seconds=0.01)
+    a, b = pool.endpoints
+    for _ in range(2):
+        pool.end(a, pool.begin(a), False)
+    assert not a.healthy
+    assert all(pool.pick() is b for _ in range(10))
+    # 全部不可用时仍然返回一个地址
+    assert pool.pick(exclude=[b]) is b
+    time.sleep(0.015)
+    assert a.healthy
+
+
+def test_active_health_check():
+    state = {"up": False}
+
+    async def healthz(request):
+        return web.Response(status=200 if state["up"] else 503)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/healthz", healthz)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        pool = WebhookPool(f"http://127.0.0.1:{port}/webhook/x,http://127.0.0.1:9/webhook/x")
+        endpoint = pool.endpoints[0]
+        try:
+            async with aiohttp.ClientSession() as session:
+                down = await pool.check(endpoint, session), endpoint.healthy
+                state["up"] = True
+                up = await pool.check(endpoint, session), endpoint.healthy
+            return down, up
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(scenario()) == ((False, False), (True, True))
+
+
+def test_ai_service_retries_on_another_endpoint():
+    hits = {"bad": 0, "good": 0}
+
+    async def bad(request):
+        hits["bad"] += 1
+        return web.Response(status=503)
+
+    async def good(request):
+        hits["good"] += 1
+        return web.json_response({"output": "好的"})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/bad", bad)
+        app.router.add_post("/good", good)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        base = f"http://127.0.0.1:{port}"
+        ai_service = AIService([f"{base}/bad", f"{base}/good"])
+        ai_service.retry_policy = RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)
+        try:
+            return [await ai_service.get_ai_response(f"问题{i}", "u1", "c1") for i in range(4)]
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    assert asyncio.run(scenario()) == ["好的"] * 4
+    assert hits["good"] == 4
+    # 默认连续失败3次后移出轮询
+    assert hits["bad"] <= 3
+
+
+@pytest.mark.parametrize("failure", ["503", "refused"])
+def test_stream_retries_on_another_endpoint_before_first_chunk(failure):
+    hits = {"bad": 0, "good": 0}
+
+    async def bad(request):
+        hits["bad"] += 1
+        return web.Response(status=503)
+
+    async def good(request):
+        hits["good"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for text in ("你", "好"):
+            await response.write(f'{{"type": "item", "content": "{text}"}}\n'.encode())
+        await response.write_eof()
+        return response
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/bad", bad)
+        app.router.add_post("/good", good)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        bad_url = f"http://127.0.0.1:{port}/bad" if failure == "503" else "http://127.0.0.1:9/webhook"
+        ai_service = AIService([bad_url, f"http://127.0.0.1:{port}/good"])
+        ai_service.retry_policy = RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)
+        try:
+            return ["".join([delta async for delta in ai_service.stream_ai_response(f"问题{i}", "u1", "c1")])
+                    for i in range(3)]
+        finally:
+            await ai_service.close()
+            await runner.cleanup()
+
+    assert asyncio.run(scenario()) == ["你好"] * 3
+    assert hits["good"] == 3
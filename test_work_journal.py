@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+工作日志测试：批量落盘、崩溃后重放未完成的消息、滚动重启时不重放仍在运行的进程的条目
+"""
+
+import sys
+import sqlite3
+import asyncio
+import subprocess
+
+from dingtalk_stream import AckMessage, CallbackMessage
+
+from config import Config
+from handlers.ai_card_handler import AICardHandler
+from utils.message_dedup import MessageDeduplicator
+from utils.work_journal import CURRENT_ENTRY, KIND_INBOUND, KIND_OUTBOUND, WorkJournal, run_journaled
+from test_graceful_shutdown import FakeAIService, FakeOpenAPIClient, FakeTokenManager
+
+# 写入一条已完成和一条未完成的入站消息后直接退出，模拟进程崩溃
+CRASH_SCRIPT = """
+import os, sys, asyncio
+from utils.work_journal import WorkJournal
+async def main():
+    journal = WorkJournal(sys.argv[1])
+    journal.open()
+    assert await journal.recover() == []
+    done = await journal.append("inbound", {"msgId": "done"})
+    journal.complete(done)
+    await journal.append("inbound", {"msgId": "lost"})
+    await journal.flush()
+    os._exit(1)
+asyncio.run(main())
+"""
+
+
+def _callback(msg_id: str) -> CallbackMessage:
+    callback = CallbackMessage()
+    callback.data = {
+        "msgId": msg_id, "conversationId": "c1", "conversationType": "1", "senderStaffId": "u1",
+        "msgtype": "text", "text": {"content": "你好"},
+    }
+    return callback
+
+
+def test_concurrent_appends_share_commits(tmp_path):
+    journal = WorkJournal(str(tmp_path / "journal.db"))
+    journal.open()
+
+    async def scenario():
+        ids = await asyncio.gather(*(journal.append(KIND_INBOUND, {"i": i}) for i in range(100)))
+        await journal.close()
+        return ids
+
+    ids = asyncio.run(scenario())
+    assert sorted(ids) == ids and len(set(ids)) == 100
+    assert journal.batches < 100
+
+
+def test_recover_after_crash(tmp_path):
+    path = str(tmp_path / "journal.db")
+    subprocess.run([sys.executable, "-c", CRASH_SCRIPT, path], check=False)
+    journal = WorkJournal(path)
+    journal.open()
+
+    async def scenario():
+        entries = await journal.recover()
+        # 已接管的条目不会被本进程再次重放
+        again = await journal.recover()
+        await journal.close()
+        return entries, again
+
+    entries, again = asyncio.run(scenario())
+    assert [entry.payload["msgId"] for entry in entries] == ["lost"]
+    assert entries[0].attempts == 0 and again == []
+
+
+def test_recover_drops_children_of_replayed_messages_and_stale_entries(tmp_path):
+    path = str(tmp_path / "journal.db")
+    old = WorkJournal(path)
+    old.open()
+
+    async def write_old():
+        inbound = await old.append(KIND_INBOUND, {"msgId": "m1"})
+        # 正在处理m1时发送的消息，m1重新处理时会重新生成
+        token = CURRENT_ENTRY.set(inbound)
+        await old.append(KIND_OUTBOUND, {"text": "page 1"}, parent=CURRENT_ENTRY.get())
+        CURRENT_ENTRY.reset(token)
+        finished = await old.append(KIND_INBOUND, {"msgId": "m2"})
+        await old.append(KIND_OUTBOUND, {"text": "failed send"}, parent=finished)
+        old.complete(finished)
+        await old.close()
+
+    asyncio.run(write_old())
+    new = WorkJournal(path)
+    new.open()
+
+    async def scenario():
+        entries = await new.recover()
+        await new.close()
+        return entries
+
+    assert [(entry.kind, entry.payload) for entry in asyncio.run(scenario())] == [
+        (KIND_INBOUND, {"msgId": "m1"}),
+        (KIND_OUTBOUND, {"text": "failed send"}),
+    ]
+
+    stale = WorkJournal(path)
+    stale.open()
+
+    async def stale_scenario():
+        await asyncio.sleep(0.05)
+        entries = await stale.recover(max_age=0.01)
+        await stale.close()
+        return entries
+
+    assert asyncio.run(stale_scenario()) == []
+
+
+def test_recover_waits_for_previous_process_to_exit(tmp_path):
+    path = str(tmp_path / "journal.db")
+    old = WorkJournal(path)
+    old.open()
+    assert old.try_lock()
+    new = WorkJournal(path, lock_retry_interval=0.05)
+    new.open()
+
+    async def scenario():
+        await old.append(KIND_INBOUND, {"msgId": "in-flight"})
+        recovering = asyncio.ensure_future(new.recover())
+        await asyncio.sleep(0.2)
+        # 旧进程仍在处理自己的消息，不能重放
+        assert not recovering.done()
+        await old.close()
+        entries = await recovering
+        await new.close()
+        return entries
+
+    entries = asyncio.run(scenario())
+    assert [entry.payload["msgId"] for entry in entries] == ["in-flight"]
+
+
+def test_card_handler_journals_before_ack_and_replays(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = WorkJournal(path)
+    journal.open()
+    handler = AICardHandler(FakeAIService(hang=True), token_manager=FakeTokenManager(),
+                            openapi_client=FakeOpenAPIClient(), deduplicator=MessageDeduplicator(),
+                            journal=journal)
+
+    async def crash():
+        status, _ = await handler.process(_callback("m1"))
+        await asyncio.sleep(0.05)
+        # 回复尚未完成时进程退出（不标记完成）
+        await handler.admission.close()
+        await journal.close()
+        return status
+
+    assert asyncio.run(crash()) == AckMessage.STATUS_OK
+
+    journal = WorkJournal(path)
+    journal.open()
+    openapi_client = FakeOpenAPIClient()
+    handler = AICardHandler(FakeAIService(hang=False), token_manager=FakeTokenManager(),
+                            openapi_client=openapi_client, deduplicator=MessageDeduplicator(),
+                            journal=journal)
+
+    async def restart():
+        replayed = await handler.replay_journal()
+        await handler.drain(5)
+        await journal.close()
+        return replayed
+
+    assert asyncio.run(restart()) == 1
+    assert openapi_client.updates[-1]["finished"] and not openapi_client.updates[-1]["failed"]
+
+    # 重放完成后条目已删除
+    journal = WorkJournal(path)
+    journal.open()
+
+    async def recover():
+        entries = await journal.recover()
+        await journal.close()
+        return entries
+
+    assert asyncio.run(recover()) == []
+
+
+def test_shutdown_tells_user_the_journaled_reply_will_resume(tmp_path):
+    journal = WorkJournal(str(tmp_path / "journal.db"))
+    journal.open()
+    openapi_client = FakeOpenAPIClient()
+    handler = AICardHandler(FakeAIService(hang=True), token_manager=FakeTokenManager(),
+                            openapi_client=openapi_client, deduplicator=MessageDeduplicator(),
+                            journal=journal)
+
+    async def scenario():
+        await handler.process(_callback("m1"))
+        await asyncio.sleep(0.05)
+        drained = await handler.drain(0.1)
+        await journal.close()
+        with sqlite3.connect(journal.path) as conn:
+            return drained, conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+
+    # 消息会在重启后重放，提示用户等待而不是重新提问，避免收到两次回复
+    assert asyncio.run(scenario()) == (False, 1)
+    last = openapi_client.updates[-1]
+    assert last["failed"] and Config.SHUTDOWN_RESUME_MESSAGE in last["content"]
+    assert Config.SHUTDOWN_REPLY_MESSAGE not in last["content"]
+
+
+def test_run_journaled_keeps_cancelled_entries(tmp_path):
+    journal = WorkJournal(str(tmp_path / "journal.db"))
+    journal.open()
+
+    async def scenario():
+        done = await journal.append(KIND_INBOUND, {"msgId": "done"})
+        cancelled = await journal.append(KIND_INBOUND, {"msgId": "cancelled"})
+        await run_journaled(journal, done, asyncio.sleep, 0)
+        task = asyncio.ensure_future(run_journaled(journal, cancelled, asyncio.sleep, 10))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await journal.close()
+
+    asyncio.run(scenario())
+    other = WorkJournal(journal.path)
+    other.open()
+
+    async def recover():
+        entries = await other.recover()
+        await other.close()
+        return entries
+
+    assert [entry.payload["msgId"] for entry in asyncio.run(recover())] == ["cancelled"]
@@ -0,0 +1,341 @@
+import heapq
+import asyncio
+import logging
+import itertools
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Sequence
+
+from utils.metrics import QUEUE_WAIT_SECONDS, REJECTED_TOTAL
+
+logger = logging.getLogger(__name__)
+
+# 优先级类别，权重越大获得的处理份额越大
+PRIORITY_VIP = "vip"
+PRIORITY_DM = "dm"
+PRIORITY_GROUP = "group"
+
+# FairQueue回收已结束的流的最小间隔（流的数量）
+MIN_FINISH_PRUNE = 64
+
+
+class FairQueue:
+    """
+    加权公平队列
+    每个任务属于一个或多个流（如发送者、会话），入队时计算虚拟完成时间：
+    取系统虚拟时间与所属各流上一个任务的虚拟完成时间中的最大值，加上1/weight；
+    出队时取虚拟完成时间最小的任务，系统虚拟时间推进到该任务的虚拟完成时间。
+    连续提交大量任务的流，其任务的虚拟完成时间越排越靠后，新来的其他流的任务排在它们前面，
+    占用多的用户或群不会饿死其他人；权重越大的任务（如VIP群、单聊）获得的份额越大。
+    """
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        # 流 -> 该流最后一个任务的虚拟完成时间
+        self._finish: Dict[Hashable, float] = {}
+        self._vtime = 0.0
+        # 流的数量达到该值时回收已结束的流
+        self._prune_at = MIN_FINISH_PRUNE
+        self._seq = itertools.count()
+        self._available = asyncio.Semaphore(0)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def put(self, item: Any, flows: Sequence[Hashable] = (), weight: float = 1.0):
+        """
+        :param flows: 任务所属的流，没有时按先来先服务排在当前虚拟时间之后
+        :param weight: 权重，越大排得越靠前
+        """
+        start = max([self._vtime] + [self._finish.get(flow, 0.0) for flow in flows])
+        finish = start + 1.0 / max(weight, 1e-6)
+        for flow in flows:
+            self._finish[flow] = finish
+        heapq.heappush(self._heap, (finish, next(self._seq), item))
+        self._available.release()
+
+    async def get(self) -> Any:
+        await self._available.acquire()
+        finish, _, item = heapq.heappop(self._heap)
+        self._vtime = max(self._vtime, finish)
+        if not self._heap:
+            # 所有流的虚拟完成时间都不超过系统虚拟时间，不再影响排序
+            self._finish.clear()
+        elif len(self._finish) >= self._prune_at:
+            # 队列持续非空时回收虚拟完成时间不超过系统虚拟时间的流，它们与新流的排序相同；
+            # 流的数量翻倍后才再次回收，均摊到每次出队为O(1)
+            self._finish = {flow: end for flow, end in self._finish.items() if end > self._vtime}
+            self._prune_at = max(MIN_FINISH_PRUNE, 2 * len(self._finish))
+        return item
+
+
+class AdmissionController:
+    """
+    入站消息准入控制
+    固定数量的worker并发处理任务，超出并发的任务进入有界队列等待，
+    队列满时拒绝新任务（由调用方快速回复"繁忙"），避免突发流量耗尽内存和连接。
+    提交时指定key（如会话ID）的任务按key串行、按提交顺序执行，不同key之间并行；
+    只有存在待处理任务的key才会占用内存，空闲后立即回收。
+    等待队列按流（发送者、会话）加权公平出队，少数用户刷屏时其他人的排队时间基本不受影响；
+    单个流排队的任务数超过max_pending_per_flow时拒绝该流的新任务，不占满整个队列。
+    """
+
+    def __init__(self, max_concurrency: int = 20, max_queue_size: int = 200, max_pending_per_flow: int = 0):
+        """
+        :param max_concurrency: 同时处理的最大任务数
+        :param max_queue_size: 等待队列的最大长度，0表示不限制
+        :param max_pending_per_flow: 每个流最多排队的任务数，0表示不限制
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.max_pending_per_flow = max_pending_per_flow
+        self._queue: Optional[FairQueue] = None
+        # 流 -> 排队中（包括在key后等待）的任务数
+        self._flow_pending: Dict[Hashable, int] = {}
+        self._workers: List[asyncio.Task] = []
+        # key -> 该key正在执行时后续到达的任务
+        self._lanes: Dict[Hashable, Deque[tuple]] = {}
+        self._pending = 0
+        self._running = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+        self._wait_time_total = 0.0
+        self.max_wait_time = 0.0
+        # 没有排队和执行中的任务时置位，用于关闭时等待处理完
+        self._idle: Optional[asyncio.Event] = None
+        self._drain_aborted = False
+
+    @property
+    def queue_depth(self) -> int:
+        """当前排队等待的任务数"""
+        return self._pending
+
+    @property
+    def active_lanes(self) -> int:
+        """当前有任务在执行或等待的key数量"""
+        return len(self._lanes)
+
+    @property
+    def running(self) -> int:
+        """当前正在处理的任务数"""
+        return self._running
+
+    @property
+    def avg_wait_time(self) -> float:
+        """任务平均排队时间（秒）"""
+        started = self.completed + self._running
+        return self._wait_time_total / started if started else 0.0
+
+    def submit(self, func: Callable[..., Awaitable[Any]], *args, key: Hashable = None,
+               flows: Sequence[Hashable] = (), weight: float = 1.0, priority: str = PRIORITY_GROUP) -> bool:
+        """
+        提交一个任务
+        :param func: 协程函数
+        :param args: 参数
+        :param key: 串行执行的key，相同key的任务按提交顺序依次执行，为空则不限制
+        :param flows: 公平排队的流，如fair_flows(发送者, 会话)
+        :param weight: 公平排队的权重
+        :param priority: 优先级类别，用于统计排队时间
+        :return: 是否被接受，队列已满或所属的流排队过多时返回False
+        """
+        self._ensure_workers()
+        if self.max_queue_size and self._pending >= self.max_queue_size:
+            self._reject("处理队列已满")
+            return False
+        if self.max_pending_per_flow and any(
+                self._flow_pending.get(flow, 0) >= self.max_pending_per_flow for flow in flows):
+            self._reject(f"排队消息过多: flows={list(flows)}")
+            return False
+        self._pending += 1
+        for flow in flows:
+            self._flow_pending[flow] = self._flow_pending.get(flow, 0) + 1
+        self._idle.clear()
+        self._queue.put((time.monotonic(), key, func, args, flows, priority), flows, weight)
+        self.accepted += 1
+        return True
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        REJECTED_TOTAL.inc()
+        logger.warning(f"{reason}，拒绝新消息: running={self._running}, "
+                       f"queue_depth={self.queue_depth}, rejected={self.rejected}")
+
+    def stats(self) -> dict:
+        """队列深度、排队时间等统计信息，用于评估并发和队列上限"""
+        return {
+            "running": self._running,
+            "queue_depth": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "max_queue_size": self.max_queue_size,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "active_lanes": self.active_lanes,
+            "avg_wait_time": round(self.avg_wait_time, 3),
+            "max_wait_time": round(self.max_wait_time, 3),
+        }
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._queue is not None and self._workers and self._workers[0].get_loop() is loop:
+            return
+        self._queue = FairQueue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._lanes = {}
+        self._flow_pending = {}
+        self._pending = 0
+        self._workers = [loop.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            key = item[1]
+            if key is not None:
+                if key in self._lanes:
+                    # 同一key已有任务在执行，排在其后，不占用worker
+                    self._lanes[key].append(item)
+                    continue
+                self._lanes[key] = deque()
+            # 执行完后继续执行同一key后续到达的任务，保证顺序
+            while item is not None:
+                await self._run(item)
+                item = None
+                if key is not None:
+                    lane = self._lanes[key]
+                    if lane:
+                        item = lane.popleft()
+                    else:
+                        del self._lanes[key]
+
+    async def _run(self, item: tuple):
+        enqueued_at, _, func, args, flows, priority = item
+        self._pending -= 1
+        for flow in flows:
+            remaining = self._flow_pending[flow] - 1
+            if remaining:
+                self._flow_pending[flow] = remaining
+            else:
+                del self._flow_pending[flow]
+        wait_time = time.monotonic() - enqueued_at
+        self._wait_time_total += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        QUEUE_WAIT_SECONDS.observe(wait_time, priority=priority)
+        self._running += 1
+        try:
+            await func(*args)
+        except Exception as e:
+            logger.exception(f"异步处理任务异常: {e}")
+        finally:
+            self._running -= 1
+            self.completed += 1
+            if not self._pending and not self._running:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        等待已接受的任务（包括排队中的）全部执行完
+        :param timeout: 最长等待时间（秒）
+        :return: 是否全部执行完，超时或被abort_drain中止时返回False
+        """
+        if self._idle is None:
+            return True
+        self._drain_aborted = False
+        try:
+            await asyncio.wait_for(self._wait_idle(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return not self._pending and not self._running
+
+    async def _wait_idle(self):
+        while (self._pending or self._running) and not self._drain_aborted:
+            await self._idle.wait()
+            if self._pending or self._running:
+                self._idle.clear()
+
+    def abort_drain(self):
+        """中止drain的等待，如关闭过程中再次收到退出信号"""
+        self._drain_aborted = True
+        if self._idle is not None:
+            self._idle.set()
+
+    async def close(self):
+        """停止所有worker，未处理的任务被丢弃"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+def lane_key(scope: str, user_id: Optional[str], conversation_id: Optional[str]) -> Optional[str]:
+    """
+    计算消息串行执行的key
+    :param scope: conversation（同一会话串行）、conversation_user（同一会话内同一用户串行）、none（不串行）
+    :return: key，不串行时返回None
+    """
+    if scope == "none" or not conversation_id:
+        return None
+    if scope == "conversation_user":
+        return f"{conversation_id}:{user_id}"
+    return conversation_id
+
+
+def fair_flows(user_id: Optional[str], conversation_id: Optional[str]) -> tuple:
+    """公平排队的流：同时按发送者和会话计算份额，刷屏的用户和嘈杂的群都只占自己的份额"""
+    flows = []
+    if user_id:
+        flows.append(f"user:{user_id}")
+    if conversation_id:
+        flows.append(f"conversation:{conversation_id}")
+    return tuple(flows)
+
+
+def parse_class_weights(spec: str) -> Dict[str, float]:
+    """
+    解析优先级类别权重
+    :param spec: 如 "vip:4,dm:2,group:1"
+    :return: 类别 -> 权重
+    """
+    weights = {PRIORITY_VIP: 4.0, PRIORITY_DM: 2.0, PRIORITY_GROUP: 1.0}
+    for part in spec.split(","):
+        name, _, value = part.partition(":")
+        if not name.strip():
+            continue
+        try:
+            weights[name.strip()] = max(float(value), 0.01)
+        except ValueError:
+            logger.warning(f"忽略无效的优先级权重配置: {part}")
+    return weights
+
+
+class PriorityClasses:
+    """按会话类型和VIP名单把消息分到优先级类别"""
+
+    def __init__(self, weights: str = "", vip_conversations: str = "", vip_users: str = ""):
+        """
+        :param weights: 类别权重，如 "vip:4,dm:2,group:1"
+        :param vip_conversations: 逗号分隔的VIP会话ID
+        :param vip_users: 逗号分隔的VIP用户（staffId）
+        """
+        self.weights = parse_class_weights(weights)
+        self.vip_conversations = {item.strip() for item in vip_conversations.split(",") if item.strip()}
+        self.vip_users = {item.strip() for item in vip_users.split(",") if item.strip()}
+
+    @classmethod
+    def from_config(cls, config) -> "PriorityClasses":
+        return cls(config.FAIR_QUEUE_CLASS_WEIGHTS, config.FAIR_QUEUE_VIP_CONVERSATIONS,
+                   config.FAIR_QUEUE_VIP_USERS)
+
+    def classify(self, conversation_type: Optional[str], conversation_id: Optional[str],
+                 user_id: Optional[str]) -> str:
+        """
+        :param conversation_type: 1：单聊，2：群聊
+        :return: vip/dm/group
+        """
+        if conversation_id in self.vip_conversations or user_id in self.vip_users:
+            return PRIORITY_VIP
+        return PRIORITY_DM if conversation_type == "1" else PRIORITY_GROUP
+
+    def weight(self, priority: str) -> float:
+        return self.weights.get(priority, 1.0)
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 结束时分页发送失败的最大次数，超过后放弃剩余内容，直接以失败状态结束卡片
+MAX_FINISH_FAILURES = 3
+
+
+class CardUpdate(NamedTuple):
+    """一次AI卡片流式更新"""
+    seq: int            # 卡片内递增的序号
+    content: str        # append为True时是增量内容，否则是完整内容
+    append: bool
+    finished: bool
+    failed: bool
+
+
+class CardStreamScheduler:
+    """
+    AI卡片流式更新调度器
+    把频繁到达的分段合并为每张卡片每秒最多N次更新，尽量只发送增量（append模式），
+    同一张卡片的更新严格按序号顺序串行发送，结束时总会发送一次finished=True的更新。
+    长回复在同一张卡片中分页发送：单次更新最多携带max_update_length个字符（尽量在换行处分页），
+    剩余内容在后续更新中追加，不会因为一次性发送完整长回复而失败。
+    """
+
+    def __init__(self, send: Callable[[CardUpdate], Awaitable[bool]],
+                 max_updates_per_second: float = 2.0, max_update_length: int = 0):
+        """
+        :param send: 发送一次卡片更新的协程函数，返回是否发送成功
+        :param max_updates_per_second: 每张卡片每秒最多更新次数
+        :param max_update_length: 单次更新最多携带的字符数，0表示不限制
+        """
+        self._send = send
+        self._min_interval = 1.0 / max_updates_per_second if max_updates_per_second > 0 else 0.0
+        self._max_update_length = max_update_length
+        self._content = ""
+        self._sent_length = 0        # 已确认送达的内容长度
+        self._full_required = True   # 首次更新或发送失败后需要发送完整内容
+        self._last_sent_at = 0.0
+        self._seq = 0
+        self._dirty = asyncio.Event()
+        self._closing = False
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def content(self) -> str:
+        """当前累计的完整内容"""
+        return self._content
+
+    @property
+    def updates_sent(self) -> int:
+        """已发送的更新次数"""
+        return self._seq
+
+    def push(self, segment: str):
+        """
+        追加一段内容，由后台任务合并发送
+        :param segment: 内容分段
+        """
+        if self._closing:
+            raise RuntimeError("卡片更新已结束，不能继续追加内容")
+        if not segment:
+            return
+        self._content += segment
+        self._dirty.set()
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def finish(self, failed: bool = False, content: str = None):
+        """
+        等待已追加的内容发送完毕，并发送最终更新
+        :param failed: 是否以失败状态结束卡片
+        :param content: 追加到末尾的内容（如错误提示）
+        """
+        if content:
+            self._content += content
+        self._closing = True
+        self._dirty.set()
+        if self._worker is not None:
+            try:
+                await self._worker
+            except Exception as e:
+                logger.error(f"卡片流式更新任务异常: {e}")
+        await self._wait_interval()
+        failures = 0
+        while True:
+            success, more = await self._flush(finished=True, failed=failed)
+            if not more:
+                # 最终更新已发送
+                return
+            if not success:
+                # 分页发送失败，下一次从头发送完整内容
+                failures += 1
+                if failures >= MAX_FINISH_FAILURES:
+                    break
+            await self._wait_interval()
+        # 剩余内容无法送达，仍然发送一次结束更新，避免卡片一直停留在输入中状态
+        logger.warning(f"卡片分页更新连续失败{failures}次，放弃剩余内容")
+        await self._wait_interval()
+        self._seq += 1
+        await self._deliver(CardUpdate(self._seq, "", True, True, True))
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            if self._closing:
+                # 剩余内容合并到最终更新中发送
+                return
+            await self._wait_interval()
+            if self._closing:
+                return
+            self._dirty.clear()
+            success, more = await self._flush(finished=False, failed=False)
+            if more and success:
+                self._dirty.set()
+
+    async def _wait_interval(self):
+        delay = self._last_sent_at + self._min_interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _deliver(self, update: CardUpdate) -> bool:
+        """发送一次更新，异常按发送失败处理"""
+        self._last_sent_at = time.monotonic()
+        try:
+            return await self._send(update)
+        except Exception as e:
+            logger.error(f"卡片流式更新异常: seq={update.seq}, {e}")
+            return False
+
+    async def _flush(self, finished: bool, failed: bool) -> Tuple[bool, bool]:
+        """
+        :return: (本次更新是否发送成功, 是否还有超出单次更新长度、留待下一次发送的内容)
+        """
+        snapshot = self._content
+        if self._full_required:
+            update_content, append = snapshot, False
+        else:
+            update_content, append = snapshot[self._sent_length:], True
+        if not update_content and not finished:
+            return True, False
+
+        more = 0 < self._max_update_length < len(update_content)
+        if more:
+            # 超出单次更新长度，本次只发送一页
+            cut = update_content.rfind("\n", 0, self._max_update_length) + 1 or self._max_update_length
+            update_content = update_content[:cut]
+            snapshot = snapshot[:self._sent_length + cut] if append else snapshot[:cut]
+            finished = failed = False
+
+        self._seq += 1
+        update = CardUpdate(self._seq, update_content, append, finished, failed)
+        success = await self._deliver(update)
+
+        if success:
+            self._sent_length = len(snapshot)
+            self._full_required = False
+        else:
+            # 增量可能丢失，下一次发送完整内容
+            logger.warning(f"卡片流式更新失败: seq={update.seq}，下次将发送完整内容")
+            self._full_required = True
+        logger.debug(f"卡片流式更新: seq={update.seq}, append={append}, "
+                     f"length={len(update_content)}, finished={finished}")
+        return success, more
@@ -0,0 +1,31 @@
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时使用标准库
+    orjson = None
+
+# 当前使用的JSON后端名称
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    解析JSON，安装了orjson时使用orjson
+    :raise ValueError: 不是合法的JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    """编码为JSON字符串，保留中文不转义"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            # orjson不支持的类型（如超过64位的整数）交给标准库处理
+            pass
+    return json.dumps(obj, ensure_ascii=False)
@@ -0,0 +1,222 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from utils import fast_json
+
+logger = logging.getLogger(__name__)
+
+# 过期key的清理间隔（秒）
+SWEEP_INTERVAL = 60
+
+
+class LocalStateServer:
+    """
+    多进程模式下由主进程提供的本机共享状态服务
+    通过Unix域套接字通信，每行一个JSON请求/响应，支持带过期时间的set/get/delete和incrby/expire，
+    语义与Redis对应命令一致，worker之间用它共享消息去重记录、限流计数等状态。
+    在独立线程的事件循环中运行。
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Unix域套接字路径
+        """
+        self.path = path
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def _get(self, key: str) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expire = entry
+        if expire is not None and expire <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def execute(self, request: dict) -> Any:
+        """
+        执行一条命令
+        :return: set成功返回True（nx且key已存在时返回None），get返回值，delete返回删除的个数，
+                 incrby返回增加后的值，expire返回key是否存在
+        """
+        op = request.get("op")
+        key = request.get("key")
+        if op == "get":
+            return self._get(key)
+        if op == "set":
+            if request.get("nx") and self._get(key) is not None:
+                return None
+            ex = request.get("ex")
+            self._data[key] = (request.get("value"), time.monotonic() + ex if ex else None)
+            return True
+        if op == "delete":
+            return 1 if self._data.pop(key, None) is not None else 0
+        if op == "incrby":
+            value = int(self._get(key) or 0) + int(request.get("amount", 1))
+            # 与Redis一致，保留原有的过期时间
+            _, expire = self._data.get(key, (None, None))
+            self._data[key] = (value, expire)
+            return value
+        if op == "expire":
+            value = self._get(key)
+            if value is None:
+                return False
+            self._data[key] = (value, time.monotonic() + request.get("seconds", 0))
+            return True
+        raise ValueError(f"不支持的命令: {op}")
+
+    def _sweep(self):
+        now = time.monotonic()
+        expired = [key for key, (_, expire) in self._data.items() if expire is not None and expire <= now]
+        for key in expired:
+            del self._data[key]
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self._sweep()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = {"result": self.execute(fast_json.loads(line))}
+                except Exception as e:
+                    response = {"error": str(e)}
+                writer.write(fast_json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_async(self):
+        """在当前事件循环中启动"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        asyncio.ensure_future(self._sweep_forever())
+        logger.info(f"共享状态服务已启动: {self.path}")
+
+    async def _close_async(self):
+        self._server.close()
+        # 取消清理任务和仍然连接着的客户端
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start(self):
+        """在后台线程中启动，返回时已开始监听"""
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self.start_async())
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._close_async())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="local-state-server", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        """停止后台线程中的服务"""
+        if self._loop is not None and self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._thread = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class LocalStateClient:
+    """
+    LocalStateServer的客户端，接口与redis.asyncio的set/get/delete/incrby/expire/aclose兼容，
+    可直接作为MessageDeduplicator、RateLimiter的redis_client使用。
+    Stream SDK重连时会新建事件循环，连接在事件循环变化后自动重建。
+    """
+
+    def __init__(self, path: str, timeout: float = 2.0):
+        """
+        :param path: Unix域套接字路径
+        :param timeout: 单次请求超时（秒）
+        """
+        self.path = path
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _reset(self):
+        if self._writer is not None and self._loop is asyncio.get_running_loop():
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _request(self, request: dict) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._reset()
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    self._reader, self._writer = await asyncio.wait_for(
+                        asyncio.open_unix_connection(self.path), self.timeout)
+                self._writer.write(fast_json.dumps(request).encode("utf-8") + b"\n")
+                await self._writer.drain()
+                line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+                if not line:
+                    raise ConnectionError("共享状态服务已断开")
+            except BaseException:
+                # 连接状态未知，下次请求重新连接
+                self._reset()
+                raise
+        response = fast_json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"共享状态服务返回错误: {response['error']}")
+        return response["result"]
+
+    async def set(self, key: str, value: Any, nx: bool = False, ex: Optional[int] = None) -> Optional[bool]:
+        return await self._request({"op": "set", "key": key, "value": value, "nx": nx, "ex": ex})
+
+    async def get(self, key: str) -> Any:
+        return await self._request({"op": "get", "key": key})
+
+    async def delete(self, key: str) -> int:
+        return await self._request({"op": "delete", "key": key})
+
+    async def incrby(self, key: str, amount: int = 1) -> int:
+        return await self._request({"op": "incrby", "key": key, "amount": amount})
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        return await self._request({"op": "expire", "key": key, "seconds": seconds})
+
+    async def aclose(self):
+        if self._loop is asyncio.get_running_loop():
+            self._reset()
+        self._reader = self._writer = None
@@ -0,0 +1,240 @@
+import re
+from typing import List, Optional
+
+# 代码块围栏：行首最多3个空格，后跟至少3个 ` 或 ~
+FENCE_PATTERN = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+
+
+class MarkdownSegmenter:
+    """
+    增量Markdown分段器
+    按句号、感叹号、问号、换行切分流式文本，代码块整体作为一段输出，不会在代码块内部切分。
+    所有分段拼接后与输入文本完全一致。
+    """
+
+    SENTENCE_ENDINGS = "。！？"
+
+    def __init__(self):
+        self._pending = ""
+        self._pos = 0            # 已扫描到的位置
+        self._line_start = 0     # 当前行在_pending中的起点
+        self._mid_line = False   # 当前行的开头已经在之前的分段中输出
+        self._fence = None       # 当前所在代码块的围栏标记
+
+    def feed(self, text: str) -> List[str]:
+        """
+        喂入一段流式文本
+        :param text: 文本增量
+        :return: 已完整的分段列表
+        """
+        self._pending += text
+        segments = []
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            segments.append(self._pending[:cut])
+            self._pending = self._pending[cut:]
+            self._pos = 0
+            if self._line_start >= cut:
+                self._line_start -= cut
+            else:
+                self._line_start = 0
+                self._mid_line = True
+        return segments
+
+    def flush(self) -> Optional[str]:
+        """
+        输出剩余内容（包括未闭合的代码块）
+        :return: 剩余分段，没有则返回None
+        """
+        remaining = self._pending
+        self._pending = ""
+        self._pos = 0
+        self._line_start = 0
+        self._mid_line = False
+        self._fence = None
+        return remaining or None
+
+    @property
+    def in_code_block(self) -> bool:
+        """当前是否处于未闭合的代码块中"""
+        return self._fence is not None
+
+    def _find_cut(self) -> Optional[int]:
+        buf = self._pending
+        i = self._pos
+        length = len(buf)
+        while i < length:
+            ch = buf[i]
+            if ch == "\n":
+                if not self._mid_line:
+                    self._update_fence(buf[self._line_start:i])
+                self._mid_line = False
+                i += 1
+                self._line_start = i
+                if self._fence is None:
+                    return i
+                continue
+            if (ch in self.SENTENCE_ENDINGS and self._fence is None
+                    and not self._line_may_be_fence(buf[self._line_start:i])):
+                return i + 1
+            i += 1
+        self._pos = i
+        return None
+
+    def _line_may_be_fence(self, line_prefix: str) -> bool:
+        if self._mid_line:
+            return False
+        return FENCE_PATTERN.match(line_prefix) is not None
+
+    def _update_fence(self, line: str):
+        match = FENCE_PATTERN.match(line)
+        if not match:
+            return
+        marker = match.group(1)
+        if self._fence is None:
+            self._fence = marker
+        elif (marker[0] == self._fence[0] and len(marker) >= len(self._fence)
+              and not line[match.end():].strip()):
+            self._fence = None
+
+
+def _is_table_row(line: str) -> bool:
+    return line.lstrip().startswith("|")
+
+
+# 表格分隔行，如 |---|:---:|
+TABLE_DELIMITER_PATTERN = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+
+
+class MarkdownPaginator:
+    """
+    增量Markdown分页器
+    把流式文本按不超过page_size的长度分页，只在块之间分页，不会切开代码块和表格，优先在段落之间分页；
+    某一页写满时立即输出，不必等待完整回复。
+    单个代码块或表格超过一页时才在块内分页：代码块在页末补上结束围栏、下一页重新打开，表格在下一页重复表头。
+    除此之外，所有页拼接后与输入文本完全一致。
+    """
+
+    def __init__(self, page_size: int = 2000):
+        """
+        :param page_size: 每页最大字符数
+        """
+        self.page_size = max(100, page_size)
+        self._buffer = ""           # 未完整的最后一行
+        self._page = ""
+        self._cut = 0               # 当前页中最后一个可以分页的位置
+        self._paragraph_cut = 0     # 当前页中最后一个段落之间的分页位置
+        self._prev_blank = True
+        self._fence = None          # 当前所在代码块的围栏标记
+        self._fence_line = ""       # 代码块的开始行
+        self._table = []            # 当前表格的表头行（表头和分隔行）
+
+    def feed(self, text: str) -> List[str]:
+        """
+        喂入一段流式文本
+        :param text: 文本增量
+        :return: 已写满的页
+        """
+        self._buffer += text
+        pages = []
+        start = 0
+        while True:
+            end = self._buffer.find("\n", start)
+            if end < 0:
+                break
+            self._add_line(self._buffer[start:end + 1], pages)
+            start = end + 1
+        self._buffer = self._buffer[start:]
+        return pages
+
+    def flush(self) -> List[str]:
+        """
+        输出剩余内容
+        :return: 剩余的页（最后一页可能不满）
+        """
+        pages = []
+        if self._buffer:
+            self._add_line(self._buffer, pages)
+            self._buffer = ""
+        if self._page:
+            pages.append(self._page)
+        self._page = ""
+        self._cut = self._paragraph_cut = 0
+        self._prev_blank = True
+        self._fence = None
+        self._table = []
+        return pages
+
+    def _reserve(self) -> int:
+        """代码块内分页时页末需要补上的结束围栏长度"""
+        return len(self._fence) + 2 if self._fence is not None else 0
+
+    def _fits(self, line: str) -> bool:
+        return len(self._page) + len(line) + self._reserve() <= self.page_size
+
+    def _add_line(self, line: str, pages: List[str]):
+        # 代码块内部、表格的两行之间不能分页
+        if self._fence is None and not (self._table and _is_table_row(line)):
+            self._cut = len(self._page)
+            if self._prev_blank:
+                self._paragraph_cut = self._cut
+        if not self._fits(line) and self._page:
+            cut = self._paragraph_cut if self._paragraph_cut >= self.page_size // 2 else self._cut
+            if cut > 0:
+                pages.append(self._page[:cut])
+                self._page = self._page[cut:]
+                self._cut = self._cut - cut if self._cut > cut else 0
+                self._paragraph_cut = 0
+        while not self._fits(line):
+            room = self.page_size - len(self._page) - self._reserve()
+            if room > 0 and (not self._page or room >= self.page_size // 4):
+                # 一行超过一页，尽量在句子或空格后切开
+                piece = self._split_point(line, room)
+                self._page += line[:piece]
+                line = line[piece:]
+            self._continue_block(pages)
+        self._page += line
+        self._update_state(line)
+
+    def _continue_block(self, pages: List[str]):
+        """当前块超过一页，在块内分页"""
+        page = self._page
+        if self._fence is not None:
+            if not page.endswith("\n"):
+                page += "\n"
+            pages.append(page + self._fence + "\n")
+            reopen = self._fence_line
+        else:
+            pages.append(page)
+            reopen = "".join(self._table) if len(self._table) == 2 and self._table[1] else ""
+        self._page = reopen if len(reopen) <= self.page_size // 4 else ""
+        self._cut = self._paragraph_cut = 0
+
+    @staticmethod
+    def _split_point(line: str, room: int) -> int:
+        for i in range(room - 1, room // 2, -1):
+            if line[i] in "。！？.!? ":
+                return i + 1
+        return room
+
+    def _update_state(self, line: str):
+        content = line.rstrip("\n")
+        in_fence = self._fence is not None
+        match = FENCE_PATTERN.match(content)
+        if in_fence:
+            if (match and match.group(1)[0] == self._fence[0] and len(match.group(1)) >= len(self._fence)
+                    and not content[match.end():].strip()):
+                self._fence = None
+        elif match:
+            self._fence = match.group(1)
+            self._fence_line = content + "\n"
+        if in_fence or self._fence is not None or not _is_table_row(content):
+            self._table = []
+        elif not self._table:
+            self._table = [content + "\n"]
+        elif len(self._table) == 1:
+            # 只有第二行是分隔行时才是表格，分页后重复表头
+            self._table.append(content + "\n" if TABLE_DELIMITER_PATTERN.match(content) else "")
+        self._prev_blank = not content.strip()
@@ -0,0 +1,114 @@
+import time
+import logging
+from typing import Optional, Set
+
+from utils.local_state import LocalStateClient
+from utils.metrics import DUPLICATES_TOTAL
+
+logger = logging.getLogger(__name__)
+
+
+class MessageDeduplicator:
+    """
+    消息去重，用于丢弃Stream SDK在重连或ACK较慢时重复投递的回调
+    本地使用两代轮换的集合，只保存消息ID的哈希值；每隔ttl秒轮换一次，
+    因此一条消息至少在ttl秒内（最多2*ttl秒）可识别为重复。
+    配置了Redis客户端时再用 SET NX EX 在多个进程之间共享去重结果。
+    """
+
+    def __init__(self, ttl: float = 300, redis_client=None, key_prefix: str = "dingtalk_bot:msg:"):
+        """
+        :param ttl: 去重时间窗口（秒）
+        :param redis_client: redis.asyncio兼容的客户端，为空时只在本进程内去重
+        :param key_prefix: Redis key前缀
+        """
+        self.ttl = ttl
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+        self._current: Set[int] = set()
+        self._previous: Set[int] = set()
+        self._rotated_at = time.monotonic()
+        self.checked = 0
+        self.duplicates = 0
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "MessageDeduplicator":
+        """根据Redis地址创建跨进程共享的去重器，需要安装redis包"""
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("跨进程消息去重需要安装redis: pip install redis")
+        return cls(redis_client=redis.from_url(url), **kwargs)
+
+    def _rotate(self):
+        elapsed = time.monotonic() - self._rotated_at
+        if elapsed < self.ttl:
+            return
+        # 长时间没有消息时上一代也已过期，直接丢弃
+        self._previous = self._current if elapsed < 2 * self.ttl else set()
+        self._current = set()
+        self._rotated_at = time.monotonic()
+
+    def _seen_locally(self, msg_id: str) -> bool:
+        self._rotate()
+        digest = hash(msg_id)
+        if digest in self._current or digest in self._previous:
+            return True
+        self._current.add(digest)
+        return False
+
+    async def is_duplicate(self, msg_id: Optional[str]) -> bool:
+        """
+        判断消息是否已处理过，未处理过的消息会被记录
+        :param msg_id: 回调中的msgId，为空时不去重
+        :return: 重复投递返回True
+        """
+        if not msg_id:
+            return False
+        self.checked += 1
+        duplicate = self._seen_locally(msg_id)
+        if not duplicate and self.redis is not None:
+            try:
+                stored = await self.redis.set(self.key_prefix + msg_id, 1, nx=True, ex=max(1, int(self.ttl)))
+                duplicate = not stored
+            except Exception as e:
+                # 共享存储不可用时退化为本进程去重
+                logger.error(f"读写消息去重记录异常: {e}")
+        if duplicate:
+            self.duplicates += 1
+            DUPLICATES_TOTAL.inc()
+            logger.info(f"丢弃重复投递的消息: msgId={msg_id}, {self.stats()}")
+        return duplicate
+
+    def stats(self) -> dict:
+        """去重统计信息"""
+        return {
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+            "tracked": len(self._current) + len(self._previous),
+        }
+
+    async def close(self):
+        if self.redis is not None:
+            close = getattr(self.redis, "aclose", None) or getattr(self.redis, "close", None)
+            if close:
+                await close()
+
+
+def create_message_deduplicator(config) -> Optional[MessageDeduplicator]:
+    """
+    根据配置创建消息去重器
+    :return: 去重器实例，未启用时返回None
+    """
+    backend = config.MESSAGE_DEDUP_BACKEND.lower()
+    if backend in ("", "none"):
+        return None
+    if backend == "redis":
+        return MessageDeduplicator.from_url(config.REDIS_URL, ttl=config.MESSAGE_DEDUP_TTL)
+    if backend == "memory":
+        if config.LOCAL_STATE_SOCKET:
+            # 多进程模式下通过主进程在各worker之间共享
+            return MessageDeduplicator(ttl=config.MESSAGE_DEDUP_TTL,
+                                       redis_client=LocalStateClient(config.LOCAL_STATE_SOCKET))
+        return MessageDeduplicator(ttl=config.MESSAGE_DEDUP_TTL)
+    raise ValueError(f"不支持的消息去重后端: {config.MESSAGE_DEDUP_BACKEND}")
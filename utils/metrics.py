@@ -0,0 +1,292 @@
+import json
+import math
+import time
+import asyncio
+import logging
+import threading
+from functools import partial
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    # 指标服务是可选的，aiohttp.web在启动服务时才导入，不增加未启用时的启动耗时
+    from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# 默认的延迟分桶（秒），覆盖毫秒级的ACK到分钟级的AI回复
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标{self.name}的标签应为{self.labelnames}，实际为{tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        # 指标在事件循环线程中更新、在HTTP线程中读取，先复制一份
+        for key, value in sorted(list(self._values.items())):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """瞬时值，读取时调用回调函数"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.func = func
+
+    def render(self) -> List[str]:
+        try:
+            value = float(self.func())
+        except Exception as e:
+            logger.error(f"读取指标{self.name}异常: {e}")
+            return []
+        return super().render() + [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """分桶统计的直方图，用于记录各阶段耗时"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # 标签值 -> [各分桶计数, 总和, 总数]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, (counts, total, count) in sorted(list(self._values.items())):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, list(counts)):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，按Prometheus文本格式输出"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# 各阶段耗时
+CALLBACK_ACK_SECONDS = REGISTRY.register(Histogram(
+    "dingtalk_bot_callback_ack_seconds", "收到Stream回调到返回ACK的耗时"))
+QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "dingtalk_bot_queue_wait_seconds", "消息在处理队列中的等待时间", ["priority"]))
+WEBHOOK_SECONDS = REGISTRY.register(Histogram(
+    "dingtalk_bot_webhook_seconds", "n8n webhook调用耗时", ["mode"]))
+CARD_CREATE_SECONDS = REGISTRY.register(Histogram(
+    "dingtalk_bot_card_create_seconds", "AI卡片创建并投放的耗时"))
+FIRST_CARD_UPDATE_SECONDS = REGISTRY.register(Histogram(
+    "dingtalk_bot_first_card_update_seconds", "收到消息到第一次更新卡片内容的耗时"))
+REPLY_SECONDS = REGISTRY.register(Histogram(
+    "dingtalk_bot_reply_seconds", "收到消息到回复完成的总耗时", ["handler"]))
+
+# 计数
+FAILURES_TOTAL = REGISTRY.register(Counter(
+    "dingtalk_bot_failures_total", "各阶段失败次数", ["stage"]))
+TIMEOUTS_TOTAL = REGISTRY.register(Counter(
+    "dingtalk_bot_timeouts_total", "各阶段超时次数", ["stage"]))
+CACHE_HITS_TOTAL = REGISTRY.register(Counter(
+    "dingtalk_bot_cache_hits_total", "回复缓存命中次数"))
+REJECTED_TOTAL = REGISTRY.register(Counter(
+    "dingtalk_bot_rejected_total", "队列已满被拒绝（回复繁忙提示）的消息数"))
+DUPLICATES_TOTAL = REGISTRY.register(Counter(
+    "dingtalk_bot_duplicates_total", "被丢弃的重复投递消息数"))
+RATE_LIMITED_TOTAL = REGISTRY.register(Counter(
+    "dingtalk_bot_rate_limited_total", "超出用户或会话限流、每日配额被拒绝的消息数", ["limit"]))
+
+
+class MetricsServer:
+    """
+    指标与健康检查HTTP服务
+    GET /metrics 返回Prometheus文本格式的指标；GET /healthz 返回各健康检查项的状态，
+    全部正常时HTTP 200，否则HTTP 503。
+    在独立线程的事件循环中运行，不受Stream客户端重建事件循环的影响。
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 9090, registry: MetricsRegistry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._health_checks: Dict[str, Callable[[], Tuple[bool, str]]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional["web.AppRunner"] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def add_health_check(self, name: str, check: Callable[[], Tuple[bool, str]]):
+        """
+        注册健康检查项
+        :param check: 返回 (是否健康, 说明) 的函数
+        """
+        self._health_checks[name] = check
+
+    def health(self) -> Tuple[bool, dict]:
+        """执行所有健康检查"""
+        results = {}
+        healthy = True
+        for name, check in list(self._health_checks.items()):
+            try:
+                ok, detail = check()
+            except Exception as e:
+                ok, detail = False, f"检查异常: {e}"
+            healthy = healthy and ok
+            results[name] = {"ok": ok, "detail": detail}
+        return healthy, results
+
+    async def _handle_metrics(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+        return web.Response(text=self.registry.render(), content_type="text/plain",
+                            headers={"X-Content-Type-Options": "nosniff"}, charset="utf-8")
+
+    async def _handle_health(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+        healthy, results = self.health()
+        return web.json_response({"status": "ok" if healthy else "unhealthy", "checks": results},
+                                 status=200 if healthy else 503,
+                                 dumps=partial(json.dumps, ensure_ascii=False))
+
+    def make_app(self) -> "web.Application":
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        app.router.add_get("/healthz", self._handle_health)
+        return app
+
+    async def start_async(self):
+        """在当前事件循环中启动"""
+        from aiohttp import web
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if self.port == 0:
+            self.port = site._server.sockets[0].getsockname()[1]
+        logger.info(f"指标服务已启动: http://{self.host}:{self.port}/metrics")
+
+    def start(self):
+        """在后台线程中启动，返回时已开始监听"""
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self.start_async())
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="metrics-server", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        """停止后台线程中的服务"""
+        if self._loop is not None and self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+def since(started: float) -> float:
+    """从started（time.monotonic()）到现在经过的秒数"""
+    return time.monotonic() - started
@@ -0,0 +1,232 @@
+import math
+import time
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from utils.local_state import LocalStateClient
+from utils.metrics import RATE_LIMITED_TOTAL
+
+logger = logging.getLogger(__name__)
+
+SCOPE_USER = "user"
+SCOPE_CONVERSATION = "conversation"
+
+# 清理过期本地计数器的间隔（秒）
+SWEEP_INTERVAL = 60
+# 共享存储模式下缓存的上一窗口计数的最大条数
+MAX_CACHED_PREVIOUS = 10000
+
+
+class Limit(NamedTuple):
+    """一条限流规则"""
+    name: str           # 规则名，用于日志、指标和共享存储的key
+    scope: str          # user（按发送者staffId）/conversation（按会话ID）
+    limit: int          # 窗口内允许的最大请求数
+    window: float       # 窗口长度（秒）
+    sliding: bool       # 滑动窗口；否则为固定窗口（如按自然日计算的每日配额）
+    offset: float = 0   # 固定窗口的起点偏移（秒），按天计算时用于对齐本地零点
+
+
+class RateLimiter:
+    """
+    按用户和会话的滑动窗口限流与每日配额，在调用AIService之前检查，超出限制的消息不会触发webhook
+    每个key只保存窗口序号、当前窗口计数和上一窗口计数三个值，
+    滑动窗口的请求数按 当前窗口计数 + 上一窗口计数 * 上一窗口仍在滑动窗口内的比例 估算，
+    不需要记录每个请求的时间戳，内存占用与活跃用户数成正比。
+    配置了Redis客户端时计数保存在共享存储中（INCRBY + EXPIRE），多个进程共用同一份限额；
+    共享存储不可用时退化为本进程计数。
+    """
+
+    def __init__(self, limits: List[Limit], redis_client=None, key_prefix: str = "dingtalk_bot:rate:"):
+        """
+        :param limits: 限流规则，limit不大于0的规则被忽略
+        :param redis_client: redis.asyncio兼容的客户端，为空时只在本进程内计数
+        :param key_prefix: Redis key前缀
+        """
+        self.limits = [limit for limit in limits if limit.limit > 0]
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+        # (规则序号, 用户或会话ID) -> [窗口序号, 当前窗口计数, 上一窗口计数]
+        self._counters: Dict[Tuple[int, str], List[int]] = {}
+        # 共享存储中已经结束的窗口的计数不再变化，缓存在本地
+        self._previous: Dict[str, int] = {}
+        self._swept_at = time.monotonic()
+        self.checked = 0
+        self.limited = 0
+
+    @classmethod
+    def from_url(cls, url: str, limits: List[Limit], **kwargs) -> "RateLimiter":
+        """根据Redis地址创建跨进程共享限额的限流器，需要安装redis包"""
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("跨进程限流需要安装redis: pip install redis")
+        return cls(limits, redis_client=redis.from_url(url), **kwargs)
+
+    def _targets(self, user_id: Optional[str], conversation_id: Optional[str],
+                 now: float) -> List[Tuple[int, Limit, str, int, float]]:
+        """返回 (规则序号, 规则, 用户或会话ID, 窗口序号, 当前窗口已过去的比例)"""
+        targets = []
+        for index, limit in enumerate(self.limits):
+            subject = user_id if limit.scope == SCOPE_USER else conversation_id
+            if not subject:
+                continue
+            position = (now + limit.offset) / limit.window
+            window = int(position)
+            targets.append((index, limit, subject, window, position - window))
+        return targets
+
+    @staticmethod
+    def _estimate(limit: Limit, current: int, previous: int, elapsed: float) -> float:
+        if not limit.sliding:
+            return current
+        return current + previous * (1 - elapsed)
+
+    async def check(self, user_id: Optional[str], conversation_id: Optional[str]) -> Optional[str]:
+        """
+        检查并记录一次请求
+        :param user_id: 发送者staffId
+        :param conversation_id: 会话ID
+        :return: 未超出限制时返回None并计入各规则；超出时返回第一条超出的规则名，本次请求不计数
+        """
+        if not self.limits:
+            return None
+        self.checked += 1
+        now = time.time()
+        targets = self._targets(user_id, conversation_id, now)
+        if self.redis is not None:
+            try:
+                exceeded = await self._check_shared(targets)
+            except Exception as e:
+                # 共享存储不可用时退化为本进程计数
+                logger.error(f"读写限流计数异常: {e}")
+                exceeded = self._check_local(targets)
+        else:
+            exceeded = self._check_local(targets)
+        if exceeded is not None:
+            self.limited += 1
+            RATE_LIMITED_TOTAL.inc(limit=exceeded)
+            logger.info(f"请求超出限制({exceeded}): user={user_id}, conversation={conversation_id}")
+        return exceeded
+
+    def _check_local(self, targets: List[Tuple[int, Limit, str, int, float]]) -> Optional[str]:
+        self._sweep()
+        counters = []
+        for index, limit, subject, window, elapsed in targets:
+            counter = self._counters.get((index, subject))
+            if counter is None:
+                counter = [window, 0, 0]
+            elif counter[0] != window:
+                # 进入新窗口，只有紧邻的上一窗口计入估算
+                counter[:] = [window, 0, counter[1] if counter[0] == window - 1 else 0]
+            if self._estimate(limit, counter[1], counter[2], elapsed) + 1 > limit.limit:
+                return limit.name
+            counters.append(((index, subject), counter))
+        for key, counter in counters:
+            counter[1] += 1
+            self._counters[key] = counter
+        return None
+
+    def _sweep(self):
+        """回收已有两个窗口以上没有请求的本地计数器"""
+        if time.monotonic() - self._swept_at < SWEEP_INTERVAL:
+            return
+        self._swept_at = time.monotonic()
+        now = time.time()
+        expired = [key for key, (window, _, _) in self._counters.items()
+                   if window < int((now + self.limits[key[0]].offset) / self.limits[key[0]].window) - 1]
+        for key in expired:
+            del self._counters[key]
+
+    def _key(self, limit: Limit, subject: str, window: int) -> str:
+        return f"{self.key_prefix}{limit.name}:{subject}:{window}"
+
+    async def _check_shared(self, targets: List[Tuple[int, Limit, str, int, float]]) -> Optional[str]:
+        counted = []
+        try:
+            for _, limit, subject, window, elapsed in targets:
+                key = self._key(limit, subject, window)
+                # 先计数再判断，多个进程同时请求时不会同时通过最后一个名额
+                current = int(await self.redis.incrby(key, 1))
+                counted.append(key)
+                if current == 1:
+                    # 上一窗口的计数在当前窗口结束前仍要读取
+                    await self.redis.expire(key, int(math.ceil(limit.window * 2)))
+                previous = await self._shared_previous(limit, subject, window) if limit.sliding else 0
+                if self._estimate(limit, current, previous, elapsed) > limit.limit:
+                    exceeded = limit.name
+                    break
+            else:
+                return None
+        except BaseException:
+            await self._rollback(counted)
+            raise
+        await self._rollback(counted)
+        return exceeded
+
+    async def _shared_previous(self, limit: Limit, subject: str, window: int) -> int:
+        key = self._key(limit, subject, window - 1)
+        if key not in self._previous:
+            if len(self._previous) >= MAX_CACHED_PREVIOUS:
+                self._previous.clear()
+            self._previous[key] = int(await self.redis.get(key) or 0)
+        return self._previous[key]
+
+    async def _rollback(self, keys: List[str]):
+        """被拒绝的请求不占用名额"""
+        for key in keys:
+            try:
+                await self.redis.incrby(key, -1)
+            except Exception as e:
+                logger.error(f"回滚限流计数异常: {e}")
+
+    def stats(self) -> dict:
+        """限流统计信息"""
+        return {
+            "checked": self.checked,
+            "limited": self.limited,
+            "tracked": len(self._counters),
+        }
+
+    async def close(self):
+        if self.redis is not None:
+            close = getattr(self.redis, "aclose", None) or getattr(self.redis, "close", None)
+            if close:
+                await close()
+
+
+def local_day_offset() -> float:
+    """本地时区相对UTC的偏移（秒），使每日配额在本地零点重置"""
+    return float(time.localtime().tm_gmtoff)
+
+
+def create_rate_limiter(config) -> Optional[RateLimiter]:
+    """
+    根据配置创建限流器
+    :return: 限流器实例，没有配置任何限制时返回None
+    """
+    day = 24 * 3600
+    limits = [
+        Limit("user_rate", SCOPE_USER, config.RATE_LIMIT_PER_USER, config.RATE_LIMIT_WINDOW, True),
+        Limit("conversation_rate", SCOPE_CONVERSATION, config.RATE_LIMIT_PER_CONVERSATION,
+              config.RATE_LIMIT_WINDOW, True),
+        Limit("user_daily", SCOPE_USER, config.DAILY_QUOTA_PER_USER, day, False, local_day_offset()),
+        Limit("conversation_daily", SCOPE_CONVERSATION, config.DAILY_QUOTA_PER_CONVERSATION,
+              day, False, local_day_offset()),
+    ]
+    if not any(limit.limit > 0 for limit in limits):
+        return None
+    backend = config.RATE_LIMIT_BACKEND.lower()
+    if backend == "redis":
+        return RateLimiter.from_url(config.REDIS_URL, limits)
+    if backend == "memory":
+        if config.LOCAL_STATE_SOCKET:
+            # 多进程模式下通过主进程在各worker之间共享限额
+            return RateLimiter(limits, redis_client=LocalStateClient(config.LOCAL_STATE_SOCKET))
+        return RateLimiter(limits)
+    raise ValueError(f"不支持的限流后端: {config.RATE_LIMIT_BACKEND}")
+
+
+def limit_message(config, name: str) -> str:
+    """超出限制时回复用户的提示"""
+    return config.DAILY_QUOTA_MESSAGE if name.endswith("_daily") else config.RATE_LIMIT_MESSAGE
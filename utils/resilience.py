@@ -0,0 +1,175 @@
+import time
+import random
+import logging
+from collections import deque
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开时快速失败"""
+
+
+class CircuitBreaker:
+    """
+    熔断器
+    连续失败达到阈值后打开，期间请求直接失败；经过恢复时间后进入半开状态，
+    只放行一个探测请求，探测成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30, name: str = ""):
+        """
+        :param failure_threshold: 连续失败多少次后打开，小于等于0表示不熔断
+        :param recovery_timeout: 打开后多久进入半开状态（秒）
+        :param name: 名称，用于日志
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.name = name
+        self.failures = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_started_at = None
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        """是否处于快速失败状态（半开且探测进行中也算）"""
+        return not self._would_allow()
+
+    def _would_allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        # 半开：同一时间只放行一个探测；探测迟迟没有结果时允许重新探测
+        return self._probe_started_at is None or \
+            time.monotonic() - self._probe_started_at >= self.recovery_timeout
+
+    def allow(self) -> bool:
+        """
+        是否允许发起请求，半开状态下放行的请求即为探测请求
+        :return: 允许返回True
+        """
+        if not self._would_allow():
+            return False
+        if self.state == self.HALF_OPEN:
+            self._probe_started_at = time.monotonic()
+            logger.info(f"熔断器{self.name}半开，发起探测请求")
+        return True
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logger.info(f"熔断器{self.name}探测成功，恢复正常")
+        self._state = self.CLOSED
+        self.failures = 0
+        self._probe_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failure_threshold <= 0:
+            return
+        if self._state != self.CLOSED or self.failures >= self.failure_threshold:
+            if self._state == self.CLOSED:
+                logger.warning(f"熔断器{self.name}打开: 连续失败{self.failures}次")
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probe_started_at = None
+
+
+class RetryPolicy:
+    """有限次数重试，退避时间按指数增长并加入随机抖动（full jitter）"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 4,
+                 retry_statuses: Iterable[int] = (429, 502, 503, 504)):
+        """
+        :param max_attempts: 最多尝试次数（包括第一次）
+        :param base_delay: 第一次重试前的最大等待时间（秒）
+        :param max_delay: 单次等待时间上限（秒）
+        :param retry_statuses: 可重试的HTTP状态码
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def is_retryable(self, status: int) -> bool:
+        return status in self.retry_statuses
+
+    def delay(self, attempt: int) -> float:
+        """
+        第attempt次尝试失败后的等待时间
+        :param attempt: 从0开始的尝试序号
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class HedgePolicy:
+    """
+    对冲请求策略
+    请求超过最近延迟的指定百分位仍未返回时再发一个请求，先返回的结果生效；
+    每个请求积累budget个令牌，每次对冲消耗一个，因此对冲带来的额外负载不超过budget
+    """
+
+    def __init__(self, percentile: float = 95, budget: float = 0.05, min_samples: int = 20,
+                 window: int = 200, max_tokens: float = 10):
+        """
+        :param percentile: 触发对冲的延迟百分位
+        :param budget: 额外请求占比上限，如0.05表示最多多出5%的请求
+        :param min_samples: 延迟样本数达到多少后才开始对冲
+        :param window: 保留最近多少个延迟样本
+        :param max_tokens: 令牌上限，限制空闲后突发的对冲数量
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self._latencies = deque(maxlen=window)
+        self._tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+
+    def observe(self, latency: float):
+        """记录一次成功请求的延迟"""
+        self._latencies.append(latency)
+
+    def record_request(self):
+        """记录一次原始请求，积累对冲令牌"""
+        self.requests += 1
+        self._tokens = min(self.max_tokens, self._tokens + self.budget)
+
+    def delay(self) -> Optional[float]:
+        """
+        原始请求发出后多久触发对冲
+        :return: 秒数，样本不足时返回None（不对冲）
+        """
+        if len(self._latencies) < max(1, self.min_samples):
+            return None
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return latencies[index]
+
+    def try_acquire(self) -> bool:
+        """尝试消耗一个对冲令牌，预算用完返回False"""
+        # 留出浮点累加误差
+        if self._tokens < 1 - 1e-9:
+            return False
+        self._tokens = max(0.0, self._tokens - 1)
+        self.hedges += 1
+        return True
+
+
+def parse_statuses(value: str) -> list:
+    """解析逗号分隔的HTTP状态码列表"""
+    return [int(item) for item in value.split(",") if item.strip()]
@@ -0,0 +1,397 @@
+import re
+import codecs
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from utils import fast_json
+
+logger = logging.getLogger(__name__)
+
+# 默认的回复字段，按优先级排列
+DEFAULT_RESPONSE_PATHS = "output,response,data.reply,message,content"
+
+# 不超过该长度（字节）的响应直接完整读取，保持HTTP连接可复用
+FULL_READ_LIMIT = 64 * 1024
+# 逐字符跳过无关字段比C实现的完整解析慢，单个字段超过该长度时改为读完后完整解析
+SKIP_LIMIT = 64 * 1024
+
+PathSegment = Union[str, int]
+Path = Tuple[PathSegment, ...]
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+# 字符串开头引号之后的部分
+_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_STRING_STOP = re.compile(r'["\\]')
+# 括号以外的内容：完整的字符串，或不含引号和括号的字符
+_SKIP_RUN = re.compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+_SCALAR = re.compile(r"[^\s,\]}]+")
+
+
+def compile_paths(spec: Union[str, Iterable[str]]) -> List[Path]:
+    """
+    编译回复字段路径
+    :param spec: 逗号分隔的路径列表，如 "output,data.reply,choices.0.message.content"，
+                 路径各段用.分隔，纯数字表示列表下标
+    :return: 路径元组列表，顺序即优先级
+    """
+    if isinstance(spec, str):
+        spec = spec.split(",")
+    paths = []
+    for item in spec:
+        item = item.strip()
+        if not item:
+            continue
+        segments = tuple(int(part) if part.isdigit() else part for part in item.split("."))
+        if any(part == "" for part in segments):
+            raise ValueError(f"回复字段路径格式错误: {item}")
+        paths.append(segments)
+    if not paths:
+        raise ValueError("至少需要一个回复字段路径")
+    return paths
+
+
+def _resolve(data: Any, path: Iterable[PathSegment]) -> Any:
+    for part in path:
+        if isinstance(part, int):
+            if not isinstance(data, list) or part >= len(data):
+                return None
+        elif not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+
+class ResponseExtractor:
+    """
+    按配置的字段路径从n8n响应中提取AI回复
+    路径在创建时编译；响应为列表时在第一个元素上查找（n8n常返回单元素列表）。
+    读取响应时增量扫描顶层字段，只解码路径涉及的字段，
+    更高优先级的字段都已不可能出现时停止读取，不解码n8n附带的执行数据等无关内容。
+    路径涉及的顶层字段重复出现时取第一次出现的值，无论响应大小、是否增量读取都相同。
+    """
+
+    def __init__(self, paths: Union[str, Iterable[str]] = DEFAULT_RESPONSE_PATHS):
+        """
+        :param paths: 回复字段路径列表，或逗号分隔的字符串，顺序即优先级
+        """
+        self.paths = compile_paths(paths)
+        # 顶层字段 -> 以它开头的路径的最高优先级
+        self.first_keys: Dict[str, int] = {}
+        for priority, path in enumerate(self.paths):
+            if isinstance(path[0], str):
+                self.first_keys.setdefault(path[0], priority)
+        # 有以列表下标开头的路径时无法只扫描顶层字段，退化为完整解析
+        self.incremental = all(isinstance(path[0], str) for path in self.paths)
+        # (首段, 剩余路径)，首段是字段名时先用in判断，避免逐条路径完整查找
+        self._steps = [(path[0], path[1:]) for path in self.paths]
+        # 顶层字段名的JSON编码，用于判断完整解析前这些字段是否可能重复
+        self._quoted_keys = [fast_json.dumps(key) for key in self.first_keys]
+        self._quoted_key_bytes = [key.encode("utf-8") for key in self._quoted_keys]
+
+    def extract(self, data: Any) -> Optional[str]:
+        """
+        从已解析的响应中提取回复
+        :return: 回复文本，没有匹配的字段时返回None
+        """
+        item = data[0] if isinstance(data, list) and data else data
+        if isinstance(item, str):
+            return item
+        is_dict = isinstance(item, dict)
+        for head, tail in self._steps:
+            if isinstance(head, int):
+                value = _resolve(data, (head,) + tail)
+            elif is_dict and head in item:
+                value = _resolve(item[head], tail) if tail else item[head]
+            else:
+                continue
+            if isinstance(value, str):
+                return value
+        return None
+
+    def parse(self, body: Union[str, bytes]) -> Optional[str]:
+        """
+        从完整的响应体中提取回复
+        :raise ValueError: 响应体不是合法的JSON
+        """
+        if not body.strip():
+            return None
+        if len(body) <= FULL_READ_LIMIT:
+            # 小响应直接完整解析更快
+            return self._decode(body)
+        return self._scan(body)
+
+    def _scan(self, body: Union[str, bytes], skip_limit: Optional[int] = SKIP_LIMIT) -> Optional[str]:
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        scanner = _ResponseScanner(self, skip_limit)
+        if not scanner.feed(body):
+            scanner.finish()
+        return scanner.result
+
+    def _decode(self, body: Union[str, bytes]) -> Optional[str]:
+        """
+        完整解析后提取回复
+        完整解析时重复的字段取最后一次出现的值，路径涉及的顶层字段可能重复时改为逐个字段扫描，取第一次出现的值
+        """
+        if self.incremental and self._may_repeat_keys(body):
+            return self._scan(body, skip_limit=None)
+        return self.extract(fast_json.loads(body))
+
+    def _may_repeat_keys(self, body: Union[str, bytes]) -> bool:
+        """字段名出现多次（也可能在嵌套对象或字符串中）时返回True"""
+        quoted_keys = self._quoted_keys if isinstance(body, str) else self._quoted_key_bytes
+        return any(body.count(key) > 1 for key in quoted_keys)
+
+    async def read(self, response, chunk_size: int = FULL_READ_LIMIT) -> Optional[str]:
+        """
+        边读取aiohttp响应边提取回复，提取完成后不再读取剩余内容
+        :param response: aiohttp.ClientResponse
+        :raise ValueError: 响应体不是合法的JSON
+        """
+        length = response.content_length
+        if length is not None and length <= chunk_size:
+            return self.parse(await response.read())
+        scanner = _ResponseScanner(self)
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if scanner.feed(decoder.decode(chunk)):
+                # 未读完的响应在退出上下文时关闭连接，不会被复用
+                logger.debug(f"已提取AI回复，停止读取n8n响应，已读取{scanner.consumed}个字符")
+                return scanner.result
+        if not scanner.feed(decoder.decode(b"", final=True)):
+            scanner.finish()
+        return scanner.result
+
+
+class _Incomplete(Exception):
+    """缓冲区中的数据还不够，需要继续读取"""
+
+
+class _SkipLimitExceeded(Exception):
+    """要跳过的字段太大，改为完整解析"""
+
+
+class _ResponseScanner:
+    """
+    增量扫描JSON顶层对象（或顶层列表的第一个对象）的字段
+    路径涉及的字段值完整读取后解码，其余字段只跳过不解码；
+    顶层不是对象或遇到超过skip_limit的无关字段时缓存全部内容，结束时完整解析
+    """
+
+    def __init__(self, extractor: ResponseExtractor, skip_limit: Optional[int] = SKIP_LIMIT):
+        """
+        :param skip_limit: 无关字段超过该长度时改为完整解析，为空时总是逐个字段扫描
+        """
+        self.extractor = extractor
+        self.skip_limit = skip_limit
+        self.state = "start" if extractor.incremental else "full"
+        self.buffer = ""
+        self.pos = 0
+        self.consumed = 0
+        self.result: Optional[str] = None
+        self.done = False
+        self._best: Optional[int] = None
+        self._unseen = dict(extractor.first_keys)
+        # 正在读取的字段值
+        self._key: Optional[str] = None
+        self._value_start = 0
+        self._skip_pos = 0
+        self._skip_depth = 0
+        self._in_string = False
+
+    def feed(self, text: str) -> bool:
+        """
+        喂入一段响应文本
+        :return: 已完成提取时返回True
+        """
+        if self.done:
+            return True
+        self.consumed += len(text)
+        if self.state == "full":
+            self.buffer += text
+            return False
+        self.buffer += text
+        try:
+            self._scan(final=False)
+        except _Incomplete:
+            pass
+        return self.done
+
+    def finish(self):
+        """响应结束，处理剩余内容"""
+        if self.done:
+            return
+        if self.state == "full" or not self.buffer.strip():
+            if not self.buffer.strip():
+                self.result = None
+            elif self.skip_limit is None:
+                # 顶层不是对象，没有需要按第一次出现取值的字段
+                self.result = self.extractor.extract(fast_json.loads(self.buffer))
+            else:
+                self.result = self.extractor._decode(self.buffer)
+            self.done = True
+            return
+        try:
+            self._scan(final=True)
+        except _Incomplete:
+            raise ValueError("n8n响应不是完整的JSON")
+        if not self.done:
+            raise ValueError("n8n响应不是完整的JSON")
+
+    def _skip_ws(self) -> str:
+        self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+        if self.pos >= len(self.buffer):
+            raise _Incomplete()
+        return self.buffer[self.pos]
+
+    def _scan(self, final: bool):
+        while not self.done:
+            if self.state == "start":
+                char = self._skip_ws()
+                if char == "{":
+                    self.state = "object"
+                    self.pos += 1
+                elif char == "[":
+                    self.state = "array"
+                    self.pos += 1
+                else:
+                    self._fallback()
+            elif self.state == "array":
+                char = self._skip_ws()
+                if char == "{":
+                    self.state = "object"
+                    self.pos += 1
+                elif char == "]":
+                    self._finish_object()
+                else:
+                    self._fallback()
+            elif self.state == "object":
+                char = self._skip_ws()
+                if char == ",":
+                    self.pos += 1
+                elif char == "}":
+                    self._finish_object()
+                elif char == '"':
+                    self._read_key(final)
+                else:
+                    raise ValueError(f"n8n响应JSON格式错误，位置{self.consumed - len(self.buffer) + self.pos}")
+            elif self.state == "value":
+                try:
+                    if self._skip_value(final):
+                        self._end_value()
+                except _SkipLimitExceeded:
+                    self._fallback()
+            elif self.state == "full":
+                if final:
+                    self.finish()
+                return
+
+    def _fallback(self):
+        # 顶层不是对象（如字符串、非对象列表）或要跳过的字段太大，缓存全部内容后完整解析
+        self.state = "full"
+        self.pos = 0
+
+    def _read_key(self, final: bool):
+        match = _STRING.match(self.buffer, self.pos)
+        if match is None:
+            if final:
+                raise ValueError("n8n响应JSON格式错误：字段名不完整")
+            raise _Incomplete()
+        colon = _WHITESPACE.match(self.buffer, match.end()).end()
+        if colon >= len(self.buffer):
+            raise _Incomplete()
+        if self.buffer[colon] != ":":
+            raise ValueError("n8n响应JSON格式错误：字段名后缺少冒号")
+        value_start = _WHITESPACE.match(self.buffer, colon + 1).end()
+        if value_start >= len(self.buffer):
+            raise _Incomplete()
+        key = fast_json.loads(match.group())
+        self._key = key if key in self._unseen else None
+        self._value_start = self._skip_pos = value_start
+        self._skip_depth = 0
+        self._in_string = False
+        self.pos = value_start
+        self.state = "value"
+
+    def _skip_value(self, final: bool) -> bool:
+        """从上次的位置继续跳过当前字段值，到达值末尾返回True"""
+        buffer = self.buffer
+        pos = self._skip_pos
+        if pos == self._value_start and buffer[pos] not in '"{[':
+            # 数字、true/false/null
+            match = _SCALAR.match(buffer, pos)
+            if match is None:
+                raise ValueError("n8n响应JSON格式错误：字段值为空")
+            if match.end() >= len(buffer) and not final:
+                raise _Incomplete()
+            self._skip_pos = match.end()
+            return True
+        while True:
+            if self._in_string:
+                match = _STRING_STOP.search(buffer, pos)
+                if match is None:
+                    self._skip_pos = len(buffer)
+                    raise _Incomplete()
+                if match.group() == "\\":
+                    if match.end() >= len(buffer):
+                        self._skip_pos = match.start()
+                        raise _Incomplete()
+                    pos = match.end() + 1
+                    continue
+                pos = match.end()
+                self._in_string = False
+                if self._skip_depth == 0:
+                    self._skip_pos = pos
+                    return True
+                continue
+            if self._skip_depth > 0:
+                if self._key is None and self.skip_limit is not None and pos - self._value_start > self.skip_limit:
+                    raise _SkipLimitExceeded()
+                # 括号内的字符串、数字等内容一次跳过，只逐个处理括号
+                pos = _SKIP_RUN.match(buffer, pos).end()
+            if pos >= len(buffer):
+                self._skip_pos = pos
+                raise _Incomplete()
+            char = buffer[pos]
+            pos += 1
+            if char == '"':
+                # 完整的字符串一次跳过，不完整时逐个处理转义字符
+                rest = _STRING_REST.match(buffer, pos)
+                if rest is None:
+                    self._in_string = True
+                    continue
+                pos = rest.end()
+                if self._skip_depth == 0:
+                    self._skip_pos = pos
+                    return True
+            elif char in "{[":
+                self._skip_depth += 1
+            else:
+                self._skip_depth -= 1
+                if self._skip_depth == 0:
+                    self._skip_pos = pos
+                    return True
+
+    def _end_value(self):
+        key = self._key
+        if key is not None:
+            value = fast_json.loads(self.buffer[self._value_start:self._skip_pos])
+            for priority, path in enumerate(self.extractor.paths):
+                if path[0] != key or (self._best is not None and priority >= self._best):
+                    continue
+                text = _resolve(value, path[1:])
+                if isinstance(text, str):
+                    self._best = priority
+                    self.result = text
+            # 重复出现的同名字段不再解码，取第一次出现的值
+            del self._unseen[key]
+            # 剩余字段都不可能提供更高优先级的回复时停止
+            if self._best is not None and all(p > self._best for p in self._unseen.values()):
+                self.done = True
+        self._key = None
+        self.pos = self._skip_pos
+        self.state = "object"
+
+    def _finish_object(self):
+        self.done = True
@@ -0,0 +1,268 @@
+import heapq
+import asyncio
+import logging
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# 发送优先级，数值越小越先发送
+PRIORITY_REPLY = 0
+PRIORITY_NOTICE = 1
+
+# 可合并的消息类型：msgKey -> (正文字段, 合并时的分隔符, 标题字段)
+# 有标题的消息合并时每一段前加上各自的标题，标题中的@用户不会丢失
+MERGEABLE_FIELDS = {
+    "sampleMarkdown": ("text", "\n\n---\n\n", "title"),
+    "sampleText": ("content", "\n\n", None),
+}
+
+
+def _merged_part(msg_key: str, params: Dict[str, Any]) -> str:
+    """一条消息合并后在正文中的内容"""
+    field, _, title_field = MERGEABLE_FIELDS[msg_key]
+    text = params.get(field, "")
+    title = params.get(title_field) if title_field else None
+    return f"**{title}**\n\n{text}" if title else text
+
+
+class TokenBucket:
+    """令牌桶：每秒补充rate个令牌，最多积累burst个；rate<=0表示不限制"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """还需等待多少秒才有可用的令牌"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        if self.rate <= 0:
+            return
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        """令牌已补满，丢弃后重建不影响限流效果"""
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Outbound:
+    __slots__ = ("priority", "seq", "access_token", "conversation_id", "msg_key", "params", "future")
+
+    def __init__(self, priority: int, seq: int, access_token: str, conversation_id: str,
+                 msg_key: str, params: Dict[str, Any], future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.access_token = access_token
+        self.conversation_id = conversation_id
+        self.msg_key = msg_key
+        self.params = params
+        self.future = future
+
+    def __lt__(self, other: "_Outbound") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class GroupSendScheduler:
+    """
+    群消息发送调度器
+    每个群和整个应用各有一个令牌桶，发送速率保持在钉钉的限流以内，不会因为超限失败后再重试；
+    待发送消息按优先级（回复优先于错误提示）和到达顺序排队，一个群限流时不影响其他群；
+    同一个群排队中的同类型消息在发送时合并为一条，合并后的长度不超过merge_max_length；
+    Markdown消息合并时每一段保留各自的标题（如"回复 @用户"），不会被误认为回复给第一个人。
+    """
+
+    def __init__(self, send: Callable[[str, str, str, Dict[str, Any]], Awaitable[bool]],
+                 group_rate: float = 0.25, group_burst: float = 5,
+                 app_rate: float = 20, app_burst: float = 20,
+                 merge: bool = True, merge_max_length: int = 2000):
+        """
+        :param send: 实际发送一条消息的协程函数 (access_token, open_conversation_id, msg_key, params) -> 是否成功
+        :param group_rate: 每个群每秒补充的发送次数，0表示不限制
+        :param group_burst: 每个群最多连续发送的次数
+        :param app_rate: 整个应用每秒补充的发送次数，0表示不限制
+        :param app_burst: 整个应用最多连续发送的次数
+        :param merge: 是否合并同一个群排队中的同类型消息
+        :param merge_max_length: 合并后正文的最大长度（字符数）
+        """
+        self._send = send
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.app_bucket = TokenBucket(app_rate, app_burst)
+        self.merge = merge
+        self.merge_max_length = merge_max_length
+        self._group_buckets: Dict[str, TokenBucket] = {}
+        # 群 -> 按(优先级, 到达顺序)排列的待发送消息
+        self._queues: Dict[str, List[_Outbound]] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+        self.sent = 0
+        self.merged = 0
+
+    @property
+    def pending(self) -> int:
+        """排队中的消息数"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {"pending": self.pending, "sent": self.sent, "merged": self.merged,
+                "groups": len(self._queues)}
+
+    async def submit(self, access_token: str, open_conversation_id: str, msg_key: str,
+                     params: Dict[str, Any], priority: int = PRIORITY_REPLY) -> bool:
+        """
+        提交一条群消息，等待实际发送完成
+        :param msg_key: 消息模板，如sampleMarkdown、sampleText
+        :param params: 消息参数，发送时编码为msgParam
+        :param priority: PRIORITY_REPLY或PRIORITY_NOTICE，数值越小越先发送
+        :return: 发送是否成功（合并发送时与同批消息的结果相同）
+        """
+        self._ensure_dispatcher()
+        item = _Outbound(priority, next(self._seq), access_token, open_conversation_id, msg_key, params,
+                         asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queues.setdefault(open_conversation_id, []), item)
+        self._wakeup.set()
+        return await item.future
+
+    def _ensure_dispatcher(self):
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is not None and self._dispatcher.get_loop() is loop and not self._dispatcher.done():
+            return
+        # Stream SDK重建事件循环后，旧循环中的排队消息已无人等待
+        self._queues = {}
+        self._sending = set()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = loop.create_task(self._dispatch_loop())
+
+    def _group_bucket(self, conversation_id: str) -> TokenBucket:
+        bucket = self._group_buckets.get(conversation_id)
+        if bucket is None:
+            bucket = self._group_buckets[conversation_id] = TokenBucket(self.group_rate, self.group_burst)
+        return bucket
+
+    async def _dispatch_loop(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch_ready()
+            if delay is None:
+                # 没有待发送的消息，顺便清理已补满的群令牌桶
+                now = time.monotonic()
+                self._group_buckets = {cid: bucket for cid, bucket in self._group_buckets.items()
+                                       if not bucket.idle(now)}
+                await self._wakeup.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _dispatch_ready(self) -> Optional[float]:
+        """
+        发送所有当前可以发送的消息
+        :return: 下一条消息可发送前需要等待的秒数，没有待发送的消息时返回None
+        """
+        while True:
+            now = time.monotonic()
+            best: Optional[str] = None
+            next_ready: Optional[float] = None
+            for conversation_id, queue in list(self._queues.items()):
+                # 调用方已取消的消息不再发送
+                while queue and queue[0].future.done():
+                    heapq.heappop(queue)
+                if not queue:
+                    del self._queues[conversation_id]
+                    continue
+                wait = self._group_bucket(conversation_id).wait_time(now)
+                if wait > 0:
+                    next_ready = wait if next_ready is None else min(next_ready, wait)
+                elif best is None or queue[0] < self._queues[best][0]:
+                    best = conversation_id
+            if best is None:
+                return next_ready
+            app_wait = self.app_bucket.wait_time(now)
+            if app_wait > 0:
+                return app_wait
+            self.app_bucket.take(now)
+            self._group_bucket(best).take(now)
+            self._start_send(best)
+
+    def _start_send(self, conversation_id: str):
+        queue = self._queues[conversation_id]
+        batch = [heapq.heappop(queue)]
+        head = batch[0]
+        if self.merge and head.msg_key in MERGEABLE_FIELDS and queue:
+            separator = MERGEABLE_FIELDS[head.msg_key][1]
+            length = len(_merged_part(head.msg_key, head.params))
+            rest = []
+            for item in sorted(queue):
+                if item.future.done():
+                    continue
+                if item.msg_key != head.msg_key:
+                    rest.append(item)
+                    continue
+                text = _merged_part(item.msg_key, item.params)
+                if length + len(separator) + len(text) <= self.merge_max_length:
+                    batch.append(item)
+                    length += len(separator) + len(text)
+                else:
+                    rest.append(item)
+            queue[:] = rest
+            heapq.heapify(queue)
+        if not queue:
+            del self._queues[conversation_id]
+        task = asyncio.get_running_loop().create_task(self._send_batch(conversation_id, batch))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send_batch(self, conversation_id: str, batch: List[_Outbound]):
+        head = batch[0]
+        params = head.params
+        if len(batch) > 1:
+            field, separator, title_field = MERGEABLE_FIELDS[head.msg_key]
+            params = dict(params, **{field: separator.join(_merged_part(item.msg_key, item.params)
+                                                           for item in batch)})
+            if title_field and any(item.params.get(title_field) != head.params.get(title_field) for item in batch):
+                params[title_field] = f"{head.params.get(title_field, '')} 等{len(batch)}条回复"
+            self.merged += len(batch) - 1
+            logger.info(f"合并{len(batch)}条待发送的群消息: {conversation_id}")
+        try:
+            # 使用最近提交的access_token
+            success = await self._send(batch[-1].access_token, conversation_id, head.msg_key, params)
+        except Exception as e:
+            logger.error(f"发送群消息异常: {e}")
+            success = False
+        self.sent += 1
+        for item in batch:
+            if not item.future.done():
+                item.future.set_result(success)
+
+    async def close(self):
+        """停止调度，排队中的消息视为发送失败"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, *self._sending, return_exceptions=True)
+            self._dispatcher = None
+        for queue in self._queues.values():
+            for item in queue:
+                if not item.future.done():
+                    item.future.set_result(False)
+        self._queues = {}
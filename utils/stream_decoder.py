@@ -0,0 +1,141 @@
+import logging
+from typing import Any, List, Optional
+
+from utils import fast_json
+
+logger = logging.getLogger(__name__)
+
+# n8n "Respond to Webhook"（流式）节点逐行输出的消息类型
+N8N_STREAM_TYPES = ("begin", "item", "end", "error")
+
+
+class SSEDecoder:
+    """增量SSE(text/event-stream)解码器，按字节块喂入，返回完整事件的data"""
+
+    def __init__(self):
+        self._buffer = ""
+        self._data_lines: List[str] = []
+
+    def feed(self, chunk: str) -> List[str]:
+        """
+        喂入一段文本，返回已完整的事件data列表
+        :param chunk: 响应体文本片段
+        :return: 事件data列表
+        """
+        self._buffer += chunk
+        events = []
+        while True:
+            index = self._buffer.find("\n")
+            if index < 0:
+                break
+            line = self._buffer[:index].rstrip("\r")
+            self._buffer = self._buffer[index + 1:]
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def flush(self) -> List[str]:
+        """响应结束时取出剩余事件"""
+        events = []
+        if self._buffer:
+            event = self._process_line(self._buffer.rstrip("\r"))
+            self._buffer = ""
+            if event is not None:
+                events.append(event)
+        event = self._process_line("")
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: str) -> Optional[str]:
+        # 空行表示一个事件结束
+        if not line:
+            if not self._data_lines:
+                return None
+            data = "\n".join(self._data_lines)
+            self._data_lines = []
+            return data
+        # 注释行
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            self._data_lines.append(value)
+        return None
+
+
+class NDJSONDecoder:
+    """增量NDJSON解码器，每行一个JSON对象"""
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, chunk: str) -> List[Any]:
+        """
+        喂入一段文本，返回已完整解析的JSON对象列表
+        :param chunk: 响应体文本片段
+        :return: JSON对象列表
+        """
+        self._buffer += chunk
+        objects = []
+        while True:
+            index = self._buffer.find("\n")
+            if index < 0:
+                break
+            line = self._buffer[:index]
+            self._buffer = self._buffer[index + 1:]
+            obj = self._decode_line(line)
+            if obj is not None:
+                objects.append(obj)
+        return objects
+
+    def flush(self) -> List[Any]:
+        """响应结束时解析最后一行（可能没有换行符）"""
+        line, self._buffer = self._buffer, ""
+        obj = self._decode_line(line)
+        return [obj] if obj is not None else []
+
+    @staticmethod
+    def _decode_line(line: str) -> Optional[Any]:
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            return fast_json.loads(line)
+        except ValueError:
+            logger.warning(f"无法解析的NDJSON行: {line[:200]}")
+            return None
+
+
+def is_n8n_stream_object(obj: Any) -> bool:
+    """判断JSON对象是否为n8n流式响应的消息"""
+    return isinstance(obj, dict) and obj.get("type") in N8N_STREAM_TYPES
+
+
+def extract_stream_text(obj: Any) -> Optional[str]:
+    """
+    从流式消息中提取文本增量
+    支持n8n流式格式 {"type": "item", "content": "..."}，
+    以及常见的 {"content"|"delta"|"text"|"output": "..."} 格式
+    :param obj: SSE data字符串或NDJSON对象
+    :return: 文本增量，没有内容返回None
+    """
+    if isinstance(obj, str):
+        return obj
+    if not isinstance(obj, dict):
+        return None
+    if "type" in obj and obj["type"] in N8N_STREAM_TYPES:
+        if obj["type"] == "item":
+            content = obj.get("content")
+            return content if isinstance(content, str) else None
+        if obj["type"] == "error":
+            logger.error(f"n8n流式响应返回错误: {obj}")
+        return None
+    for key in ("content", "delta", "text", "output", "response"):
+        value = obj.get(key)
+        if isinstance(value, str):
+            return value
+    return None
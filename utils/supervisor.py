@@ -0,0 +1,166 @@
+import os
+import time
+import signal
+import logging
+import subprocess
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 标识worker进程的环境变量，值为worker编号
+WORKER_ID_ENV = "DINGTALK_BOT_WORKER_ID"
+
+# 运行超过该时长（秒）后退出的worker不计入连续崩溃，重启等待时间恢复为初始值
+STABLE_UPTIME = 60
+
+
+class _Worker:
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at: Optional[float] = None
+        self.restarts = 0
+
+
+class WorkerSupervisor:
+    """
+    多进程模式的主进程
+    启动N个worker子进程，每个worker建立自己的Stream长连接，钉钉会把回调分散到各个连接上。
+    worker异常退出后自动重启，连续崩溃时重启等待时间指数增长；
+    收到SIGINT/SIGTERM时转发给所有worker，等待它们处理完手头的消息后退出，超时后强制结束；
+    收到SIGHUP时逐个滚动重启：先启动新worker，再让旧worker断开连接并处理完手头的消息。
+    """
+
+    def __init__(self, command: List[str], workers: int, env: Dict[str, str] = None,
+                 restart_delay: float = 1.0, max_restart_delay: float = 30.0,
+                 shutdown_timeout: float = 30.0, reload_grace: float = 5.0,
+                 poll_interval: float = 0.5):
+        """
+        :param command: 启动worker的命令
+        :param workers: worker数量
+        :param env: 额外传给worker的环境变量
+        :param restart_delay: worker崩溃后首次重启前的等待时间（秒）
+        :param max_restart_delay: 连续崩溃时重启等待时间的上限（秒）
+        :param shutdown_timeout: 关闭时等待worker退出的时间（秒），超时后强制结束
+        :param reload_grace: 滚动重启时新worker启动后、关闭旧worker前的等待时间（秒），用于建立长连接
+        """
+        if workers < 1:
+            raise ValueError("worker数量至少为1")
+        self.command = command
+        self.env = env or {}
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.reload_grace = reload_grace
+        self.poll_interval = poll_interval
+        self.workers = [_Worker(worker_id) for worker_id in range(workers)]
+        self._stop_signal: Optional[int] = None
+        self._reload_requested = False
+
+    def _spawn(self, worker: _Worker):
+        env = dict(os.environ, **self.env)
+        env[WORKER_ID_ENV] = str(worker.worker_id)
+        # worker在独立的进程组中运行，终端的Ctrl+C只发给主进程，由主进程统一转发
+        worker.process = subprocess.Popen(self.command, env=env, start_new_session=True)
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logger.info(f"worker {worker.worker_id} 已启动，pid={worker.process.pid}")
+
+    def _check(self, worker: _Worker):
+        now = time.monotonic()
+        if worker.restart_at is not None:
+            if now >= worker.restart_at:
+                worker.restarts += 1
+                self._spawn(worker)
+            return
+        code = worker.process.poll()
+        if code is None:
+            return
+        uptime = now - worker.started_at
+        if uptime >= STABLE_UPTIME:
+            worker.restart_delay = self.restart_delay
+        else:
+            worker.restart_delay = min(max(worker.restart_delay * 2, self.restart_delay), self.max_restart_delay)
+        worker.restart_at = now + worker.restart_delay
+        logger.error(f"worker {worker.worker_id} 已退出（退出码{code}，运行{uptime:.1f}秒），"
+                     f"{worker.restart_delay:.1f}秒后重启")
+
+    def stop(self, signum: int = signal.SIGTERM):
+        """请求关闭，可在信号处理器中调用"""
+        self._stop_signal = signum
+
+    def reload(self):
+        """请求滚动重启所有worker，可在信号处理器中调用"""
+        self._reload_requested = True
+
+    def _signal_handler(self, signum, frame):
+        if signum == getattr(signal, "SIGHUP", None):
+            logger.info(f"收到信号 {signum}，开始滚动重启worker...")
+            self.reload()
+            return
+        logger.info(f"收到信号 {signum}，通知所有worker关闭...")
+        self.stop(signum)
+
+    def _terminate(self, processes: List[subprocess.Popen], signum: int):
+        """向进程发送信号并等待退出，超时后强制结束"""
+        for process in processes:
+            try:
+                process.send_signal(signum)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in processes:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"worker进程 {process.pid} 未在{self.shutdown_timeout}秒内退出，强制结束")
+                process.kill()
+                process.wait()
+
+    def _rolling_restart(self):
+        self._reload_requested = False
+        for worker in self.workers:
+            if self._stop_signal is not None:
+                return
+            old = worker.process
+            self._spawn(worker)
+            # 新worker建立长连接后，旧worker再断开，期间的消息由其他连接接收
+            deadline = time.monotonic() + self.reload_grace
+            while self._stop_signal is None and time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+            if old is not None and old.poll() is None:
+                self._terminate([old], signal.SIGTERM)
+        logger.info("滚动重启完成")
+
+    def _shutdown(self):
+        alive = [w.process for w in self.workers if w.process is not None and w.process.poll() is None]
+        self._terminate(alive, self._stop_signal)
+        logger.info("所有worker已退出")
+
+    def run(self, install_signal_handlers: bool = True) -> int:
+        """
+        启动所有worker并持续监控，直到收到关闭信号
+        :param install_signal_handlers: 是否注册SIGINT/SIGTERM处理器（只能在主线程中注册）
+        :return: 退出码
+        """
+        if install_signal_handlers:
+            signal.signal(signal.SIGINT, self._signal_handler)
+            signal.signal(signal.SIGTERM, self._signal_handler)
+            if hasattr(signal, "SIGHUP"):
+                signal.signal(signal.SIGHUP, self._signal_handler)
+        for worker in self.workers:
+            self._spawn(worker)
+        try:
+            while self._stop_signal is None:
+                if self._reload_requested:
+                    self._rolling_restart()
+                for worker in self.workers:
+                    self._check(worker)
+                time.sleep(self.poll_interval)
+        finally:
+            if self._stop_signal is None:
+                self._stop_signal = signal.SIGTERM
+            self._shutdown()
+        return 0
@@ -1,62 +1,252 @@
+import os
+import json
 import time
+import asyncio
 import logging
-from alibabacloud_dingtalk.oauth2_1_0.client import Client as DingTalkOAuthClient
-from alibabacloud_dingtalk.oauth2_1_0 import models as oauth_models
-from alibabacloud_tea_openapi import models as open_api_models
+import contextlib
+from typing import Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows下不支持文件锁，退化为各进程独立刷新
+    fcntl = None
+
+from services.dingtalk_openapi import DingTalkOpenAPIClient, get_openapi_client, offload
 
 logger = logging.getLogger(__name__)
 
 class TokenManager:
-    """钉钉Access Token管理器"""
+    """
+    钉钉Access Token管理器
+    - 并发调用只会触发一次刷新（single-flight）
+    - 后台任务在过期前主动刷新，请求路径上基本不会等待token
+    - 进入提前刷新窗口后仍返回未过期的token，同时在后台刷新（stale-while-revalidate）
+    - 刷新失败时在token真正过期前继续使用旧token
+    - 可选的本地文件缓存，同一台机器上的多个进程共用一个token
+    """
     
-    def __init__(self, client_id: str, client_secret: str):
+    def __init__(self, client_id: str, client_secret: str,
+                 openapi_client: DingTalkOpenAPIClient = None,
+                 refresh_ahead: int = 300, cache_file: str = None,
+                 background_refresh: bool = True):
+        """
+        :param refresh_ahead: 提前多少秒刷新token
+        :param cache_file: 多进程共享的token缓存文件路径，为空则只在进程内缓存
+        :param background_refresh: 是否启动后台主动刷新任务
+        """
         self.client_id = client_id
         self.client_secret = client_secret
+        self.openapi_client = openapi_client or get_openapi_client()
+        self.refresh_ahead = refresh_ahead
+        self.cache_file = cache_file
+        self.background_refresh = background_refresh
         self._token_cache = {"token": None, "expire": 0}
+        self._rejected_token: Optional[str] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        self._refresher: Optional[asyncio.Task] = None
+    
+    def _is_fresh(self, now: float) -> bool:
+        return bool(self._token_cache["token"]) and now < self._token_cache["expire"] - self.refresh_ahead
+    
+    def _is_usable(self, now: float) -> bool:
+        return bool(self._token_cache["token"]) and now < self._token_cache["expire"]
     
-    def get_token(self) -> str:
+    def health(self) -> Tuple[bool, str]:
         """
-        获取access_token，带本地缓存，2小时有效，提前200秒刷新
+        token状态，用于健康检查
+        尚未获取过token时视为正常（首次使用时才获取），已获取的token过期说明刷新持续失败
+        :return: (是否正常, 说明) 元组
+        """
+        if not self._token_cache["token"]:
+            return True, "尚未获取"
+        expires_in = self._token_cache["expire"] - time.time()
+        if expires_in <= 0:
+            return False, "token已过期，刷新失败"
+        return True, f"剩余有效期{int(expires_in)}秒"
+    
+    async def get_token(self) -> Optional[str]:
+        """
+        获取access_token，带本地缓存，2小时有效，提前refresh_ahead秒刷新
+        只有没有token或token已过期时才等待刷新完成
         :return: access_token字符串，获取失败返回None
         """
-        now = time.time()
+        self._ensure_refresher()
         
         # 检查缓存是否有效
-        if self._token_cache["token"] and now < self._token_cache["expire"]:
+        now = time.time()
+        if self._is_fresh(now):
             logger.debug("使用缓存的access_token")
             return self._token_cache["token"]
+        if self._is_usable(now):
+            # 即将过期：在后台刷新，本次继续使用仍然有效的token
+            self._start_refresh()
+            return self._token_cache["token"]
         
-        # 重新获取token
-        logger.info("重新获取access_token")
-        config = open_api_models.Config()
-        config.protocol = 'https'
-        config.region_id = 'central'
-        
-        client = DingTalkOAuthClient(config)
-        request = oauth_models.GetAccessTokenRequest(
-            app_key=self.client_id,
-            app_secret=self.client_secret
-        )
-        
-        try:
-            response = client.get_access_token(request)
-            token = getattr(response.body, "access_token", None)
-            expire_in = getattr(response.body, "expire_in", 7200)
+        return await self.refresh()
+    
+    async def refresh(self) -> Optional[str]:
+        """
+        刷新access_token，并发调用共享同一次刷新
+        :return: access_token字符串，刷新失败且旧token已过期时返回None
+        """
+        # shield：单个调用方被取消时不影响其他等待者
+        return await asyncio.shield(self._start_refresh())
+    
+    def _start_refresh(self) -> asyncio.Task:
+        """启动一次刷新，已有刷新进行中时返回该刷新任务"""
+        loop = asyncio.get_running_loop()
+        task = self._refreshing
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = loop.create_task(self._do_refresh())
+            task.add_done_callback(self._handle_refresh_exception)
+            self._refreshing = task
+        return task
+    
+    @staticmethod
+    def _handle_refresh_exception(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"刷新access_token异常: {task.exception()}")
+    
+    async def _do_refresh(self) -> Optional[str]:
+        async with self._cache_file_lock():
+            # 其他进程可能已经刷新过
+            if self._load_cache_file() and self._is_fresh(time.time()):
+                logger.info("使用共享缓存文件中的access_token")
+                return self._token_cache["token"]
+            
+            logger.info("重新获取access_token")
+            now = time.time()
+            try:
+                result = await self.openapi_client.get_access_token(self.client_id, self.client_secret)
+            except Exception as err:
+                logger.error(f"获取access_token异常: {err}")
+                result = None
             
-            if token:
-                self._token_cache["token"] = token
-                self._token_cache["expire"] = now + expire_in - 200  # 提前200秒刷新
+            if result:
+                self._token_cache = {
+                    "token": result["accessToken"],
+                    "expire": now + result.get("expireIn", 7200),
+                }
+                self._save_cache_file()
                 logger.info("access_token获取成功")
-                return token
-            else:
-                logger.error("获取access_token失败：响应中没有token")
-                return None
-                
-        except Exception as err:
-            logger.error(f"获取access_token异常: {err}")
+                return self._token_cache["token"]
+            
+            if self._is_usable(time.time()):
+                logger.warning("刷新access_token失败，继续使用未过期的旧token")
+                return self._token_cache["token"]
+            logger.error("获取access_token失败：响应中没有token")
             return None
     
+    def _ensure_refresher(self):
+        """在当前事件循环中启动后台刷新任务"""
+        if not self.background_refresh:
+            return
+        loop = asyncio.get_running_loop()
+        if self._refresher is None or self._refresher.done() or self._refresher.get_loop() is not loop:
+            self._refresher = loop.create_task(self._refresh_loop())
+    
+    async def _refresh_loop(self):
+        while True:
+            delay = self._token_cache["expire"] - self.refresh_ahead - time.time()
+            if self._token_cache["token"] and delay > 0:
+                await asyncio.sleep(delay)
+            token = await self.refresh()
+            if not token or not self._is_fresh(time.time()):
+                # 刷新失败，稍后重试
+                await asyncio.sleep(10)
+    
+    def _load_cache_file(self) -> bool:
+        """从共享缓存文件读取token，读取到同一应用的token返回True"""
+        if not self.cache_file:
+            return False
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("client_id") != self.client_id or not data.get("token"):
+            return False
+        if data["token"] == self._rejected_token:
+            return False
+        if data.get("expire", 0) > self._token_cache["expire"]:
+            self._token_cache = {"token": data["token"], "expire": data["expire"]}
+        return True
+    
+    def _save_cache_file(self):
+        if not self.cache_file:
+            return
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({"client_id": self.client_id, **self._token_cache}, f)
+            os.chmod(tmp_file, 0o600)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as err:
+            logger.warning(f"写入token缓存文件失败: {err}")
+    
+    @contextlib.asynccontextmanager
+    async def _cache_file_lock(self):
+        """
+        持有共享缓存文件的进程间锁，多个进程同时刷新时只有一个调用OAuth接口
+        等待锁期间被取消时，线程池中稍后拿到的锁会立即释放，不泄漏文件描述符
+        """
+        if not self.cache_file:
+            yield
+            return
+        future = asyncio.ensure_future(offload(self._lock_cache_file))
+        try:
+            lock_fd = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self._release_abandoned_lock)
+            raise
+        try:
+            yield
+        finally:
+            if lock_fd is not None:
+                self._unlock_cache_file(lock_fd)
+    
+    def _lock_cache_file(self) -> Optional[int]:
+        if fcntl is None:
+            return None
+        try:
+            fd = os.open(f"{self.cache_file}.lock", os.O_CREAT | os.O_RDWR, 0o600)
+        except OSError as err:
+            logger.warning(f"打开token缓存锁文件失败: {err}")
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+    
+    @classmethod
+    def _release_abandoned_lock(cls, future: asyncio.Future):
+        """等待者已被取消，释放随后拿到的锁"""
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            cls._unlock_cache_file(future.result())
+    
+    @staticmethod
+    def _unlock_cache_file(fd: int):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+    
     def clear_cache(self):
-        """清除token缓存"""
+        """清除token缓存（如接口返回token无效时调用），共享缓存文件中的同一token也不再使用"""
+        self._rejected_token = self._token_cache["token"]
         self._token_cache = {"token": None, "expire": 0}
-        logger.info("已清除token缓存") 
\ No newline at end of file
+        logger.info("已清除token缓存")
+    
+    async def close(self):
+        """停止后台刷新任务和进行中的刷新"""
+        for task in (self._refresher, self._refreshing):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._refresher = None
+        self._refreshing = None
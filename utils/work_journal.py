@@ -0,0 +1,295 @@
+import os
+import time
+import queue
+import sqlite3
+import asyncio
+import logging
+import threading
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, List, NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from utils import fast_json
+
+logger = logging.getLogger(__name__)
+
+KIND_INBOUND = "inbound"
+KIND_OUTBOUND = "outbound"
+
+# 当前正在处理的入站消息对应的条目ID，处理过程中的出站发送记录为它的子条目
+CURRENT_ENTRY: ContextVar[Optional[int]] = ContextVar("journal_entry", default=None)
+
+# 一个事务最多合并的操作数
+MAX_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    parent INTEGER,
+    owner TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+)
+"""
+
+
+class JournalEntry(NamedTuple):
+    """一条未完成的日志条目"""
+    id: int
+    kind: str               # inbound（已接受的入站消息）/outbound（待发送的群消息）
+    payload: Any
+    parent: Optional[int]   # 出站发送所属的入站消息
+    attempts: int           # 已重放的次数
+    created: float          # 写入时间（time.time()）
+
+
+class WorkJournal:
+    """
+    持久化工作日志
+    已接受的入站消息在ACK前、待发送的群消息在发送前写入本地SQLite（WAL模式），处理完成后删除；
+    进程崩溃或被OOM kill后，下次启动时重放未完成的条目，实现至少一次投递。
+    写入由后台线程批量提交：同时到达的多条记录合并为一个事务、一次fsync，
+    ACK只多等待一次fsync，不需要等到回复完成。
+    多个进程可以共用一个日志文件：每个进程只重放已退出的进程留下的条目，由文件锁判断之前的进程是否都已退出。
+    """
+
+    def __init__(self, path: str, lock_retry_interval: float = 2.0):
+        """
+        :param path: SQLite数据库文件路径
+        :param lock_retry_interval: 旧进程仍在运行（如滚动重启）时，重新检查的间隔（秒）
+        """
+        self.path = path
+        self.lock_retry_interval = lock_retry_interval
+        # 区分本进程写入的条目和之前的进程留下的条目
+        self.owner = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock_file = None
+        self.batches = 0
+        self.operations = 0
+
+    def open(self):
+        """创建数据库并启动后台写入线程"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        started = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                conn = sqlite3.connect(self.path, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                # 每次提交都fsync WAL文件，提交成功即已落盘
+                conn.execute("PRAGMA synchronous=FULL")
+                conn.execute("PRAGMA busy_timeout=5000")
+                conn.execute(SCHEMA)
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            try:
+                self._write_loop(conn)
+            finally:
+                conn.close()
+
+        self._thread = threading.Thread(target=run, name="work-journal", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            self._thread = None
+            raise errors[0]
+        logger.info(f"工作日志已打开: {self.path}")
+
+    def _write_loop(self, conn: sqlite3.Connection):
+        while True:
+            ops = [self._queue.get()]
+            # 合并写入线程忙于上一次提交期间到达的所有操作
+            while len(ops) < MAX_BATCH:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            results = []
+            error = None
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for op, args, _, _ in ops:
+                        results.append(self._execute(conn, op, args))
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            except Exception as e:
+                logger.error(f"写入工作日志失败: {e}")
+                error = e
+            self.batches += 1
+            self.operations += len(ops)
+            for i, (_, _, future, loop) in enumerate(ops):
+                if future is not None:
+                    self._resolve(loop, future, results[i] if error is None else None, error)
+            if any(op == "stop" for op, _, _, _ in ops):
+                return
+
+    def _execute(self, conn: sqlite3.Connection, op: str, args: tuple) -> Any:
+        if op == "append":
+            kind, payload, parent = args
+            cursor = conn.execute(
+                "INSERT INTO journal (kind, payload, parent, owner, created) VALUES (?, ?, ?, ?, ?)",
+                (kind, fast_json.dumps(payload), parent, self.owner, time.time()))
+            return cursor.lastrowid
+        if op == "complete":
+            conn.executemany("DELETE FROM journal WHERE id = ?", [(entry_id,) for entry_id in args])
+            return None
+        if op == "claim":
+            return self._claim(conn, *args)
+        return None
+
+    def _claim(self, conn: sqlite3.Connection, max_age: float, max_attempts: int) -> List[JournalEntry]:
+        """把之前的进程留下的条目转给本进程，返回需要重放的条目"""
+        rows = conn.execute(
+            "SELECT id, kind, payload, parent, attempts, created FROM journal WHERE owner != ? ORDER BY id",
+            (self.owner,)).fetchall()
+        entries = [JournalEntry(row[0], row[1], fast_json.loads(row[2]), row[3], row[4], row[5]) for row in rows]
+        incomplete = {entry.id for entry in entries if entry.kind == KIND_INBOUND}
+        cutoff = time.time() - max_age if max_age > 0 else None
+        replay, dropped = [], []
+        for entry in entries:
+            if entry.parent in incomplete:
+                # 所属的入站消息会整体重新处理，重新生成回复
+                dropped.append(entry.id)
+            elif cutoff is not None and entry.created < cutoff:
+                logger.warning(f"丢弃过期的日志条目: id={entry.id}, kind={entry.kind}")
+                dropped.append(entry.id)
+            elif max_attempts and entry.attempts >= max_attempts:
+                logger.error(f"日志条目重放{entry.attempts}次仍未完成，不再重放: id={entry.id}, kind={entry.kind}")
+                dropped.append(entry.id)
+            else:
+                replay.append(entry)
+        conn.executemany("DELETE FROM journal WHERE id = ?", [(entry_id,) for entry_id in dropped])
+        conn.executemany("UPDATE journal SET owner = ?, attempts = attempts + 1 WHERE id = ?",
+                         [(self.owner, entry.id) for entry in replay])
+        return replay
+
+    @staticmethod
+    def _resolve(loop: asyncio.AbstractEventLoop, future: asyncio.Future, result: Any, error: Optional[Exception]):
+        def resolve():
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            # 事件循环已关闭，调用方已不再等待
+            pass
+
+    def _submit(self, op: str, args: tuple = (), wait: bool = True) -> Optional[asyncio.Future]:
+        if self._thread is None:
+            raise RuntimeError("工作日志未打开")
+        if not wait:
+            self._queue.put((op, args, None, None))
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((op, args, future, loop))
+        return future
+
+    async def append(self, kind: str, payload: Any, parent: Optional[int] = None) -> int:
+        """
+        写入一条记录，落盘后返回
+        :param kind: inbound/outbound
+        :param payload: 可JSON序列化的内容
+        :param parent: 所属的入站消息条目ID
+        :return: 条目ID
+        """
+        return await self._submit("append", (kind, payload, parent))
+
+    async def record(self, kind: str, payload: Any, parent: Optional[int] = None) -> Optional[int]:
+        """与append相同，但写入失败时只记录错误并返回None，不影响消息处理"""
+        try:
+            return await self.append(kind, payload, parent)
+        except Exception as e:
+            logger.error(f"记录工作日志失败，本条消息在崩溃后无法重放: {e}")
+            return None
+
+    def complete(self, entry_id: Optional[int]):
+        """标记条目已完成，与之后的写入一起批量提交，不等待落盘"""
+        if entry_id is not None and self._thread is not None:
+            self._submit("complete", (entry_id,), wait=False)
+
+    async def flush(self):
+        """等待之前提交的所有操作落盘"""
+        await self._submit("flush")
+
+    def try_lock(self) -> bool:
+        """
+        尝试获取日志文件的独占锁，进程退出（包括崩溃）时由系统自动释放
+        :return: 获取成功说明之前的进程都已退出
+        """
+        if fcntl is None:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    async def recover(self, max_age: float = 3600, max_attempts: int = 3) -> List[JournalEntry]:
+        """
+        接管之前的进程留下的未完成条目
+        等到之前的进程都已退出后才返回（滚动重启时旧进程仍在处理自己的消息）；
+        过期、重放次数过多的条目，以及所属入站消息会被重新处理的出站条目直接丢弃
+        :param max_age: 超过该时长（秒）的条目不再重放，0表示不限制
+        :param max_attempts: 每个条目最多重放的次数，0表示不限制
+        :return: 需要重放的条目，按写入顺序排列
+        """
+        while not self.try_lock():
+            logger.info(f"工作日志仍被其他进程使用，{self.lock_retry_interval}秒后重试")
+            await asyncio.sleep(self.lock_retry_interval)
+        return await self._submit("claim", (max_age, max_attempts))
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "operations": self.operations}
+
+    async def close(self):
+        """提交剩余操作并停止后台线程"""
+        if self._thread is None:
+            return
+        await self._submit("stop")
+        self._thread.join(timeout=5)
+        self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        logger.info(f"工作日志已关闭: {self.stats()}")
+
+
+async def run_journaled(journal: Optional[WorkJournal], entry_id: Optional[int],
+                        func: Callable[..., Awaitable[Any]], *args):
+    """
+    处理一条已记录的入站消息，处理结束（包括已处理的失败）后把条目标记为完成；
+    被取消（关闭时未能处理完）或进程崩溃时条目保留，下次启动时重放
+    """
+    token = CURRENT_ENTRY.set(entry_id)
+    cancelled = False
+    try:
+        await func(*args)
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        CURRENT_ENTRY.reset(token)
+        if journal is not None and not cancelled:
+            journal.complete(entry_id)